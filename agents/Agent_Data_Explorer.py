@@ -2,7 +2,8 @@
 # 描述统计、分布分析、相关性分析
 # 关键工具（示例）：seaborn, matplotlib, statsmodels
 
-from tools import get_table_schema, get_tables_from_db, run_db_query
+from tools import get_table_schema, get_tables_from_db, get_database_schema, describe_tables, run_db_query, profile_table
+from tools import ExcelToDBTool, IngestJobStatusTool
 from langchain.agents import create_agent
 from config import settings
 from models.Deepseek_Models import call_deepseek_chat
@@ -11,7 +12,12 @@ from prompts import DataExplorerPrompts
 tools = [
     get_tables_from_db,
     get_table_schema,
-    run_db_query
+    get_database_schema,
+    describe_tables,
+    run_db_query,
+    profile_table,
+    ExcelToDBTool(),
+    IngestJobStatusTool()
 ]
 
 agent = create_agent(
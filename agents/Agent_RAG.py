@@ -1,14 +1,15 @@
 # RAG智能问答智能体
 # 负责基于本地知识库的智能问答
 
-from tools.Tool_RAG import retrieve_documents, refresh_knowledge_base
+from tools.Tool_RAG import retrieve_documents, refresh_knowledge_base, list_knowledge_bases
 from langchain.agents import create_agent
 from config import settings
 from models.Deepseek_Models import call_deepseek_chat
 
 tools = [
     retrieve_documents,
-    refresh_knowledge_base
+    refresh_knowledge_base,
+    list_knowledge_bases
 ]
 
 prompt = """
@@ -22,6 +23,9 @@ prompt = """
 3. 如果文档中没有相关信息，才告知用户"知识库中没有相关信息"
 4. 引用具体的文档来源
 
+知识库按业务领域划分，不指定 knowledge_base 时检索默认知识库；问题属于其他领域时，
+先用 list_knowledge_bases 查看可用的知识库，再在 retrieve_documents 中指定名称
+
 禁止行为：
 - 禁止在未检索的情况下直接拒绝回答
 - 禁止在未检索的情况下说"我没有相关信息"
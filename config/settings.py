@@ -37,6 +37,104 @@ class Settings(BaseSettings):
     db_name: str
     db_port: int = 3306
 
+    # 数据库连接池配置（Tool_DBM 等工具共享）
+    db_pool_size: int = 5                 # 每个连接目标常驻的连接数
+    db_pool_max_overflow: int = 5         # 高峰期允许额外创建的连接数
+    db_pool_timeout: int = 30             # 等待空闲连接的超时时间（秒）
+    db_pool_recycle: int = 3600           # 连接最长存活时间（秒），避免被 MySQL wait_timeout 断开
+    db_pool_idle_timeout: int = 600       # 连接目标空闲超过该时间（秒）后释放整个引擎
+    db_pool_max_engines: int = 8          # 最多同时缓存的连接目标数量（LRU 淘汰）
+    db_connect_timeout: int = 10          # 建立 TCP 连接的超时时间（秒）
+    db_introspect_workers: int = 4        # 并发获取元数据时的最大并发连接数（不应超过连接池容量）
+
+    # run_db_query 流式查询配置
+    db_query_max_rows: int = 200          # 返回给 Agent 的最大预览行数
+    db_query_max_bytes: int = 64 * 1024   # 返回给 Agent 的最大预览字节数
+    db_spill_dir: str = "outputs/query_results"  # 完整结果落盘目录（相对项目根目录）
+    db_query_output_format: str = "csv"   # 查询结果的默认编码：csv / tsv / markdown / json
+    db_query_float_digits: int = 4        # 浮点数保留的小数位数
+    db_query_max_cell_width: int = 80     # 单元格最大字符数，超出部分截断
+
+    # run_db_query 查询结果缓存配置（仅缓存只读查询）
+    db_query_cache_enabled: bool = True
+    db_query_cache_ttl: int = 600                          # 缓存有效期（秒）
+    db_query_cache_max_entries: int = 256                  # 内存缓存最大条目数（LRU）
+    db_query_cache_max_bytes: int = 64 * 1024 * 1024       # 内存缓存最大字节数
+    db_query_cache_disk_path: Optional[str] = None         # SQLite 磁盘缓存路径，为空时不启用
+    db_query_cache_disk_max_entries: int = 5000            # 磁盘缓存最大条目数
+
+    # run_db_query 执行前的 EXPLAIN 准入检查
+    db_guard_enabled: bool = True
+    db_guard_rewrite_rows: int = 1_000_000      # 预计扫描行数超过该值时改写查询（加 LIMIT 和执行超时）
+    db_guard_reject_rows: int = 50_000_000      # 预计扫描行数超过该值时直接拒绝
+    db_guard_reject_cartesian: bool = True      # 是否拒绝无连接条件的全表连接（疑似笛卡尔积）
+    db_guard_max_execution_ms: int = 30000      # 改写时注入的 MAX_EXECUTION_TIME（毫秒）
+    db_guard_default_limit: int = 1000          # 改写时注入的 LIMIT
+
+    # profile_table 表概况配置
+    db_profile_histogram_buckets: int = 10          # 数值列直方图的分桶数
+    db_profile_exact_distinct_rows: int = 100_000   # 表行数不超过该值时精确统计去重数，否则使用 PCSA 近似
+    db_profile_sketch_buckets: int = 16             # PCSA 近似去重的分桶数（越大越准，SQL 越长）
+    db_profile_top_values: int = 5                  # 低基数文本列返回的高频值个数
+    db_profile_top_max_distinct: int = 50           # 去重数不超过该值的文本列才统计高频值
+    db_profile_max_execution_ms: int = 120000       # 每轮聚合查询的执行超时（毫秒）
+
+    # 采样查询配置（run_db_query / profile_table 按需启用）
+    db_sample_method: str = "modulo"                # 默认采样方式：modulo / range / table
+    db_sample_range_stripes: int = 100              # range 采样把主键范围切分的条带数
+    db_sample_table_prefix: str = "__sample_"       # 物化样本表的表名前缀
+    db_sample_refresh_interval: int = 24 * 3600     # 物化样本表的刷新间隔（秒）
+
+    # 表结构缓存配置
+    db_schema_check_interval: int = 30    # 两次检查表结构版本之间的最小间隔（秒）
+    db_describe_max_tables: int = 100     # describe_tables 单次最多描述的表数量
+
+    # 数据导入配置（ExcelToDBTool）
+    ingest_chunk_rows: int = 5000         # 流式导入时每个分块的行数，决定导入过程的峰值内存
+    ingest_load_strategy: str = "auto"    # 写入策略：auto / executemany / transaction / load_data
+    ingest_batch_rows: int = 1000         # executemany 每批的行数（会被合并为一条多行 INSERT）
+    ingest_job_workers: int = 2           # 同时执行的后台导入任务数
+    ingest_sheet_workers: int = 4         # 导入多个工作表时的并行数
+    ingest_auto_index_max: int = 3        # 新建表时自动建索引的最大列数
+    ingest_job_history: int = 100         # 保留的已结束任务记录数
+    ingest_manifest_table: str = "__ingest_manifest"  # 记录文件指纹和分块指纹的清单表，用于跳过未变化的重复导入
+
+    # 知识库配置（Tool_RAG）
+    kb_documents_dir: str = "kb/documents"           # 知识库文档根目录（相对项目根目录），每个子目录是一个知识库
+    kb_default_collection: str = "tobacco"           # 未指定知识库名称时使用的知识库
+    kb_warmup_on_start: bool = False      # 服务启动时在后台预先加载默认知识库，第一个请求不必等待加载
+    kb_vectorstore_dir: str = "kb/vectorstore"       # 向量库根目录（相对项目根目录），每个知识库一个子目录
+    kb_max_loaded_collections: int = 4    # 同时保留在内存中的知识库数，超出时淘汰最久未使用的
+    kb_max_loaded_mb: int = 0             # 已加载知识库的总占用上限（按向量库目录大小估算，MB），0 表示不限
+    kb_embedding_model: str = "text-embedding-v1"    # DashScope 嵌入模型
+    kb_vector_backend: str = "chroma"     # 向量库后端：chroma / numpy（内存映射矩阵，见 utils.kb_vector_index）
+    kb_vector_dtype: str = "float16"      # numpy 后端的向量存储类型：float16 / int8
+    kb_ivf_min_rows: int = 50000          # numpy 后端分片数达到该值后构建 IVF 分区，之前为精确检索
+    kb_ivf_nprobe: int = 8                # IVF 检索时扫描的分区数
+    kb_chunk_size: int = 500              # 文档切分的分片长度（字符）
+    kb_chunk_overlap: int = 50            # 相邻分片的重叠长度（字符）
+    kb_load_workers: int = 0              # 并行解析文档的进程数，0 表示等于本进程可用的 CPU 核数
+    kb_embed_batch_size: int = 25         # 每次嵌入请求的文本数（DashScope 单次最多 25 条）
+    kb_embed_workers: int = 4             # 并发嵌入请求数
+    kb_embed_requests_per_sec: float = 10.0  # 嵌入请求速率上限（令牌桶），不大于 0 表示不限流
+    kb_embed_max_retries: int = 5         # 单个批次失败后的最大重试次数
+    kb_embed_retry_backoff: float = 1.0   # 重试的初始退避时间（秒），之后按指数增长
+    kb_hybrid_enabled: bool = True        # 是否在向量检索之外同时做 BM25 关键词检索并融合排名
+    kb_hybrid_fetch_k: int = 20           # 融合前向量检索和 BM25 各取的候选数
+    kb_rrf_k: int = 60                    # 倒数排名融合的平滑常数
+    kb_bm25_k1: float = 1.5
+    kb_bm25_b: float = 0.75
+    kb_mmr_enabled: bool = True           # 是否多取候选后用 MMR 重排，减少内容相近的分片
+    kb_mmr_fetch_k: int = 20              # MMR 重排前取的候选数
+    kb_mmr_lambda: float = 0.7            # MMR 中相关度的权重，1 表示不考虑多样性
+    kb_context_max_tokens: int = 2000     # 返回给智能体的检索上下文 token 预算（估算值）
+    kb_embedding_cache_enabled: bool = True
+    kb_embedding_cache_dir: str = "kb/embedding_cache"   # 嵌入向量缓存目录（相对项目根目录），按模型分子目录
+    kb_embedding_cache_dtype: str = "float16"            # 缓存向量的存储类型：float16 / float32
+    kb_retrieval_cache_enabled: bool = True
+    kb_retrieval_cache_ttl: float = 600.0     # 检索结果缓存的有效期（秒）
+    kb_retrieval_cache_max_entries: int = 512
+
     # LangSmith 配置（可选）
     langchain_tracing_v2: bool = False
     langchain_api_key: Optional[str] = None
@@ -1,5 +1,7 @@
 from langgraph.graph import StateGraph, END, START
 from state.state import AgentState
+from config import settings
+from tools.Tool_RAG import warmup_knowledge_base
 from graph.nodes import (
     Orchestrator_node, 
     Agent_Insighter_Reporter_node,
@@ -47,4 +49,7 @@ def create_workflow():
     app = workflow.compile()
     return app
 
-app = create_workflow()
\ No newline at end of file
+app = create_workflow()
+
+if settings.kb_warmup_on_start:
+    warmup_knowledge_base()
\ No newline at end of file
@@ -3,7 +3,16 @@ from pathlib import Path
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from tools.Tool_DBM import get_tables_from_db
+from utils.db_pool import EngineRegistry
+from utils.db_stream import stream_query, astream_query
+from utils.schema_catalog import build_catalog, format_table_compact
+from utils.result_format import encode_rows, estimate_tokens
+from utils.query_cache import QueryResultCache, is_cacheable, normalize_sql, referenced_tables
+from utils.sql_guard import GuardDecision, evaluate_plan, parse_plan, rewrite_query
+from utils.table_profile import TableProfiler, _pcsa_estimate
+from utils.sampling import SamplePlanner, apply_sample, sample_notes
 from config import settings
+import asyncio
 import pytest
 
 
@@ -79,5 +88,356 @@ def test_get_tables_from_db_nonexistent_database():
     assert "查询失败" in result
 
 
+def test_engine_registry_reuses_engine():
+    """测试同一连接目标复用同一个引擎，密码变化时重建"""
+    registry = EngineRegistry(max_engines=2)
+    engine = registry.get_engine("db_host", 3306, "user", "pwd", "db")
+
+    assert registry.get_engine("db_host", 3306, "user", "pwd", "db") is engine
+    assert registry.get_engine("db_host", 3306, "user", "new_pwd", "db") is not engine
+
+
+def test_engine_registry_lru_eviction():
+    """测试连接目标数量超过上限时淘汰最久未使用的引擎"""
+    registry = EngineRegistry(max_engines=2)
+    registry.get_engine("db_host", 3306, "user", "pwd", "db_a")
+    registry.get_engine("db_host", 3306, "user", "pwd", "db_b")
+    registry.get_engine("db_host", 3306, "user", "pwd", "db_a")
+    registry.get_engine("db_host", 3306, "user", "pwd", "db_c")
+
+    targets = registry.stats().keys()
+    assert "user@db_host:3306/db_a" in targets
+    assert "user@db_host:3306/db_b" not in targets
+    assert len(targets) == 2
+
+
+class _FakeCursor:
+    """模拟 pymysql 服务端游标（SSCursor），逐行产出元组；rows 为字典时按键生成列名"""
+    def __init__(self, rows, columns=None):
+        self._columns = columns or (list(rows[0]) if rows else None)
+        self._rows = [tuple(row.values()) if isinstance(row, dict) else row for row in rows]
+        self.description = None
+        self.rowcount = 0
+
+    def execute(self, query):
+        self.description = [(name,) for name in self._columns] if self._columns else None
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class _FakeConnection:
+    def __init__(self, rows, columns=None):
+        self._rows = rows
+        self._columns = columns
+
+    def cursor(self, cursorclass=None):
+        return _FakeCursor(self._rows, self._columns)
+
+    def close(self):
+        pass
+
+
+def test_stream_query_row_budget():
+    """测试流式查询按行数预算截断，并统计总行数"""
+    rows = [{"id": i, "name": f"name_{i}"} for i in range(1000)]
+    result = stream_query(_FakeConnection(rows), "SELECT * FROM t", max_rows=10, max_bytes=1024 * 1024)
+
+    assert len(result.rows) == 10
+    assert result.total_rows == 1000
+    assert result.truncated
+
+
+def test_stream_query_spill_to_csv(tmp_path, monkeypatch):
+    """测试完整结果落盘为 CSV 文件"""
+    monkeypatch.setattr(settings, "db_spill_dir", str(tmp_path))
+    rows = [{"id": i, "name": f"name_{i}"} for i in range(50)]
+    result = stream_query(_FakeConnection(rows), "SELECT * FROM t", max_rows=5, max_bytes=100, spill_format="csv")
+
+    assert len(result.rows) <= 5
+    with open(result.spill_path, encoding="utf-8-sig") as f:
+        assert len(f.read().splitlines()) == 51
+
+
+def test_stream_query_join_with_repeated_column_names(tmp_path, monkeypatch):
+    """测试 JOIN 两张表的同名列各自保留自己的值，落盘 CSV 和编码结果都不串列"""
+    monkeypatch.setattr(settings, "db_spill_dir", str(tmp_path))
+    rows = [(1, 10, "a"), (2, 20, "b")]
+    result = stream_query(_FakeConnection(rows, ["id", "id", "name"]),
+                          "SELECT o.id, u.id, u.name FROM orders o JOIN users u ON o.user_id = u.id",
+                          max_rows=1, max_bytes=1024, spill_format="csv")
+
+    assert result.columns == ["id", "id_1", "name"]
+    assert result.rows == [{"id": 1, "id_1": 10, "name": "a"}]
+    with open(result.spill_path, encoding="utf-8-sig") as f:
+        assert f.read().splitlines() == ["id,id_1,name", "1,10,a", "2,20,b"]
+    assert encode_rows(result.columns, result.rows, "csv") == "id,id_1,name\n1,10,a"
+
+
+class _FakeAsyncCursor(_FakeCursor):
+    """模拟 aiomysql 服务端游标"""
+    async def execute(self, query):
+        super().execute(query)
+        self._iter = iter(self._rows)
+
+    async def fetchmany(self, size):
+        return [row for _, row in zip(range(size), self._iter)]
+
+    async def close(self):
+        pass
+
+
+class _FakeAsyncConnection(_FakeConnection):
+    async def cursor(self, cursorclass=None):
+        return _FakeAsyncCursor(self._rows, self._columns)
+
+
+def test_astream_query_row_budget():
+    """测试异步流式查询与同步版本的截断行为一致"""
+    rows = [{"id": i} for i in range(2500)]
+    result = asyncio.run(astream_query(_FakeAsyncConnection(rows), "SELECT id FROM t", max_rows=20, max_bytes=1024))
+
+    assert len(result.rows) == 20
+    assert result.total_rows == 2500
+    assert result.truncated
+
+
+def test_build_catalog_from_information_schema_rows():
+    """测试根据 information_schema 批量查询结果构建表结构目录"""
+    rows = {
+        "tables": [{"TABLE_NAME": "orders", "TABLE_TYPE": "BASE TABLE", "TABLE_ROWS": 100, "TABLE_COMMENT": ""}],
+        "columns": [
+            {"TABLE_NAME": "orders", "COLUMN_NAME": "id", "COLUMN_TYPE": "int", "DATA_TYPE": "int",
+             "IS_NULLABLE": "NO", "COLUMN_DEFAULT": None, "COLUMN_KEY": "PRI", "EXTRA": "", "COLUMN_COMMENT": ""},
+            {"TABLE_NAME": "orders", "COLUMN_NAME": "user_id", "COLUMN_TYPE": "int", "DATA_TYPE": "int",
+             "IS_NULLABLE": "YES", "COLUMN_DEFAULT": None, "COLUMN_KEY": "MUL", "EXTRA": "", "COLUMN_COMMENT": ""},
+        ],
+        "indexes": [
+            {"TABLE_NAME": "orders", "INDEX_NAME": "PRIMARY", "NON_UNIQUE": 0, "COLUMN_NAME": "id"},
+            {"TABLE_NAME": "orders", "INDEX_NAME": "idx_user", "NON_UNIQUE": 1, "COLUMN_NAME": "user_id"},
+        ],
+        "foreign_keys": [
+            {"TABLE_NAME": "orders", "COLUMN_NAME": "user_id", "REFERENCED_TABLE_NAME": "users",
+             "REFERENCED_COLUMN_NAME": "id"},
+        ],
+    }
+    catalog = build_catalog("shop", ("1:1", "2:2"), rows)
+    table = catalog.get_table("ORDERS")
+
+    assert catalog.table_names() == ["orders"]
+    assert table.primary_key == ["id"]
+    assert table.indexes["idx_user"] == (False, ["user_id"])
+    assert "外键: user_id->users.id" in format_table_compact(table)
+
+
+def test_encode_rows_formats():
+    """测试查询结果的紧凑编码：表头只出现一次，数值按精度格式化，长文本被截断"""
+    columns = ["id", "price", "remark"]
+    rows = [{"id": i, "price": 1 / 3, "remark": "x" * 200} for i in range(3)]
+
+    csv_text = encode_rows(columns, rows, "csv", float_digits=2, max_cell_width=10)
+    assert csv_text.splitlines()[0] == "id,price,remark"
+    assert csv_text.count("price") == 1
+    assert "0.33," in csv_text
+    assert "x" * 10 not in csv_text
+
+    json_text = encode_rows(columns, rows, "json")
+    assert '"id":[0,1,2]' in json_text
+
+    markdown_text = encode_rows(columns, rows, "markdown")
+    assert markdown_text.startswith("| id | price | remark |")
+
+    # 与列名同序的元组行；重复列名无法按名取值，直接报错而不是输出错误的值
+    assert encode_rows(["id", "id_1"], [(1, 10)], "csv") == "id,id_1\n1,10"
+    with pytest.raises(ValueError, match="列名重复: id"):
+        encode_rows(["id", "id"], [(1, 10)], "csv")
+
+
+def test_encode_rows_smaller_than_repr():
+    """测试 CSV 编码的 token 数明显小于逐行重复列名的 repr"""
+    rows = [{"customer_name": f"客户{i}", "total_amount": i * 1.5, "order_count": i} for i in range(50)]
+    csv_text = encode_rows(list(rows[0]), rows, "csv")
+
+    assert estimate_tokens(csv_text) * 2 < estimate_tokens(repr(rows))
+
+
+def test_normalize_sql_and_cacheable():
+    """测试 SQL 规范化以及只读查询判定"""
+    assert normalize_sql("SELECT  *\n FROM Orders -- 注释\n WHERE name = 'Tom';") == \
+        "select * from orders where name = 'Tom'"
+    assert is_cacheable("SELECT COUNT(*) FROM orders WHERE remark = 'now()'")
+    assert not is_cacheable("SELECT NOW()")
+    assert not is_cacheable("UPDATE orders SET amount = 0")
+    assert not is_cacheable("SELECT 1; DROP TABLE orders")
+    # 元数据查询没有数据版本，不缓存
+    assert not is_cacheable("SHOW TABLES")
+    assert not is_cacheable("DESCRIBE orders")
+    assert not is_cacheable("SELECT * FROM information_schema.TABLES")
+
+
+def test_referenced_tables():
+    """测试提取查询依赖的表"""
+    query = "SELECT * FROM orders o JOIN shop.users u ON o.user_id = u.id, items WHERE o.id > 1"
+    tables = referenced_tables(query, "db", known_tables=["orders", "items"])
+
+    assert ("db", "orders") in tables
+    assert ("shop", "users") in tables
+    assert ("db", "items") in tables
+
+
+def test_query_result_cache_lru_and_disk(tmp_path):
+    """测试查询结果缓存的 LRU 淘汰与磁盘缓存"""
+    cache = QueryResultCache(ttl=60, max_entries=2, disk_path=str(tmp_path / "cache.sqlite3"))
+    cache.put("a", [1])
+    cache.put("b", [2])
+    cache.put("c", [3])
+
+    assert cache.get("c") == [3]
+    # "a" 已被内存 LRU 淘汰，但仍可从磁盘缓存读取
+    assert cache.get("a") == [1]
+    assert cache.get("missing") is None
+    stats = cache.stats()
+    assert stats["memory_hits"] == 1 and stats["disk_hits"] == 1 and stats["misses"] == 1
+
+
+def test_run_db_query_write_invalidates_schema_catalog(monkeypatch):
+    """测试执行 DDL / DML 后清除该服务器的表结构目录缓存，只读查询不影响缓存"""
+    import tools.Tool_DBM as Tool_DBM
+    from utils.schema_catalog import schema_cache
+
+    empty = {"tables": [], "columns": [], "indexes": [], "foreign_keys": []}
+    monkeypatch.setattr(schema_cache, "_entries", {})
+    schema_cache._store(("db_host", 3306, "user", "shop", "digest"), "shop", ("1", "1"), empty)
+    schema_cache._store(("other_host", 3306, "user", "shop", "digest"), "shop", ("1", "1"), empty)
+    monkeypatch.setattr(Tool_DBM, "get_catalog", lambda *args: build_catalog("shop", ("1", "1"), empty))
+    args = {"host": "db_host", "port": 3306, "user": "user", "password": "pwd", "database": "shop"}
+
+    monkeypatch.setattr(Tool_DBM, "get_raw_connection", lambda *a: _FakeConnection([{"id": 1}]))
+    Tool_DBM.run_db_query.invoke({**args, "query": "SELECT id FROM orders", "use_cache": False})
+    assert len(schema_cache._entries) == 2
+
+    monkeypatch.setattr(Tool_DBM, "get_raw_connection", lambda *a: _FakeConnection([]))
+    result = Tool_DBM.run_db_query.invoke({**args, "query": "ALTER TABLE orders ADD COLUMN note TEXT"})
+    assert result.startswith("查询成功")
+    assert list(schema_cache._entries) == [("other_host", 3306, "user", "shop", "digest")]
+
+
+def test_sql_guard_rewrites_large_scan():
+    """测试预计扫描行数超过阈值的查询会被注入执行超时提示和 LIMIT"""
+    plan = parse_plan([{"id": 1, "table": "orders", "type": "ALL", "rows": 5_000_000,
+                        "filtered": 10.0, "Extra": "Using where"}])
+    decision = evaluate_plan("SELECT * FROM orders WHERE amount > 100", plan)
+
+    assert decision.allowed
+    assert "MAX_EXECUTION_TIME" in decision.query
+    assert decision.query.endswith(f"LIMIT {settings.db_guard_default_limit}")
+
+
+def test_sql_guard_rewrite_keeps_trailing_clauses_and_cte_hint():
+    """测试 LIMIT 插在锁定读 / 导出子句之前，执行超时提示加在 CTE 之后的主查询 SELECT 上"""
+    limit = f"LIMIT {settings.db_guard_default_limit}"
+    rewritten = rewrite_query("SELECT * FROM t WHERE note = 'for update' FOR UPDATE;", GuardDecision())
+    assert rewritten.endswith(f"'for update'\n{limit}\nFOR UPDATE")
+    rewritten = rewrite_query("SELECT a FROM t INTO OUTFILE '/tmp/a.csv'", GuardDecision())
+    assert rewritten.endswith(f"FROM t\n{limit}\nINTO OUTFILE '/tmp/a.csv'")
+    assert rewrite_query("SELECT a INTO @v FROM t", GuardDecision()).endswith(f"FROM t\n{limit}")
+    assert rewrite_query("SELECT * FROM t LIMIT 5 LOCK IN SHARE MODE", GuardDecision()).endswith("LIMIT 5 LOCK IN SHARE MODE")
+
+    rewritten = rewrite_query("WITH c AS (SELECT * FROM t) SELECT * FROM c", GuardDecision())
+    assert rewritten.startswith("WITH c AS (SELECT * FROM t) SELECT /*+ MAX_EXECUTION_TIME(")
+
+
+def test_sql_guard_rejects_cartesian_join():
+    """测试疑似笛卡尔积的连接会被拒绝，并返回可操作的提示"""
+    plan = parse_plan([
+        {"id": 1, "table": "orders", "type": "ALL", "rows": 200_000, "filtered": 100.0, "Extra": ""},
+        {"id": 1, "table": "users", "type": "ALL", "rows": 50_000, "filtered": 100.0,
+         "Extra": "Using join buffer (hash join)"},
+    ])
+    decision = evaluate_plan("SELECT * FROM orders, users", plan)
+
+    assert not decision.allowed
+    assert "users" in decision.cartesian_joins
+    assert "JOIN ... ON" in decision.message
+
+
+def test_table_profiler_single_pass_stats():
+    """测试表概况在一条聚合 SQL 中统计所有列，并据此生成直方图和高频值查询"""
+    catalog = build_catalog("shop", ("1", "1"), {
+        "tables": [{"TABLE_NAME": "orders", "TABLE_TYPE": "BASE TABLE", "TABLE_ROWS": 100, "TABLE_COMMENT": ""}],
+        "columns": [
+            {"TABLE_NAME": "orders", "COLUMN_NAME": "amount", "COLUMN_TYPE": "decimal(10,2)", "DATA_TYPE": "decimal",
+             "IS_NULLABLE": "YES", "COLUMN_DEFAULT": None, "COLUMN_KEY": "", "EXTRA": "", "COLUMN_COMMENT": ""},
+            {"TABLE_NAME": "orders", "COLUMN_NAME": "status", "COLUMN_TYPE": "varchar(16)", "DATA_TYPE": "varchar",
+             "IS_NULLABLE": "YES", "COLUMN_DEFAULT": None, "COLUMN_KEY": "", "EXTRA": "", "COLUMN_COMMENT": ""},
+        ],
+        "indexes": [], "foreign_keys": [],
+    })
+    profiler = TableProfiler(catalog.get_table("orders"), "`shop`.`orders`", buckets=4)
+    sql = profiler.stats_sql()
+    assert sql.count("FROM") == 1 and "STDDEV_POP(`amount`)" in sql and "COUNT(DISTINCT `status`)" in sql
+
+    profiler.apply_stats({"__rows": 100, "c0_nn": 90, "c0_min": 0, "c0_max": 100, "c0_avg": 50.0, "c0_std": 10.0,
+                          "c0_nd": 80, "c1_nn": 100, "c1_min": 4, "c1_max": 8, "c1_avg": 6.0, "c1_nd": 3})
+    amount, status = profiler.profile.columns
+    assert amount.nulls == 10 and amount.distinct == 80
+    assert "`c0_h3`" in profiler.histogram_sql()
+    assert "GROUP BY `status`" in profiler.top_values_sql()
+    assert _pcsa_estimate([0] * 16, 0) == 0
+
+
+def test_sampling_rewrites_query_and_reports_errors():
+    """测试采样查询以同名 CTE 替换原表，并在结果中附带样本比例和计数误差估计"""
+    catalog = build_catalog("shop", ("1", "1"), {
+        "tables": [{"TABLE_NAME": "orders", "TABLE_TYPE": "BASE TABLE", "TABLE_ROWS": 1_000_000, "TABLE_COMMENT": ""}],
+        "columns": [{"TABLE_NAME": "orders", "COLUMN_NAME": "id", "COLUMN_TYPE": "bigint", "DATA_TYPE": "bigint",
+                     "IS_NULLABLE": "NO", "COLUMN_DEFAULT": None, "COLUMN_KEY": "PRI", "EXTRA": "", "COLUMN_COMMENT": ""}],
+        "indexes": [{"TABLE_NAME": "orders", "INDEX_NAME": "PRIMARY", "NON_UNIQUE": 0, "COLUMN_NAME": "id"}],
+        "foreign_keys": [],
+    })
+    planner = SamplePlanner("shop", catalog.get_table("orders"), 0.01, "modulo")
+    sql = apply_sample("SELECT status, COUNT(*) AS cnt FROM orders GROUP BY status", planner.plan)
+    assert sql.startswith("WITH `orders` AS (SELECT * FROM `shop`.`orders` WHERE CRC32(`id`) % 10000 < 100)")
+    assert apply_sample("WITH t AS (SELECT 1) SELECT * FROM t, orders", planner.plan).startswith("WITH `orders` AS (")
+    # 带库名的引用不会被同名 CTE 替换，没有引用采样表时也不会用到样本，都应报错而不是声称结果基于样本
+    for query in ["SELECT COUNT(*) FROM shop.orders", "SELECT COUNT(*) FROM `shop`.`orders`", "SELECT 'orders' FROM users"]:
+        with pytest.raises(ValueError):
+            apply_sample(query, planner.plan)
+    # 比例精确到万分之一，计划中的比例与实际取样条件一致
+    tiny = SamplePlanner("shop", catalog.get_table("orders"), 0.00004, "modulo").plan
+    assert tiny.fraction == 0.0001 and tiny.condition.endswith("< 1") and "0.0001" in tiny.notes[0]
+
+    planner = SamplePlanner("shop", catalog.get_table("orders"), 0.01, "range")
+    planner.apply_bounds({"low": 1, "high": 1_000_000})
+    assert planner.plan.condition.count("BETWEEN") == settings.db_sample_range_stripes
+    assert abs(planner.plan.fraction - 0.01) < 1e-9
+
+    notes = sample_notes(planner.plan, ["status", "cnt"], [{"status": "paid", "cnt": 400}])
+    assert "cnt=400 → 40000 ± 3900" in "\n".join(notes)
+
+
+def test_match_tables_by_name_and_glob():
+    """测试批量描述时按表名和通配符匹配表，并报告未匹配的模式"""
+    catalog = build_catalog("shop", ("1", "1"), {
+        "tables": [{"TABLE_NAME": name, "TABLE_TYPE": "BASE TABLE", "TABLE_ROWS": 1, "TABLE_COMMENT": ""}
+                   for name in ["orders", "dim_user", "dim_item", "__sample_orders_100"]],
+        "columns": [], "indexes": [], "foreign_keys": [],
+    })
+    tables, unmatched = catalog.match_tables(["DIM_*", "orders", "dim_user", "missing_*"])
+
+    assert [t.name for t in tables] == ["dim_user", "dim_item", "orders"]
+    assert unmatched == ["missing_*"]
+    assert catalog.match_tables(["*sample*"])[0] == []
+
+
 if __name__ == "__main__":
     pytest.main([__file__, "-v"])
\ No newline at end of file
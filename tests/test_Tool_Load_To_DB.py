@@ -0,0 +1,318 @@
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from utils.ingest_reader import iter_excel_chunks, list_sources, normalize_headers
+from utils.ingest_schema import TableSchema
+from utils.ingest_fingerprint import normalize_key, row_hashes, split_delta
+from utils import bulk_load
+from utils.bulk_load import BulkLoader, chunk_records
+from utils.ingest_jobs import IngestJobManager
+from sqlalchemy.engine import make_url
+import datetime
+import time
+import pandas as pd
+import pytest
+
+
+def _write_workbook(path, rows):
+    from openpyxl import Workbook
+    workbook = Workbook()
+    sheet = workbook.active
+    for row in rows:
+        sheet.append(row)
+    workbook.save(path)
+
+
+def test_iter_excel_chunks_streams_typed_chunks(tmp_path):
+    """测试 Excel 按固定行数流式分块读取，并推断出数值列类型"""
+    path = tmp_path / "data.xlsx"
+    _write_workbook(path, [["id", "name", None, "id"]] + [[i, f"user{i}", None, i * 2] for i in range(25)])
+
+    chunks = list(iter_excel_chunks(str(path), chunk_rows=10))
+
+    assert [len(chunk) for chunk in chunks] == [10, 10, 5]
+    assert list(chunks[0].columns) == ["id", "name", "column_3", "id_1"]
+    assert str(chunks[0]["id"].dtype) == "int64"
+    assert chunks[-1]["name"].iloc[-1] == "user24"
+
+
+def test_normalize_headers():
+    """测试空表头和重复表头会被重命名"""
+    assert normalize_headers(["a", None, "a", " "]) == ["a", "column_2", "a_1", "column_4"]
+    assert normalize_headers(["a", "a", "a_1"]) == ["a", "a_1", "a_1_1"]
+    assert normalize_headers(["Qty", "qty", "a_1", "a", "a"]) == ["Qty", "qty_1", "a_1", "a", "a_2"]
+
+
+class _FakeCursor:
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql, args=None):
+        if self.connection.error is not None:
+            raise self.connection.error
+        self.connection.statements.append(sql)
+
+    def fetchall(self):
+        if self.connection.statements and self.connection.statements[-1] == "SHOW WARNINGS":
+            return self.connection.warnings
+        return self.connection.rows
+
+    def executemany(self, sql, records):
+        self.connection.batches.append(list(records))
+
+
+class _FakeConnection:
+    def __init__(self, error=None):
+        self.error = error
+        self.statements, self.batches, self.rows, self.warnings = [], [], [], []
+        self.commits = self.rollbacks = 0
+
+    def cursor(self):
+        return _FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        pass
+
+
+class _FakeEngine:
+    def __init__(self, connection):
+        self.url = make_url("mysql+pymysql://u:p@fake-host:3306/db")
+        self.connection = connection
+
+    def raw_connection(self):
+        return self.connection
+
+
+def test_chunk_records_converts_missing_values():
+    """测试 NaN / NaT 转换为 None，numpy 类型转换为 Python 原生类型"""
+    chunk = pd.DataFrame({"a": [1.5, None], "b": pd.to_datetime(["2024-01-01", None]), "c": [True, False]})
+    records = chunk_records(chunk)
+    assert records[1][0] is None and records[1][1] is None
+    assert records[0][2] == 1 and type(records[0][2]) is int
+
+
+def test_bulk_loader_falls_back_when_local_infile_disabled(monkeypatch):
+    """测试 LOAD DATA LOCAL INFILE 被服务端拒绝时回退为 executemany 批量写入"""
+    import pymysql
+    pooled = _FakeConnection()
+    rejected = _FakeConnection(pymysql.err.OperationalError(3948, "Loading local data is disabled"))
+    monkeypatch.setattr(BulkLoader, "_local_infile_connection", lambda self: rejected)
+    chunk = pd.DataFrame({"id": range(5), "name": list("abcde")})
+
+    with BulkLoader(_FakeEngine(pooled), "t", ["id", "name"], strategy="auto", batch_rows=2) as loader:
+        loader.write(chunk)
+        loader.write(chunk)
+
+    assert loader.stats.strategy == "executemany" and loader.stats.rows == 10
+    assert [len(batch) for batch in pooled.batches] == [2, 2, 1, 2, 2, 1]
+    assert "回退" in loader.stats.summary()
+    # 之后对同一目标的导入不再尝试 LOCAL INFILE
+    assert BulkLoader(_FakeEngine(pooled), "t", ["id"], strategy="auto").stats.strategy == "executemany"
+
+
+def test_bulk_loader_load_data_fails_on_warnings(monkeypatch):
+    """测试 LOAD DATA 产生警告（值被截断或置空）时回滚该分块并报错"""
+    loaded = _FakeConnection()
+    loaded.warnings = [("Warning", 1366, "Incorrect integer value: 'x' for column 'id' at row 1")]
+    monkeypatch.setattr(BulkLoader, "_local_infile_connection", lambda self: loaded)
+    chunk = pd.DataFrame({"id": ["x"], "name": ["a"]})
+
+    with BulkLoader(_FakeEngine(_FakeConnection()), "t2", ["id", "name"], strategy="load_data") as loader:
+        with pytest.raises(ValueError, match="1 条警告.*Incorrect integer"):
+            loader.write(chunk)
+        loaded.warnings = []
+        loader.write(chunk)
+
+    assert (loaded.rollbacks, loaded.commits, loader.stats.rows) == (1, 1, 1)
+
+
+def test_bulk_loader_load_data_upsert_merges_through_stage_table(monkeypatch):
+    """测试 upsert 时 LOAD DATA 先导入临时暂存表，再用 ON DUPLICATE KEY UPDATE 合并，不使用 REPLACE"""
+    loaded = _FakeConnection()
+    monkeypatch.setattr(BulkLoader, "_local_infile_connection", lambda self: loaded)
+    chunk = pd.DataFrame({"id": [1, 2], "name": ["a", "b"]})
+
+    with BulkLoader(_FakeEngine(_FakeConnection()), "t3", ["id", "name"], strategy="load_data", upsert=True) as loader:
+        loader.write(chunk)
+
+    drop, create, load, warnings, merge = loaded.statements
+    assert drop == "DROP TEMPORARY TABLE IF EXISTS `__bulk_load_stage`"
+    assert create.startswith("CREATE TEMPORARY TABLE `__bulk_load_stage` SELECT `id`, `name` FROM `t3`")
+    assert "INTO TABLE `__bulk_load_stage`" in load and "REPLACE" not in load
+    assert merge == ("INSERT INTO `t3` (`id`, `name`) SELECT `id`, `name` FROM `__bulk_load_stage` "
+                     "ON DUPLICATE KEY UPDATE `id` = VALUES(`id`), `name` = VALUES(`name`)")
+    assert (loaded.commits, loader.stats.rows) == (1, 2)
+
+
+def test_load_chunks_load_data_upsert_rebuilds_stage_after_widening(monkeypatch):
+    """测试 load_data 增量导入中途放宽列类型后，后续分块按新的列类型重建暂存表，不会因旧类型截断而报警告"""
+    loaded = _FakeConnection()
+    monkeypatch.setattr(BulkLoader, "_local_infile_connection", lambda self: loaded)
+    monkeypatch.setattr(bulk_load, "create_table", lambda *args: True)
+    monkeypatch.setattr(bulk_load, "_execute_ddl", lambda engine, sqls: loaded.statements.extend(sqls))
+    chunks = [pd.DataFrame({"id": [1, 2], "name": ["a", "b"]}), pd.DataFrame({"id": [3], "name": ["z" * 300]})]
+
+    stats = bulk_load.load_chunks(_FakeEngine(_FakeConnection()), "t4", chunks, strategy="load_data",
+                                  key_columns=["id"])
+
+    assert stats.rows == 3 and stats.strategy == "load_data"
+    alter = loaded.statements.index("ALTER TABLE `t4` MODIFY `name` TEXT NULL")
+    stage = [sql for sql in loaded.statements[alter:] if "`__bulk_load_stage`" in sql]
+    assert stage[0] == "DROP TEMPORARY TABLE IF EXISTS `__bulk_load_stage`"
+    assert stage[1].startswith("CREATE TEMPORARY TABLE `__bulk_load_stage` SELECT")
+    assert (loaded.commits, loaded.rollbacks) == (2, 0)
+
+
+def test_ingest_job_manager_reports_progress_and_errors():
+    """测试后台导入任务提交后立即返回，并能查询进度和错误"""
+    manager = IngestJobManager(max_workers=2, history=10)
+
+    def _work(job):
+        for rows in (100, 200):
+            job.progress(rows)
+        return "done"
+
+    def _fail(job):
+        job.progress(50)
+        raise ValueError("bad row")
+
+    ok = manager.submit("ok", _work, total_rows=200)
+    failed = manager.submit("failed", _fail)
+    deadline = time.time() + 5
+    while time.time() < deadline and (ok.finished_at is None or failed.finished_at is None):
+        time.sleep(0.01)
+
+    assert manager.get(ok.job_id).status == "succeeded" and ok.rows == 200
+    assert "已完成" in ok.to_text() and "done" in ok.to_text()
+    assert failed.status == "failed" and "ValueError: bad row" in failed.to_text()
+    assert [job.job_id for job in manager.recent()] == [failed.job_id, ok.job_id]
+
+
+def test_ingest_job_status_tool_exported_with_ingest_tool(monkeypatch):
+    """测试导入工具和进度查询工具一起从 tools 包导出，进度查询工具能按任务 ID 返回状态"""
+    import tools
+    import tools.Tool_Load_To_DB as Tool_Load_To_DB
+
+    manager = IngestJobManager(max_workers=1, history=10)
+    monkeypatch.setattr(Tool_Load_To_DB, "ingest_jobs", manager)
+    job = manager.submit("demo", lambda job: "done")
+    status_tool = tools.IngestJobStatusTool()
+    deadline = time.time() + 5
+    while time.time() < deadline and job.finished_at is None:
+        time.sleep(0.01)
+
+    assert {"ExcelToDBTool", "IngestJobStatusTool"} <= set(tools.__all__)
+    assert "已完成" in status_tool.invoke({"job_id": job.job_id})
+    assert "没有找到导入任务" in status_tool.invoke({"job_id": "missing"})
+
+
+def test_list_sources_reads_csv_parquet_and_all_sheets(tmp_path):
+    """测试 CSV / Parquet 分块读取，以及 Excel 全部工作表作为独立数据源"""
+    frame = pd.DataFrame({"id": range(7), "城市": ["北京"] * 7})
+    frame.to_csv(tmp_path / "data.csv", index=False, encoding="gbk")
+    frame.to_parquet(tmp_path / "data.parquet", index=False)
+    from openpyxl import Workbook
+    workbook = Workbook()
+    workbook.active.title = "s1"
+    workbook.active.append(["a"])
+    workbook.create_sheet("s2").append(["b"])
+    workbook.save(tmp_path / "book.xlsx")
+
+    for name in ("data.csv", "data.parquet"):
+        (source,) = list_sources(str(tmp_path / name))
+        chunks = list(source.chunks(chunk_rows=3))
+        assert [len(chunk) for chunk in chunks] == [3, 3, 1]
+        assert chunks[0]["城市"].iloc[0] == "北京"
+    assert [s.sheet_name for s in list_sources(str(tmp_path / "book.xlsx"))] == ["s1"]
+    assert [s.label for s in list_sources(str(tmp_path / "book.xlsx"), all_sheets=True)] == ["book.xlsx[s1]", "book.xlsx[s2]"]
+
+
+def test_table_schema_inferred_once_and_widened():
+    """测试从样本推断显式表结构和索引，后续分块超出范围时放宽列类型"""
+    sample = pd.DataFrame({
+        "order_id": [1, 2, None], "amount": [1.5, 2.0, 3.25], "code": ["001", "002", "003"],
+        "dt": pd.to_datetime(["2024-01-01", "2024-01-02", None]), "note": ["a", "b", None],
+    })
+    schema = TableSchema.infer(sample)
+    sql = schema.create_sql("orders")
+
+    assert schema.describe() == "order_id BIGINT, amount DOUBLE, code VARCHAR(255), dt DATE, note VARCHAR(255)"
+    assert "KEY `idx_order_id` (`order_id`)" in sql and "KEY `idx_dt` (`dt`)" in sql
+
+    coerced = schema.coerce(pd.DataFrame({
+        "order_id": [3.5, "x"], "amount": ["4", None], "code": [5.0, None],
+        "dt": ["2024-02-01", "bad"], "note": ["z" * 300, None],
+    }), "orders")
+    assert coerced.alter_sqls == ["ALTER TABLE `orders` MODIFY `order_id` DOUBLE NULL",
+                                  "ALTER TABLE `orders` MODIFY `note` TEXT NULL"]
+    assert coerced.nulled == 2
+    assert coerced.chunk["code"].iloc[0] == "5"
+
+
+def test_table_schema_existing_table_types_and_rounding():
+    """测试写入已有的表时按表中列类型转换，整数列中的小数四舍五入并计数，不修改表结构"""
+    schema = TableSchema.infer(pd.DataFrame({"qty": [1, 2], "code": ["a", "b"], "flag": [1, 0], "note": ["x", "y"]}))
+    changed = schema.align({"qty": "INTEGER(11)", "code": "BIGINT", "flag": "TINYINT(1)", "note": "GEOMETRY"})
+
+    assert changed == ["code VARCHAR(255) -> BIGINT", "flag BIGINT -> TINYINT(1)"]
+    coerced = schema.coerce(pd.DataFrame({"qty": [1.5, 2.0, 2.4], "code": ["7", "8", "x"],
+                                          "flag": [1, 0, 1], "note": ["x", "y", "z"]}), "t", allow_alter=False)
+    assert coerced.alter_sqls == [] and (coerced.rounded, coerced.nulled) == (2, 1)
+    assert coerced.chunk["qty"].tolist() == [2, 2, 2] and coerced.chunk["code"].iloc[0] == 7
+
+
+def test_split_delta_by_row_hash():
+    """测试按主键和行哈希把分块中的行分为新增 / 更新 / 未变化，重复主键只保留最后一行"""
+    chunk = pd.DataFrame({"id": pd.array([1, 2, 3, 3], dtype="Int64"), "name": ["a", None, "c", "d"]})
+    hashes = row_hashes(chunk).tolist()
+    assert len(set(hashes)) == 4 and row_hashes(chunk.copy()).tolist() == hashes
+    keys = [(normalize_key(v, "int"),) for v in chunk["id"]]
+
+    positions, counts = split_delta(keys, hashes, {(1,): hashes[0], (2,): "0" * 16})
+
+    assert positions == [1, 3]
+    assert (counts.inserted, counts.updated, counts.skipped) == (1, 1, 2)
+    assert normalize_key(pd.Timestamp("2024-01-02"), "date") == normalize_key(datetime.date(2024, 1, 2), "date")
+
+
+def test_load_chunks_upsert_writes_only_delta(monkeypatch):
+    """测试按主键增量导入：与上次相同的分块整体跳过，其余分块只写入新增和变化的行"""
+    monkeypatch.setattr(bulk_load, "create_table", lambda *args: False)
+    monkeypatch.setattr(bulk_load, "prepare_upsert_table", lambda *args: [])
+    monkeypatch.setattr(bulk_load, "existing_column_types", lambda *args: {"id": "BIGINT", "name": "VARCHAR(255)"})
+    frame = pd.DataFrame({"id": range(6), "name": list("abcdef")})
+    chunks = [frame.iloc[:3], frame.iloc[3:]]
+
+    first = _FakeConnection()
+    stats = bulk_load.load_chunks(_FakeEngine(first), "t", chunks, strategy="executemany", key_columns=["id"])
+    assert (stats.delta.inserted, stats.rows) == (6, 6) and len(stats.chunk_hashes) == 2
+
+    # 第二个分块中 id=3 未变化、id=4 被修改、id=5 是新行
+    edited = frame.assign(name=list("abcdXf"))
+    edited.loc[5, "id"] = 9
+    unchanged_hash = first.batches[1][0][-1]
+    second = _FakeConnection()
+    second.rows = [(3, unchanged_hash), (4, first.batches[1][1][-1])]
+    stats = bulk_load.load_chunks(_FakeEngine(second), "t", [edited.iloc[:3], edited.iloc[3:]],
+                                  strategy="executemany", key_columns=["id"], known_chunks=stats.chunk_hashes)
+
+    assert (stats.delta.inserted, stats.delta.updated, stats.delta.skipped) == (1, 1, 4)
+    assert [row[:2] for row in second.batches[0]] == [(4, "X"), (9, "f")]
+    assert "ON DUPLICATE KEY UPDATE" in BulkLoader(_FakeEngine(second), "t", ["id"], "executemany", upsert=True)._insert_sql
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
@@ -0,0 +1,596 @@
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from utils.kb_manifest import FileEntry, KBManifest, chunk_id
+from utils.embedding_pipeline import EmbeddingPipeline, TokenBucket
+from utils.embedding_cache import CachedEmbeddings, EmbeddingCache
+from utils.kb_loader import iter_loaded, load_workers
+from utils.kb_bm25 import BM25Index, reciprocal_rank_fusion, tokenize
+from utils.retrieval_cache import RetrievalCache, retrieval_key
+from utils.kb_vector_index import NumpyVectorStore
+from utils.kb_context import assemble_context, merge_adjacent, mmr_select
+from utils.kb_registry import CollectionCache, list_collections
+from utils.result_format import estimate_tokens
+from langchain_core.documents import Document
+import numpy as np
+from langchain_core.embeddings import Embeddings
+import glob
+import os
+import threading
+import time
+import pytest
+
+
+def test_kb_manifest_diff_detects_added_modified_deleted(tmp_path):
+    """测试索引清单按大小 / 修改时间 / 内容哈希识别新增、修改、删除和未变化的文件"""
+    docs = tmp_path / "docs"
+    (docs / "sub").mkdir(parents=True)
+    (docs / "a.txt").write_text("alpha", encoding="utf-8")
+    (docs / "sub" / "b.md").write_text("beta", encoding="utf-8")
+    (docs / "c.txt").write_text("gamma", encoding="utf-8")
+    (docs / "ignored.csv").write_text("x", encoding="utf-8")
+    manifest = KBManifest(str(tmp_path / "store" / "manifest.json"))
+
+    first = manifest.diff(str(docs))
+    assert first.added == ["a.txt", "c.txt", "sub/b.md"] and not first.deleted
+    for rel in first.added:
+        entry = first.files[rel]
+        entry.chunk_ids = [chunk_id(rel, entry.sha256, 0)]
+        manifest.entries[rel] = entry
+    manifest.save()
+
+    (docs / "a.txt").write_text("alpha v2", encoding="utf-8")
+    os.remove(docs / "c.txt")
+    # 只改修改时间、内容不变的文件视为未变化
+    os.utime(docs / "sub" / "b.md", (1, 1))
+    second = KBManifest(manifest.path).diff(str(docs))
+
+    assert (second.added, second.modified, second.deleted, second.unchanged) == ([], ["a.txt"], ["c.txt"], ["sub/b.md"])
+    assert second.files["a.txt"].sha256 != manifest.entries["a.txt"].sha256
+    assert "修改 1 个" in second.summary() and second.changed
+    assert chunk_id("a.txt", "h1", 0) != chunk_id("a.txt", "h2", 0)
+
+
+def test_kb_manifest_round_trip(tmp_path):
+    """测试清单保存后可以重新加载"""
+    manifest = KBManifest(str(tmp_path / "manifest.json"))
+    manifest.entries["文档.txt"] = FileEntry(3, 1.5, "abc", ["id1", "id2"])
+    manifest.save()
+    assert KBManifest(manifest.path).entries == manifest.entries
+
+
+class _FakeEmbeddings(Embeddings):
+    """按文本长度生成向量，前 fail_times 次调用抛出异常"""
+
+    def __init__(self, fail_times=0, fail_text=None):
+        self.fail_times, self.fail_text = fail_times, fail_text
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        with self._lock:
+            self.calls.append(list(texts))
+            if self.fail_times > 0 or self.fail_text in texts:
+                self.fail_times -= 1
+                raise RuntimeError("transient")
+        return [[float(len(t)), 1.0] for t in texts]
+
+    def embed_query(self, text):
+        return [float(len(text)), 0.0]
+
+
+def test_embedding_pipeline_batches_retries_and_resumes(tmp_path):
+    """测试嵌入流水线按批并发、失败重试，以及中断后从检查点继续"""
+    texts = [f"text-{i:02d}" * (i % 3 + 1) for i in range(10)] + ["text-00"]
+    fake = _FakeEmbeddings(fail_times=1)
+    pipeline = EmbeddingPipeline(fake, batch_size=3, max_workers=2, requests_per_sec=0,
+                                 max_retries=2, retry_backoff=0.001)
+
+    vectors = pipeline.embed_documents(texts)
+
+    assert vectors == [[float(len(t)), 1.0] for t in texts]
+    assert pipeline.retries == 1 and max(len(batch) for batch in fake.calls) == 3
+    # 重复文本只嵌入一次
+    assert sum(len(batch) for batch in fake.calls) == 10 + 3
+
+    # 某个批次重试耗尽时抛出异常，已完成的批次保存在检查点中
+    checkpoint = str(tmp_path / "ckpt")
+    broken = _FakeEmbeddings(fail_text=texts[9])
+    with pytest.raises(RuntimeError):
+        EmbeddingPipeline(broken, batch_size=3, max_workers=1, requests_per_sec=0, max_retries=1,
+                          retry_backoff=0.001, checkpoint_dir=checkpoint).embed_documents(texts)
+    resumed = _FakeEmbeddings()
+    pipeline = EmbeddingPipeline(resumed, batch_size=3, requests_per_sec=0, checkpoint_dir=checkpoint)
+    assert pipeline.embed_documents(texts) == vectors
+    assert resumed.calls == [texts[9:10]]
+    pipeline.clear_checkpoint()
+    assert not os.listdir(checkpoint)
+
+
+def test_token_bucket_limits_rate():
+    """测试令牌桶在令牌耗尽后按速率放行"""
+    bucket = TokenBucket(rate=50, capacity=1)
+    started = time.monotonic()
+    for _ in range(6):
+        bucket.acquire()
+    assert time.monotonic() - started >= 0.09
+
+
+def test_cached_embeddings_persist_and_report_hit_rate(tmp_path):
+    """测试嵌入缓存按规范化文本命中、跨实例持久化，并区分文档和查询"""
+    fake = _FakeEmbeddings()
+    cached = CachedEmbeddings(fake, EmbeddingCache(str(tmp_path), "text-embedding-v1", dtype="float32"))
+
+    first = cached.embed_documents(["卷烟 营销", "零售户"])
+    assert cached.embed_documents(["卷烟\u3000营销 ", "新文本"])[0] == first[0]
+    assert cached.embed_query("零售户") == [3.0, 0.0]
+    assert cached.embed_query("零售户") == [3.0, 0.0]
+    assert fake.calls == [["卷烟 营销", "零售户"], ["新文本"]]
+    assert (cached.document_stats.hits, cached.document_stats.misses) == (1, 3)
+    assert (cached.query_stats.hits, cached.query_stats.misses) == (1, 1)
+    with cached.uncounted():
+        cached.embed_documents(["零售户"])
+    assert cached.document_stats.hits == 1
+
+    # 重新打开缓存（float16 存储）后全部命中，不再调用接口
+    reopened = CachedEmbeddings(_FakeEmbeddings(), EmbeddingCache(str(tmp_path), "text-embedding-v1"))
+    assert len(reopened.cache) == 4
+    assert reopened.embed_documents(["卷烟 营销", "新文本"]) == [first[0], [3.0, 1.0]]
+    assert reopened.embeddings.calls == [] and "100%" in reopened.summary()
+
+
+def test_embedding_cache_recovers_torn_index_and_rejects_dimension_change(tmp_path):
+    """测试索引最后一行写了一半时加载后丢弃该行并从此处续写，维度不一致的向量被拒绝"""
+    cache = EmbeddingCache(str(tmp_path), "m", dtype="float32")
+    cache.put_many(["a", "b"], [[1.0, 0.0], [0.0, 1.0]])
+    with pytest.raises(ValueError, match="维度"):
+        cache.put_many(["c"], [[1.0, 2.0, 3.0]])
+    # 模拟写索引时中断：向量已写入，索引只写了半行
+    with open(os.path.join(cache.directory, "vectors.bin"), "ab") as f:
+        f.write(np.array([[5.0, 5.0]], dtype=np.float32).tobytes())
+    with open(os.path.join(cache.directory, "index.txt"), "a", encoding="ascii") as f:
+        f.write("hal")
+
+    reopened = EmbeddingCache(str(tmp_path), "m")
+    assert len(reopened) == 2 and "hal" not in reopened.get_many(["hal"])
+    reopened.put_many(["d", "e"], [[2.0, 2.0], [3.0, 3.0]])
+
+    again = EmbeddingCache(str(tmp_path), "m")
+    found = again.get_many(["a", "b", "d", "e"])
+    assert [found[k].tolist() for k in "abde"] == [[1.0, 0.0], [0.0, 1.0], [2.0, 2.0], [3.0, 3.0]]
+
+
+def test_embedding_cache_shared_between_instances(tmp_path):
+    """测试两个进程（各自的缓存实例）共享同一目录：写入前读入对方追加的行，不会互相覆盖，读取能命中对方写入的向量"""
+    first = EmbeddingCache(str(tmp_path), "m", dtype="float32")
+    second = EmbeddingCache(str(tmp_path), "m", dtype="float32")
+    first.put_many(["a", "b"], [[1.0, 0.0], [0.0, 1.0]])
+    second.put_many(["c", "a"], [[2.0, 2.0], [9.0, 9.0]])
+    first.put_many(["d"], [[3.0, 3.0]])
+
+    assert second.get_many(["d"])["d"].tolist() == [3.0, 3.0]
+    found = first.get_many(["a", "b", "c", "d"])
+    assert [found[k].tolist() for k in "abcd"] == [[1.0, 0.0], [0.0, 1.0], [2.0, 2.0], [3.0, 3.0]]
+    reopened = EmbeddingCache(str(tmp_path), "m")
+    assert len(reopened) == 4 and reopened.get_many(["c"])["c"].tolist() == [2.0, 2.0]
+
+
+def test_iter_loaded_parses_in_parallel_and_isolates_errors(tmp_path, monkeypatch):
+    """测试文档在进程池中并行解析，单个文件失败不影响其他文件"""
+    from config import settings
+    monkeypatch.setattr(settings, "kb_load_workers", 2)
+    for i in range(3):
+        (tmp_path / f"doc{i}.md").write_text(f"内容 {i}", encoding="utf-8")
+    (tmp_path / "bad.txt").write_bytes(b"\xff\xfe\x00bad")
+
+    results = dict(iter_loaded(str(tmp_path), ["doc0.md", "doc1.md", "bad.txt", "doc2.md", "missing.txt"]))
+
+    assert [results[f"doc{i}.md"][0].page_content for i in range(3)] == ["内容 0", "内容 1", "内容 2"]
+    assert isinstance(results["bad.txt"], Exception) and isinstance(results["missing.txt"], Exception)
+
+    # 默认进程数按本进程可用的 CPU 核数计算，而不是整机核数
+    monkeypatch.setattr(settings, "kb_load_workers", 0)
+    monkeypatch.setattr(os, "sched_getaffinity", lambda pid: {0, 1}, raising=False)
+    assert load_workers(10) == 2 and load_workers(1) == 1
+
+
+def test_bm25_index_matches_codes_and_chinese_terms(tmp_path):
+    """测试 BM25 索引对产品编码和中文词的召回、增量删除，以及倒数排名融合"""
+    index = BM25Index()
+    index.add(["a", "b", "c"], [
+        "中华(硬) 条码 6901028075862，零售价 450 元",
+        "黄鹤楼 1916 的营销策略与零售终端建设",
+        "卷烟零售户的终端陈列规范",
+    ])
+    assert "6901028075862" in tokenize("条码6901028075862") and "abc-12" in tokenize("型号 ABC-12")
+
+    assert index.search("6901028075862", 3)[0][0] == "a"
+    assert [doc_id for doc_id, _ in index.search("零售终端", 3)][:2] in (["b", "c"], ["c", "b"])
+    index.remove(["a"])
+    assert index.search("6901028075862", 3) == [] and len(index) == 2
+
+    index.save(str(tmp_path / "bm25.json"))
+    assert BM25Index.load(str(tmp_path / "bm25.json")).doc_terms == index.doc_terms
+
+    fused = reciprocal_rank_fusion([["x", "y", "z"], ["z", "w"]], k=60)
+    assert [doc_id for doc_id, _ in fused][:1] == ["z"]
+
+
+def test_retrieval_cache_normalizes_queries_and_expires(monkeypatch):
+    """测试检索缓存按规范化查询命中、随知识库版本失效，以及 LRU 淘汰和过期"""
+    import utils.retrieval_cache as module
+    now = [0.0]
+    monkeypatch.setattr(module.time, "monotonic", lambda: now[0])
+    cache = RetrievalCache(ttl=10, max_entries=2)
+
+    key = retrieval_key("卷烟  零售价？", 3, "v1")
+    assert key == retrieval_key("卷烟 零售价?", 3, "v1") == retrieval_key("卷烟 零售价", 3, "v1")
+    assert key not in (retrieval_key("卷烟 零售价", 5, "v1"), retrieval_key("卷烟 零售价", 3, "v2"))
+    assert cache.get(key) is None
+    cache.put(key, "context")
+    assert cache.get(key) == "context"
+
+    cache.put("b", 1)
+    cache.get(key)
+    cache.put("c", 2)
+    assert cache.get("b") is None and cache.get(key) == "context"
+    now[0] = 11
+    assert cache.get(key) is None
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["evictions"], stats["expired"]) == (3, 3, 1, 1)
+    assert stats["hit_rate"] == 0.5
+    cache.clear()
+    assert cache.stats()["entries"] == 0
+
+
+def test_kb_manifest_version_tracks_indexed_content():
+    """测试清单版本只随已写入向量库的文件内容变化"""
+    manifest = KBManifest("unused.json")
+    empty = manifest.version
+    manifest.entries["a.txt"] = FileEntry(1, 1.0, "h1")
+    assert manifest.version == empty
+    manifest.entries["a.txt"].chunk_ids = ["id"]
+    indexed = manifest.version
+    manifest.entries["a.txt"].mtime = 2.0
+    assert manifest.version == indexed != empty
+    manifest.entries["a.txt"].sha256 = "h2"
+    assert manifest.version != indexed
+
+
+class _VectorEmbeddings(Embeddings):
+    """文本形如 "x,y,z" 时直接解析为向量"""
+
+    def embed_documents(self, texts):
+        return [[float(v) for v in t.split(",")] for t in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+@pytest.mark.parametrize("dtype", ["float16", "int8"])
+def test_numpy_vector_store_append_delete_and_share(tmp_path, dtype):
+    """测试内存映射向量库的追加、墓碑删除、跨实例共享以及压缩"""
+    store = NumpyVectorStore(str(tmp_path), _VectorEmbeddings(), dtype=dtype)
+    store.add_documents([Document(page_content="1,0,0", metadata={"source": "a"}),
+                         Document(page_content="0,1,0", metadata={"source": "b"})], ids=["a", "b"])
+    # 另一个实例（相当于另一个工作进程）打开同一目录，看到后续的追加和删除
+    reader = NumpyVectorStore(str(tmp_path), _VectorEmbeddings())
+    assert [d.metadata["source"] for d in reader.similarity_search("1,0.1,0", k=2)] == ["a", "b"]
+
+    store.add_documents([Document(page_content="0.9,0.1,0")], ids=["c"])
+    store.delete(ids=["a"])
+    results = reader.similarity_search_with_score("1,0,0", k=5)
+    assert [d.id for d, _ in results] == ["c", "b"] and results[0][1] == pytest.approx(0.9939, abs=0.01)
+    assert reader.get(ids=["b", "a"])["documents"] == ["0,1,0"]
+
+    # 同一 ID 再次写入视为更新
+    store.add_documents([Document(page_content="0,0,1")], ids=["b"])
+    assert len(reader) == 2 and reader.get()["ids"] == ["c", "b"]
+
+    assert store.optimize(compact_ratio=0.3, min_ivf_rows=10 ** 9)
+    assert len(store._records) == 2
+    assert [d.id for d in reader.similarity_search("0,0,1", k=1)] == ["b"]
+
+
+def test_numpy_vector_store_readers_wait_for_compaction_and_retry(tmp_path, monkeypatch):
+    """测试读取方在压缩期间等待跨进程文件锁；没有文件锁时读到不一致状态会重新加载并重试"""
+    from utils import kb_vector_index
+    store = NumpyVectorStore(str(tmp_path), _VectorEmbeddings())
+    store.add_texts(["1,0,0", "0,1,0", "0,0,1"], ids=["a", "b", "c"])
+    store.delete(ids=["a", "b"])
+    reader = NumpyVectorStore(str(tmp_path), _VectorEmbeddings())
+    assert len(reader) == 1
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(reader.similarity_search("0,0,1", k=3)))
+    with store._lock, store._file_lock():
+        thread.start()
+        time.sleep(0.2)
+        assert thread.is_alive()
+        store._compact()
+    thread.join(5)
+    assert [d.id for d in results[0]] == ["c"] and len(reader._records) == 1
+
+    # 压缩中途退出（文件已替换、标记还在）时，读取方取得排他锁完成压缩
+    open(tmp_path / ".compacting", "wb").close()
+    (tmp_path / "tombstones.txt").write_text("0\n", encoding="ascii")
+    assert [d.id for d in reader.similarity_search("0,0,1", k=3)] == ["c"]
+    assert not (tmp_path / ".compacting").exists() and not (tmp_path / "tombstones.txt").exists()
+
+    # 没有 fcntl 的平台上，看到压缩标记时等待其他进程完成替换后重试
+    monkeypatch.setattr(kb_vector_index, "fcntl", None)
+    store.add_texts(["0,1,1"], ids=["d"])
+    open(tmp_path / ".compacting", "wb").close()
+    timer = threading.Timer(0.08, os.remove, args=(str(tmp_path / ".compacting"),))
+    timer.start()
+    assert reader.get()["ids"] == ["c", "d"]
+    timer.join()
+
+
+def test_numpy_vector_store_ivf_matches_exact_search(tmp_path):
+    """测试 IVF 分区检索在探测全部分区时与精确检索一致，并覆盖分区之后追加的行"""
+    rng = np.random.default_rng(1)
+    vectors = rng.normal(size=(400, 8))
+    texts = [",".join(f"{v:.4f}" for v in row) for row in vectors]
+    store = NumpyVectorStore(str(tmp_path), _VectorEmbeddings())
+    store.add_texts(texts[:300], ids=[str(i) for i in range(300)])
+    query = texts[7]
+    exact = [d.id for d in store.similarity_search(query, k=5)]
+
+    assert store.optimize(min_ivf_rows=100) == ["重建 IVF 分区（17 个）"]
+    store.add_texts(texts[300:], ids=[str(i) for i in range(300, 400)])
+    from config import settings
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(settings, "kb_ivf_nprobe", 17)
+        ivf = [d.id for d in store.similarity_search(query, k=5)]
+    expected = NumpyVectorStore(str(tmp_path / "exact"), _VectorEmbeddings())
+    expected.add_texts(texts, ids=[str(i) for i in range(400)])
+    assert ivf == [d.id for d in expected.similarity_search(query, k=5)] and ivf[0] == exact[0] == "7"
+
+
+def test_mmr_select_skips_near_duplicates():
+    """测试 MMR 在相关度接近时跳过与已选结果几乎相同的候选"""
+    vectors = np.array([[1.0, 0.0], [0.99, 0.05], [0.0, 1.0], [0.7, 0.7]])
+    assert mmr_select(vectors, 2, lambda_mult=1.0) == [0, 1]
+    assert mmr_select(vectors, 2, lambda_mult=0.5) == [0, 2]
+    assert mmr_select(vectors, 10) == mmr_select(vectors, 4) and len(mmr_select(vectors, 10)) == 4
+
+
+def test_rerank_reads_stored_vectors_without_embedding(tmp_path):
+    """测试 MMR 重排的分片向量取自向量库或只读的嵌入缓存，检索路径上不调用嵌入接口"""
+    import tools.Tool_RAG as Tool_RAG
+    from utils.embedding_cache import cache_key
+
+    class _Offline(_VectorEmbeddings):
+        online = True
+
+        def embed_documents(self, texts):
+            assert self.online, "检索时不应调用嵌入接口"
+            return super().embed_documents(texts)
+
+    embedding = _Offline()
+    store = NumpyVectorStore(str(tmp_path / "store"), embedding)
+    texts = ["1,0,0", "0.99,0.05,0", "0,1,0"]
+    ids = ["a", "b", "c"]
+    store.add_texts(texts, [{"chunk_id": i} for i in ids], ids=ids)
+    embedding.online = False
+    docs = [Document(page_content=t, metadata={"chunk_id": i}) for t, i in zip(texts, ids)]
+    assert store.get(ids=["c", "a"], include=["embeddings"])["embeddings"].shape == (2, 3)
+    assert [d.metadata["chunk_id"] for d in Tool_RAG._rerank(store, docs, 2)] == ["a", "c"]
+
+    # 旧版分片没有 ID：只读查询嵌入缓存，缓存缺向量时不做 MMR，按原排名截断
+    legacy = [Document(page_content=t) for t in texts]
+    cache = EmbeddingCache(str(tmp_path / "cache"), "m", dtype="float32")
+    cached_store = NumpyVectorStore(str(tmp_path / "store"), CachedEmbeddings(embedding, cache))
+    assert Tool_RAG._rerank(cached_store, legacy, 2) == legacy[:2]
+    cache.put_many([cache_key("document", t) for t in texts], _VectorEmbeddings().embed_documents(texts))
+    assert [d.page_content for d in Tool_RAG._rerank(cached_store, legacy, 2)] == ["1,0,0", "0,1,0"]
+    assert cached_store.embeddings.document_stats.misses == 0
+
+
+def test_hybrid_search_ignores_chunks_outside_snapshot(tmp_path):
+    """测试刷新中途写入向量库、但不在快照 BM25 索引中的分片不会出现在旧快照的检索结果中"""
+    import tools.Tool_RAG as Tool_RAG
+    store = NumpyVectorStore(str(tmp_path), _VectorEmbeddings())
+    store.add_texts(["1,0,0", "0,1,0"], [{"chunk_id": "a"}, {"chunk_id": "b"}], ids=["a", "b"])
+    bm25 = BM25Index()
+    bm25.add(["a", "b"], ["1,0,0", "0,1,0"])
+    store.add_texts(["1,0.01,0"], [{"chunk_id": "new"}], ids=["new"])
+
+    assert [d.metadata["chunk_id"] for d in Tool_RAG._hybrid_search(store, bm25, "1,0,0", 2)] == ["a", "b"]
+
+
+def test_merge_adjacent_chunks_and_token_budget():
+    """测试同一来源的相邻 / 重叠分片合并去重，以及上下文按 token 预算截断"""
+    text = "第一句介绍零售终端。" * 3 + "第二段讲陈列规范。" * 3 + "第三段讲价格标签。" * 3
+    chunks = [text[0:40], text[30:70], text[60:]]
+    docs = [
+        Document(page_content=chunks[1], metadata={"source": "a.pdf", "chunk_index": 1, "chunk_id": "x1"}),
+        Document(page_content="另一个文件的内容", metadata={"source": "b.pdf", "chunk_index": 0}),
+        Document(page_content=chunks[0], metadata={"source": "a.pdf", "chunk_index": 0}),
+        Document(page_content=chunks[2], metadata={"source": "a.pdf", "chunk_index": 2}),
+        # 没有序号的旧分片按文本重叠合并
+        Document(page_content="旧版分片甲的结尾部分XYZ0123456789", metadata={"source": "c.md"}),
+        Document(page_content="XYZ0123456789接着是旧版分片乙", metadata={"source": "c.md"}),
+    ]
+    merged = merge_adjacent(docs)
+    assert [d.page_content for d in merged] == [text, "另一个文件的内容", "旧版分片甲的结尾部分XYZ0123456789接着是旧版分片乙"]
+    assert merged[0].metadata == {"source": "a.pdf"}
+
+    context = assemble_context(merged, max_tokens=10 ** 6)
+    assert context.count("来源:") == 3 and context.startswith("文档 1:\n" + text)
+    trimmed = assemble_context(merged, max_tokens=60)
+    assert estimate_tokens(trimmed) <= 60 and trimmed.count("来源:") == 1
+    assert trimmed.split("\n")[1].endswith("。……")
+
+
+def test_knowledge_base_loads_once_under_concurrent_first_requests(monkeypatch):
+    """测试并发的首次请求只加载一次知识库，并且都拿到同一个快照"""
+    import tools.Tool_RAG as Tool_RAG
+    loads = []
+
+    def slow_load(name):
+        loads.append(name)
+        time.sleep(0.05)
+        return Tool_RAG._KBIndex(Tool_RAG._collection_paths(name), object(), BM25Index(), "v1"), 1
+
+    monkeypatch.setattr(Tool_RAG, "_collections", CollectionCache(max_loaded=2))
+    monkeypatch.setattr(Tool_RAG, "_load_collection", slow_load)
+    monkeypatch.setattr(Tool_RAG, "_check_collection", lambda name: None)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(Tool_RAG._get_index("tobacco"))) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert loads == ["tobacco"] and len({id(index) for index in results}) == 1
+
+    Tool_RAG.warmup_knowledge_base("retail", background=False)
+    assert loads == ["tobacco", "retail"] and Tool_RAG._collections.loaded() == ["tobacco", "retail"]
+
+
+def test_collection_cache_evicts_least_recently_used(tmp_path):
+    """测试知识库按名称发现，已加载的知识库按数量和占用上限淘汰最久未使用的"""
+    for name in ("tobacco", "retail", "bad name"):
+        (tmp_path / name).mkdir()
+    (tmp_path / "file.txt").write_text("x", encoding="utf-8")
+    assert list_collections(str(tmp_path)) == ["retail", "tobacco"]
+
+    evicted = []
+    cache = CollectionCache(max_loaded=2, max_bytes=100, on_evict=lambda name, value: evicted.append((name, value)))
+    cache.get_or_load("a", lambda: ("A", 10))
+    cache.get_or_load("b", lambda: ("B", 10))
+    assert cache.get("a") == "A"
+    cache.get_or_load("c", lambda: ("C", 10))
+    assert cache.loaded() == ["a", "c"]
+    # 超过占用上限时也会淘汰，但至少保留刚加载的一个
+    cache.put("d", "D", 95)
+    assert cache.loaded() == ["d"]
+    cache.put("e", "E", 500)
+    assert cache.loaded() == ["e"]
+    assert cache.get_or_load("empty", lambda: None) is None and "empty" not in cache.loaded()
+    stats = cache.stats()
+    assert (stats["loads"], stats["evictions"], stats["loaded_bytes"]) == (3, 4, 500)
+    assert evicted == [("b", "B"), ("a", "A"), ("c", "C"), ("d", "D")]
+
+
+def test_evicted_chroma_client_is_released_after_last_user(tmp_path, monkeypatch):
+    """测试淘汰知识库时等仍在使用该快照的检索结束后才释放 chromadb 按路径缓存的客户端，以及根目录下的旧向量库迁移到默认知识库"""
+    import tools.Tool_RAG as Tool_RAG
+
+    class _System:
+        stopped = False
+
+        def stop(self):
+            self.stopped = True
+
+    class _Client:
+        _identifier_to_system = {}
+
+        def __init__(self, path):
+            self._identifier = path
+            self._identifier_to_system.setdefault(path, _System())
+
+    class _Store:
+        def __init__(self, path):
+            self._client = _Client(path)
+            Tool_RAG._track_vectorstore(self)
+
+    stores = {name: _Store(name) for name in ("a", "b")}
+    systems = dict(_Client._identifier_to_system)
+    monkeypatch.setattr(Tool_RAG, "_collections", CollectionCache(
+        max_loaded=1, on_evict=lambda name, index: Tool_RAG._release_vectorstore(index.vectorstore)))
+    Tool_RAG._collections.put("a", Tool_RAG._KBIndex(Tool_RAG._collection_paths("a"), stores["a"], BM25Index(), "v"), 1)
+    # 检索正在使用 a 时 a 被淘汰：客户端保留到检索结束
+    assert Tool_RAG._retain_vectorstore(stores["a"])
+    Tool_RAG._collections.put("b", Tool_RAG._KBIndex(Tool_RAG._collection_paths("b"), stores["b"], BM25Index(), "v"), 1)
+    assert not systems["a"].stopped
+    # 同一路径上为刷新临时打开的对象共用 System，释放它也不会停止 System
+    refreshing = _Store("a")
+    Tool_RAG._release_vectorstore(refreshing)
+    assert not systems["a"].stopped
+    Tool_RAG._release_vectorstore(stores["a"])
+    assert systems["a"].stopped and not systems["b"].stopped and list(_Client._identifier_to_system) == ["b"]
+    # 已释放的快照不能再登记使用者，检索会重新加载
+    assert not Tool_RAG._retain_vectorstore(stores["a"])
+    Tool_RAG._release_vectorstore(object())
+
+    monkeypatch.setattr(Tool_RAG, "VECTORSTORE_ROOT", str(tmp_path))
+    (tmp_path / "chroma.sqlite3").write_bytes(b"db")
+    (tmp_path / "0b6e3a4c-1d2e-4f50-8a9b-0c1d2e3f4a5b").mkdir()
+    (tmp_path / "retail").mkdir()
+    Tool_RAG._migrate_root_store("retail")
+    assert (tmp_path / "chroma.sqlite3").exists()
+    Tool_RAG._migrate_root_store(Tool_RAG.settings.kb_default_collection)
+    default = tmp_path / Tool_RAG.settings.kb_default_collection
+    assert sorted(os.listdir(tmp_path)) == sorted(["retail", default.name])
+    assert sorted(os.listdir(default)) == ["0b6e3a4c-1d2e-4f50-8a9b-0c1d2e3f4a5b", "chroma.sqlite3"]
+
+
+def test_refresh_and_hybrid_retrieval_end_to_end(tmp_path, monkeypatch):
+    """测试在 NumPy 向量库上完整地重建旧库、增量刷新（原地删除旧分片）和混合检索"""
+    import tools.Tool_RAG as Tool_RAG
+    from config import settings
+    docs = tmp_path / "documents" / "kb1"
+    docs.mkdir(parents=True)
+    monkeypatch.setattr(Tool_RAG, "KB_ROOT", str(tmp_path / "documents"))
+    monkeypatch.setattr(Tool_RAG, "VECTORSTORE_ROOT", str(tmp_path / "vectorstore"))
+    monkeypatch.setattr(Tool_RAG, "_collections", CollectionCache())
+    monkeypatch.setattr(Tool_RAG, "_create_embeddings",
+                        lambda paths: EmbeddingPipeline(_FakeEmbeddings(), checkpoint_dir=paths.checkpoint,
+                                                        requests_per_sec=0))
+    for name, value in (("kb_vector_backend", "numpy"), ("kb_embedding_cache_enabled", False),
+                        ("kb_retrieval_cache_enabled", False), ("kb_mmr_enabled", False),
+                        ("kb_load_workers", 1), ("kb_hybrid_fetch_k", 2)):
+        monkeypatch.setattr(settings, name, value)
+    (docs / "a.txt").write_text("零售终端陈列规范要求烟柜整洁、价签齐全。" * 3, encoding="utf-8")
+    (docs / "b.txt").write_text("客户经理每周拜访零售户并记录订货情况。" * 3, encoding="utf-8")
+    (docs / "c.txt").write_text("条码 6901028075862", encoding="utf-8")
+    # 没有索引清单的旧版向量库
+    paths = Tool_RAG._collection_paths("kb1")
+    os.makedirs(paths.vectorstore)
+    open(os.path.join(paths.vectorstore, "chroma.sqlite3"), "wb").close()
+
+    report = Tool_RAG.refresh_knowledge_base.invoke({"knowledge_base": "kb1"})
+    assert "新增 3 个文件" in report and "新增: a.txt, b.txt, c.txt" in report
+    assert not os.path.exists(os.path.join(paths.vectorstore, "chroma.sqlite3"))
+    assert len(glob.glob(paths.vectorstore + ".retired-*")) == 1
+
+    # 假嵌入只与文本长度有关，条码分片只能靠 BM25 召回
+    index = Tool_RAG._get_index("kb1")
+    query = "6901028075862"
+    assert all(d.metadata["source"].endswith(("a.txt", "b.txt")) for d in index.vectorstore.similarity_search(query, k=2))
+    context = Tool_RAG.retrieve_documents.invoke({"query": query, "top_k": 2, "knowledge_base": "kb1"})
+    assert "条码 6901028075862" in context
+
+    old_ids = set(index.bm25.doc_terms)
+    (docs / "a.txt").unlink()
+    (docs / "b.txt").write_text("客户经理每月拜访零售户。", encoding="utf-8")
+    (docs / "d.txt").write_text("新品上市通知。", encoding="utf-8")
+    report = Tool_RAG.refresh_knowledge_base.invoke({"knowledge_base": "kb1"})
+    assert "新增: d.txt" in report and "修改: b.txt" in report and "删除: a.txt" in report
+    assert not glob.glob(paths.vectorstore + ".retired-*")
+
+    # 已加载的知识库在原地删除旧分片，刷新后换成新快照
+    refreshed = Tool_RAG._get_index("kb1")
+    assert refreshed is not index and refreshed.vectorstore is index.vectorstore
+    removed = old_ids - set(refreshed.bm25.doc_terms)
+    assert len(removed) == 2 and refreshed.vectorstore.get(ids=list(removed))["ids"] == []
+    assert sorted(os.path.basename(m["source"]) for m in refreshed.vectorstore.get()["metadatas"]) == ["b.txt", "c.txt", "d.txt"]
+    assert "陈列规范" not in Tool_RAG.retrieve_documents.invoke({"query": "陈列规范", "top_k": 3, "knowledge_base": "kb1"})
+
+
+def test_bm25_copy_is_independent():
+    """测试刷新时在 BM25 副本上修改不影响正在使用的旧索引"""
+    index = BM25Index()
+    index.add(["a", "b"], ["卷烟零售终端", "陈列规范"])
+    clone = index.copy()
+    clone.remove(["a"])
+    clone.add(["c"], ["零售价格"])
+    assert [doc_id for doc_id, _ in index.search("零售", 3)] == ["a"]
+    assert [doc_id for doc_id, _ in clone.search("零售", 3)] == ["c"] and index.total_length != clone.total_length
+
+
+if __name__ == "__main__":
+    pytest.main([__file__, "-v"])
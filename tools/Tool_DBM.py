@@ -1,7 +1,25 @@
+import asyncio
 import os
 from config import settings
+from typing import List, Literal, Optional
 from pydantic import BaseModel, Field
 from langchain_core.tools import tool
+from utils.db_pool import get_raw_connection
+from utils.db_async_pool import acquire_async_connection
+from utils.db_stream import stream_query, astream_query
+from utils.schema_catalog import (
+    schema_cache, get_catalog, aget_catalog, format_table_compact, describe_tables as _describe_tables, adescribe_tables
+)
+from utils.result_format import encode_rows, estimate_tokens
+from utils.sql_guard import check_query, acheck_query
+from utils.table_profile import TableProfiler, run_profile, arun_profile, format_profile, quote_identifier
+from utils.sampling import plan_sample, aplan_sample, apply_sample, sample_notes
+from utils.query_cache import (
+    query_cache, is_cacheable, referenced_tables, read_data_version, aread_data_version, make_cache_key
+)
+
+# 各工具同时提供同步实现和基于 aiomysql 的异步实现（通过 tool.coroutine 挂载），
+# 在 langgraph dev / server 中以 ainvoke 调用时不会阻塞事件循环。
 
 
 class DB_Schema(BaseModel):
@@ -11,23 +29,31 @@ class DB_Schema(BaseModel):
     password: str
     database: str
 
+
+def _format_tables(catalog) -> str:
+    tables = catalog.table_names()
+    if tables:
+        return f"数据库中包含以下表: {', '.join(tables)}"
+    else:
+        return "数据库中没有找到任何表。"
+
 @tool(args_schema=DB_Schema)
 def get_tables_from_db(host: str, port: int, user: str, password: str, database: str) -> str:
     """
     获取指定数据库中的所有表名。
     """
-    from sqlalchemy import create_engine, inspect
     try:
-        db_uri = f"mysql+pymysql://{user}:{password}@{host}:{port}/{database}"
-        engine = create_engine(db_uri, echo=False)
-        inspector = inspect(engine)
-        tables = inspector.get_table_names()
-        if tables:
-            return f"数据库中包含以下表: {', '.join(tables)}"
-        else:
-            return "数据库中没有找到任何表。"
+        return _format_tables(get_catalog(host, port, user, password, database))
     except Exception as e:
         return f"查询失败！无法连接数据库或发生错误: {str(e)}"
+
+async def _aget_tables_from_db(host: str, port: int, user: str, password: str, database: str) -> str:
+    try:
+        return _format_tables(await aget_catalog(host, port, user, password, database))
+    except Exception as e:
+        return f"查询失败！无法连接数据库或发生错误: {str(e)}"
+
+get_tables_from_db.coroutine = _aget_tables_from_db
     
 
 
@@ -39,26 +65,123 @@ class DB_Schema_Table_Query(BaseModel):
     database: str
     table_name: str
 
+
+def _format_table_schema(catalog, table_name: str) -> str:
+    table = catalog.get_table(table_name)
+    if table is not None and table.columns:
+        schema_info = f"表 '{table_name}' 的结构信息:\n"
+        for col in table.columns:
+            schema_info += f"- 列名: {col.name}, 类型: {col.type}, 可否为空: {col.nullable}, 默认值: {col.default}\n"
+        if table.primary_key:
+            schema_info += f"主键: {', '.join(table.primary_key)}\n"
+        for name, (unique, columns) in table.indexes.items():
+            if name != "PRIMARY":
+                schema_info += f"{'唯一索引' if unique else '索引'} {name}: {', '.join(columns)}\n"
+        for column, ref_table, ref_column in table.foreign_keys:
+            schema_info += f"外键: {column} -> {ref_table}.{ref_column}\n"
+        return schema_info
+    else:
+        return f"表 '{table_name}' 不存在或没有找到任何列。"
+
 @tool(args_schema=DB_Schema_Table_Query)
 def get_table_schema(host: str, port: int, user: str, password: str, database: str, table_name: str) -> str:
     """
     获取指定数据库表的结构信息。
     """
-    from sqlalchemy import create_engine, inspect
     try:
-        db_uri = f"mysql+pymysql://{user}:{password}@{host}:{port}/{database}"
-        engine = create_engine(db_uri, echo=False)
-        inspector = inspect(engine)
-        columns = inspector.get_columns(table_name)
-        if columns:
-            schema_info = f"表 '{table_name}' 的结构信息:\n"
-            for col in columns:
-                schema_info += f"- 列名: {col['name']}, 类型: {col['type']}, 可否为空: {col['nullable']}, 默认值: {col['default']}\n"
-            return schema_info
-        else:
-            return f"表 '{table_name}' 不存在或没有找到任何列。"
+        return _format_table_schema(get_catalog(host, port, user, password, database), table_name)
+    except Exception as e:
+        return f"查询失败！无法连接数据库或发生错误: {str(e)}"
+
+async def _aget_table_schema(host: str, port: int, user: str, password: str, database: str, table_name: str) -> str:
+    try:
+        return _format_table_schema(await aget_catalog(host, port, user, password, database), table_name)
+    except Exception as e:
+        return f"查询失败！无法连接数据库或发生错误: {str(e)}"
+
+get_table_schema.coroutine = _aget_table_schema
+
+
+def _format_database_schema(catalog, database: str) -> str:
+    if not catalog.tables:
+        return "数据库中没有找到任何表。"
+    lines = [format_table_compact(catalog.tables[name]) for name in catalog.table_names(include_views=True)]
+    return f"数据库 '{database}' 共 {len(lines)} 张表:\n" + "\n".join(lines)
+
+@tool(args_schema=DB_Schema)
+def get_database_schema(host: str, port: int, user: str, password: str, database: str) -> str:
+    """
+    一次性获取指定数据库中所有表的结构概览（列名、类型、主键、索引、外键）。
+    需要了解多张表的结构时，优先使用此工具，而不是逐张调用 get_table_schema。
+    """
+    try:
+        return _format_database_schema(get_catalog(host, port, user, password, database), database)
+    except Exception as e:
+        return f"查询失败！无法连接数据库或发生错误: {str(e)}"
+
+async def _aget_database_schema(host: str, port: int, user: str, password: str, database: str) -> str:
+    try:
+        return _format_database_schema(await aget_catalog(host, port, user, password, database), database)
+    except Exception as e:
+        return f"查询失败！无法连接数据库或发生错误: {str(e)}"
+
+get_database_schema.coroutine = _aget_database_schema
+
+
+class DB_Describe_Tables(BaseModel):
+    host: str
+    port: int
+    user: str
+    password: str
+    database: str
+    tables: List[str] = Field(description="要描述的表名列表，支持通配符，如 ['orders', 'dim_*']")
+    exact_row_count: bool = Field(default=False, description="是否并发统计每张表的精确行数（大表较慢）")
+
+
+def _format_table_descriptions(result) -> str:
+    if not result.tables:
+        return f"没有找到与 {', '.join(result.unmatched)} 匹配的表。"
+    lines = [f"共匹配 {len(result.tables)} 张表:"]
+    for table in result.tables:
+        if table.name in result.errors and not table.columns:
+            continue
+        line = format_table_compact(table)
+        if table.name in result.row_counts:
+            line += f" | 精确行数: {result.row_counts[table.name]}"
+        lines.append(line)
+    if result.omitted:
+        lines.append(f"（另有 {result.omitted} 张匹配的表未返回，请缩小匹配范围）")
+    if result.unmatched:
+        lines.append(f"没有匹配到任何表: {', '.join(result.unmatched)}")
+    if result.errors:
+        lines.append("以下表的信息获取失败:")
+        lines.extend(f"- {name}: {error}" for name, error in result.errors.items())
+    return "\n".join(lines)
+
+@tool(args_schema=DB_Describe_Tables)
+def describe_tables(host: str, port: int, user: str, password: str, database: str, tables: List[str],
+                    exact_row_count: bool = False) -> str:
+    """
+    批量获取多张表的结构信息（列、主键、索引、外键），支持表名列表和通配符。
+    需要了解若干张表时使用此工具，避免逐张调用 get_table_schema；部分表失败时会单独列出，其余表正常返回。
+    """
+    try:
+        return _format_table_descriptions(
+            _describe_tables(host, port, user, password, database, tables, exact_row_count)
+        )
     except Exception as e:
         return f"查询失败！无法连接数据库或发生错误: {str(e)}"
+
+async def _adescribe_tables(host: str, port: int, user: str, password: str, database: str, tables: List[str],
+                            exact_row_count: bool = False) -> str:
+    try:
+        return _format_table_descriptions(
+            await adescribe_tables(host, port, user, password, database, tables, exact_row_count)
+        )
+    except Exception as e:
+        return f"查询失败！无法连接数据库或发生错误: {str(e)}"
+
+describe_tables.coroutine = _adescribe_tables
     
 
 DB_Data_Query_description = """
@@ -75,30 +198,242 @@ class DB_Data_Query(BaseModel):
     password: str
     database: str
     query: str = Field(description=DB_Data_Query_description)
+    max_rows: int = Field(default=settings.db_query_max_rows, description="返回的最大预览行数，超出部分只计数不返回")
+    max_bytes: int = Field(default=settings.db_query_max_bytes, description="返回的最大预览字节数")
+    spill_format: Optional[Literal["csv", "parquet"]] = Field(
+        default=None,
+        description="如需完整结果，可指定 csv 或 parquet，完整结果会保存为本地文件并返回文件路径"
+    )
+    output_format: Literal["csv", "tsv", "markdown", "json"] = Field(
+        default=settings.db_query_output_format,
+        description="结果编码格式：csv/tsv（表头只出现一次，最省 token）、markdown 表格、json（按列组织）"
+    )
+    use_cache: bool = Field(default=True, description="是否使用查询结果缓存（仅对只读查询生效，数据变化后自动失效）")
+    sample_table: Optional[str] = Field(
+        default=None,
+        description="对大表先采样探索时，指定要采样的表名；查询中请直接使用表名（不带库名前缀）引用该表"
+    )
+    sample_fraction: Optional[float] = Field(
+        default=None, gt=0, le=1,
+        description="采样比例，如 0.01 表示 1%；与 sample_table 同时指定时生效，结果会附带样本比例和误差估计"
+    )
+    sample_method: Literal["modulo", "range", "table"] = Field(
+        default=settings.db_sample_method,
+        description="采样方式：modulo 主键哈希取模（均匀）、range 主键区间分块（最快）、table 定期刷新的物化样本表"
+    )
+
+
+def _format_query_result(result, output_format: str, from_cache: bool = False) -> str:
+    """把流式查询结果格式化为返回给 Agent 的文本"""
+    if not result.rows:
+        if result.spill_path:
+            return f"查询成功，但没有返回任何结果。结果文件: {result.spill_path}"
+        return "查询成功，但没有返回任何结果。"
+    body = encode_rows(result.columns, result.rows, output_format)
+    source = "，命中缓存" if from_cache else ""
+    output = f"查询结果（{output_format}，{len(result.rows)} 行，约 {estimate_tokens(body)} tokens{source}）:\n{body}"
+    if result.truncated:
+        output += f"\n（结果已截断：共 {result.total_rows} 行，仅返回前 {len(result.rows)} 行）"
+    if result.spill_path:
+        output += f"\n完整结果已保存到文件: {result.spill_path}"
+    for note in result.notes:
+        output += f"\n注意: {note}"
+    return output
+
 
 @tool(args_schema=DB_Data_Query)
-def run_db_query(host: str, port: int, user: str, password: str, database: str, query: str) -> str:
+def run_db_query(host: str, port: int, user: str, password: str, database: str, query: str,
+                 max_rows: int = settings.db_query_max_rows,
+                 max_bytes: int = settings.db_query_max_bytes,
+                 spill_format: Optional[str] = None,
+                 output_format: str = settings.db_query_output_format,
+                 use_cache: bool = True,
+                 sample_table: Optional[str] = None,
+                 sample_fraction: Optional[float] = None,
+                 sample_method: str = settings.db_sample_method) -> str:
     """
     在指定的MySQL数据库上运行一段SQL查询代码，并返回查询结果。
+    结果以流式方式读取，超出行数/字节预算的部分会被截断，只返回预览和总行数。
+    只读查询的结果会被缓存，相关表的数据变化后缓存自动失效。
+    探索大表时可以指定 sample_table 和 sample_fraction 先在确定性样本上查询，再去掉采样参数全量确认。
     """
     import pymysql
+    # 需要落盘完整结果时总是重新执行查询
+    cacheable = (use_cache and settings.db_query_cache_enabled
+                 and spill_format is None and is_cacheable(query))
+    sampling = bool(sample_table and sample_fraction and sample_fraction < 1)
     try:
-        connection = pymysql.connect(
-            host=host,
-            port=port,
-            user=user,
-            password=password,
-            database=database,
-            cursorclass=pymysql.cursors.DictCursor
-        )
-        with connection:
-            with connection.cursor() as cursor:
-                cursor.execute(query)
-                result = cursor.fetchall()
-                if result:
-                    return f"查询结果: {result}"
-                else:
-                    return "查询成功，但没有返回任何结果。"
+        catalog = get_catalog(host, port, user, password, database) if cacheable or sampling else None
+        known_tables = catalog.tables if cacheable else None
+        # 从共享连接池借出连接，close() 时归还到池中
+        connection = get_raw_connection(host, port, user, password, database)
+        try:
+            plan = None
+            if sampling:
+                with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+                    plan = plan_sample(cursor, catalog, database, sample_table, sample_fraction, sample_method)
+                query = apply_sample(query, plan)
+            cache_key = None
+            if cacheable:
+                with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+                    data_version = read_data_version(cursor, referenced_tables(query, database, known_tables))
+                cache_key = make_cache_key(host, port, user, password, database, query,
+                                           data_version, max_rows, max_bytes)
+                cached = query_cache.get(cache_key)
+                if cached is not None:
+                    return _format_query_result(cached, output_format, from_cache=True)
+            # 执行前先用 EXPLAIN 估算代价，超出阈值的查询会被改写或拒绝
+            with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+                decision = check_query(cursor, query)
+            if not decision.allowed:
+                return decision.message
+            result = stream_query(connection, decision.query, max_rows, max_bytes, spill_format)
+            if not result.has_result_set:
+                # DDL / DML 可能改变了表结构（也可能是其他库的表），清除该服务器的表结构目录缓存
+                schema_cache.invalidate(host, port)
+            result.notes.extend(decision.notes)
+            if plan is not None:
+                result.notes.extend(sample_notes(plan, result.columns, result.rows))
+            if cache_key is not None and result.has_result_set:
+                query_cache.put(cache_key, result)
+        finally:
+            connection.close()
+        return _format_query_result(result, output_format)
     except Exception as e:
         return f"查询失败！无法连接数据库或发生错误: {str(e)}"
-    
+
+async def _arun_db_query(host: str, port: int, user: str, password: str, database: str, query: str,
+                         max_rows: int = settings.db_query_max_rows,
+                         max_bytes: int = settings.db_query_max_bytes,
+                         spill_format: Optional[str] = None,
+                         output_format: str = settings.db_query_output_format,
+                         use_cache: bool = True,
+                         sample_table: Optional[str] = None,
+                         sample_fraction: Optional[float] = None,
+                         sample_method: str = settings.db_sample_method) -> str:
+    import aiomysql
+    cacheable = (use_cache and settings.db_query_cache_enabled
+                 and spill_format is None and is_cacheable(query))
+    sampling = bool(sample_table and sample_fraction and sample_fraction < 1)
+    try:
+        catalog = await aget_catalog(host, port, user, password, database) if cacheable or sampling else None
+        known_tables = catalog.tables if cacheable else None
+        async with acquire_async_connection(host, port, user, password, database) as connection:
+            plan = None
+            if sampling:
+                async with connection.cursor(aiomysql.DictCursor) as cursor:
+                    plan = await aplan_sample(cursor, catalog, database, sample_table, sample_fraction, sample_method)
+                query = apply_sample(query, plan)
+            cache_key = None
+            if cacheable:
+                async with connection.cursor(aiomysql.DictCursor) as cursor:
+                    data_version = await aread_data_version(cursor, referenced_tables(query, database, known_tables))
+                cache_key = make_cache_key(host, port, user, password, database, query,
+                                           data_version, max_rows, max_bytes)
+                # 磁盘层的读写是阻塞的 SQLite I/O，放到线程中执行，不阻塞事件循环
+                cached = await asyncio.to_thread(query_cache.get, cache_key)
+                if cached is not None:
+                    return _format_query_result(cached, output_format, from_cache=True)
+            async with connection.cursor(aiomysql.DictCursor) as cursor:
+                decision = await acheck_query(cursor, query)
+            if not decision.allowed:
+                return decision.message
+            result = await astream_query(connection, decision.query, max_rows, max_bytes, spill_format)
+            if not result.has_result_set:
+                # DDL / DML 可能改变了表结构（也可能是其他库的表），清除该服务器的表结构目录缓存
+                schema_cache.invalidate(host, port)
+            result.notes.extend(decision.notes)
+            if plan is not None:
+                result.notes.extend(sample_notes(plan, result.columns, result.rows))
+            if cache_key is not None and result.has_result_set:
+                await asyncio.to_thread(query_cache.put, cache_key, result)
+        return _format_query_result(result, output_format)
+    except Exception as e:
+        return f"查询失败！无法连接数据库或发生错误: {str(e)}"
+
+run_db_query.coroutine = _arun_db_query
+
+
+class DB_Table_Profile(BaseModel):
+    host: str
+    port: int
+    user: str
+    password: str
+    database: str
+    table_name: str
+    columns: Optional[List[str]] = Field(default=None, description="只统计指定的列，为空时统计全部列")
+    histogram_buckets: int = Field(default=settings.db_profile_histogram_buckets, description="数值列直方图的分桶数")
+    sample_fraction: Optional[float] = Field(
+        default=None, gt=0, le=1,
+        description="采样比例，如 0.01 表示只在 1% 的确定性样本上统计，适合先快速了解大表"
+    )
+    sample_method: Literal["modulo", "range", "table"] = Field(
+        default=settings.db_sample_method,
+        description="采样方式：modulo 主键哈希取模、range 主键区间分块、table 物化样本表"
+    )
+
+
+def _table_profiler(catalog, database: str, table_name: str, columns, histogram_buckets: int, plan=None):
+    table = catalog.get_table(table_name)
+    if table is None or not table.columns:
+        return None
+    if plan is not None:
+        profiler = TableProfiler(table, plan.derived_table(), columns, histogram_buckets)
+        profiler.profile.notes.extend(sample_notes(plan, [], []))
+        return profiler
+    source_sql = f"{quote_identifier(database)}.{quote_identifier(table.name)}"
+    return TableProfiler(table, source_sql, columns, histogram_buckets)
+
+@tool(args_schema=DB_Table_Profile)
+def profile_table(host: str, port: int, user: str, password: str, database: str, table_name: str,
+                  columns: Optional[List[str]] = None,
+                  histogram_buckets: int = settings.db_profile_histogram_buckets,
+                  sample_fraction: Optional[float] = None,
+                  sample_method: str = settings.db_sample_method) -> str:
+    """
+    一次性获取数据表的描述性统计概况：每列的非空数、空值比例、去重数、最小/最大值、均值、标准差，
+    数值列的分布直方图，以及低基数文本列的高频取值。
+    进行探索性分析时优先使用此工具，而不是用 run_db_query 逐列逐指标查询。
+    大表可以指定 sample_fraction 先在确定性样本上统计。
+    """
+    import pymysql
+    try:
+        catalog = get_catalog(host, port, user, password, database)
+        profiler = _table_profiler(catalog, database, table_name, columns, histogram_buckets)
+        if profiler is None:
+            return f"表 '{table_name}' 不存在或没有找到任何列。"
+        connection = get_raw_connection(host, port, user, password, database)
+        try:
+            with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+                if sample_fraction and sample_fraction < 1:
+                    plan = plan_sample(cursor, catalog, database, table_name, sample_fraction, sample_method)
+                    profiler = _table_profiler(catalog, database, table_name, columns, histogram_buckets, plan)
+                profile = run_profile(cursor, profiler)
+        finally:
+            connection.close()
+        return format_profile(profile)
+    except Exception as e:
+        return f"查询失败！无法连接数据库或发生错误: {str(e)}"
+
+async def _aprofile_table(host: str, port: int, user: str, password: str, database: str, table_name: str,
+                          columns: Optional[List[str]] = None,
+                          histogram_buckets: int = settings.db_profile_histogram_buckets,
+                          sample_fraction: Optional[float] = None,
+                          sample_method: str = settings.db_sample_method) -> str:
+    import aiomysql
+    try:
+        catalog = await aget_catalog(host, port, user, password, database)
+        profiler = _table_profiler(catalog, database, table_name, columns, histogram_buckets)
+        if profiler is None:
+            return f"表 '{table_name}' 不存在或没有找到任何列。"
+        async with acquire_async_connection(host, port, user, password, database) as connection:
+            async with connection.cursor(aiomysql.DictCursor) as cursor:
+                if sample_fraction and sample_fraction < 1:
+                    plan = await aplan_sample(cursor, catalog, database, table_name, sample_fraction, sample_method)
+                    profiler = _table_profiler(catalog, database, table_name, columns, histogram_buckets, plan)
+                profile = await arun_profile(cursor, profiler)
+        return format_profile(profile)
+    except Exception as e:
+        return f"查询失败！无法连接数据库或发生错误: {str(e)}"
+
+profile_table.coroutine = _aprofile_table
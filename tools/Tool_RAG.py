@@ -1,154 +1,656 @@
+from langchain_core.documents import Document
 from langchain_core.tools import tool
 from langchain_community.vectorstores import Chroma  # 改用 Chroma
 from langchain_community.embeddings import DashScopeEmbeddings
-from langchain_community.document_loaders import (
-    PyPDFLoader, 
-    DirectoryLoader
-)
-from langchain_community.document_loaders.text import TextLoader
-from langchain_community.document_loaders import Docx2txtLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from pydantic import BaseModel, Field
-from typing import List
+from typing import Any, List, Optional, Tuple
+import numpy as np
+import glob
 import os
+import re
+import shutil
+import threading
+import time
+import weakref
+from contextlib import nullcontext
+from dataclasses import dataclass
+from config import settings
+from utils.embedding_cache import CachedEmbeddings, EmbeddingCache, cache_key
+from utils.embedding_pipeline import EmbeddingPipeline
+from utils.kb_bm25 import BM25Index, reciprocal_rank_fusion
+from utils.kb_context import assemble_context, merge_adjacent, mmr_select
+from utils.kb_loader import iter_loaded
+from utils.kb_manifest import KBManifest, ManifestDiff, chunk_id, scan_documents
+from utils.kb_registry import CollectionCache, directory_size, list_collections
+from utils.kb_vector_index import NumpyVectorStore
+from utils.retrieval_cache import retrieval_cache, retrieval_key
 
 class RAGQueryInput(BaseModel):
     """RAG查询输入参数"""
     query: str = Field(description="用户的查询问题")
     top_k: int = Field(default=3, description="返回的相关文档数量")
+    knowledge_base: str = Field(default=settings.kb_default_collection,
+                                description="要检索的知识库名称，可用 list_knowledge_bases 查看")
 
-# 全局向量存储实例
-_vectorstore = None
-
-def _init_vectorstore():
-    """初始化向量存储"""
-    global _vectorstore
-    
-    if _vectorstore is not None:
-        return _vectorstore
-    
-    kb_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "kb", "documents","tobacco")
-    vectorstore_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "kb", "vectorstore")
-    
+class RefreshInput(BaseModel):
+    """知识库刷新输入参数"""
+    knowledge_base: str = Field(default=settings.kb_default_collection, description="要刷新的知识库名称")
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _project_path(path: str) -> str:
+    return path if os.path.isabs(path) else os.path.join(PROJECT_ROOT, path)
+
+
+# 每个子目录是一个知识库
+KB_ROOT = _project_path(settings.kb_documents_dir)
+VECTORSTORE_ROOT = _project_path(settings.kb_vectorstore_dir)
+
+
+@dataclass(frozen=True)
+class _KBPaths:
+    """一个知识库的文档目录和索引文件位置"""
+    name: str
+    documents: str
+    vectorstore: str
+    manifest: str       # 索引清单与向量库放在同一目录，删除向量库时一并清除
+    checkpoint: str     # 构建过程中已完成的嵌入批次，构建中断后从这里继续
+    bm25: str           # 与向量库同步维护的 BM25 倒排索引
+
+
+# 单知识库版本直接存放在向量库根目录下的文件：chroma.sqlite3、按 UUID 命名的段目录、清单等
+_LEGACY_ROOT_ENTRY = re.compile(r"^(chroma\.sqlite3|manifest\.json|bm25\.json|embedding_checkpoint|"
+                                r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12})$")
+
+
+def _migrate_root_store(name: str):
+    """
+    把单知识库版本放在向量库根目录下的向量库移到默认知识库的目录，沿用已有的向量而不是冷启动重建。
+    调用方需持有该知识库的加载 / 刷新锁。
+    """
+    target = os.path.join(VECTORSTORE_ROOT, name)
+    if (name != settings.kb_default_collection or os.path.exists(target)
+            or not os.path.exists(os.path.join(VECTORSTORE_ROOT, "chroma.sqlite3"))):
+        return
+    os.makedirs(target)
+    for entry in os.listdir(VECTORSTORE_ROOT):
+        if _LEGACY_ROOT_ENTRY.match(entry):
+            os.replace(os.path.join(VECTORSTORE_ROOT, entry), os.path.join(target, entry))
+    print(f"已将根目录下的旧向量库迁移到知识库 '{name}'")
+
+
+def _collection_paths(name: str) -> _KBPaths:
+    vectorstore = os.path.join(VECTORSTORE_ROOT, name)
+    if settings.kb_vector_backend == "numpy":
+        # 与 Chroma 的数据分开存放，两种后端可以来回切换而互不影响
+        vectorstore = os.path.join(vectorstore, "numpy")
+    return _KBPaths(
+        name=name,
+        documents=os.path.join(KB_ROOT, name),
+        vectorstore=vectorstore,
+        manifest=os.path.join(vectorstore, "manifest.json"),
+        checkpoint=os.path.join(vectorstore, "embedding_checkpoint"),
+        bm25=os.path.join(vectorstore, "bm25.json"),
+    )
+
+
+@dataclass(frozen=True)
+class _KBIndex:
+    """一次加载或刷新得到的知识库快照，刷新完成后整体替换"""
+    paths: _KBPaths
+    vectorstore: Any
+    bm25: BM25Index          # 与 vectorstore 中的分片一一对应
+    version: str             # 向量库内容的版本（见 KBManifest.version），作为检索缓存键的一部分
+
+
+def _chroma_system(vectorstore):
+    """Chroma 客户端当前使用的 (System 缓存, 键, System)；不是 Chroma 时返回 None"""
+    client = getattr(vectorstore, "_client", None)
+    identifier = getattr(client, "_identifier", None)
+    systems = getattr(type(client), "_identifier_to_system", None)
+    if identifier is None or systems is None:
+        return None
+    return systems, identifier, systems.get(identifier)
+
+
+def _stop_client(systems: dict, identifier: str, system):
+    """
+    停止 Chroma 客户端的 System。chromadb 在类级别按持久化路径缓存 System（SQLite 连接、HNSW 索引），
+    只丢弃 Chroma 对象并不会回收内存，同一路径重新打开时也会拿到旧的 System。
+    """
+    try:
+        if systems.get(identifier) is system:
+            systems.pop(identifier, None)
+        system.stop()
+    except Exception as e:
+        print(f"释放向量库客户端失败: {e}")
+
+
+# 每个 Chroma System 的使用者数：缓存中的快照算一个，正在进行的检索各算一个，减到 0 时才停止 System。
+# 同一路径上打开的多个 Chroma 对象共用一个 System，按打开时拿到的 System 计数
+_client_users = {}                                  # id(System) -> [System, 使用者数]
+_client_users_lock = threading.Lock()
+_vectorstore_systems = weakref.WeakKeyDictionary()  # Chroma 对象 -> 打开时的 System
+
+
+def _track_vectorstore(vectorstore):
+    """登记新打开的向量库，打开者算作第一个使用者"""
+    found = _chroma_system(vectorstore)
+    if found is None or found[2] is None:
+        return
+    system = found[2]
+    with _client_users_lock:
+        _vectorstore_systems[vectorstore] = system
+        _client_users.setdefault(id(system), [system, 0])[1] += 1
+
+
+def _retain_vectorstore(vectorstore) -> bool:
+    """登记一个使用者；客户端已被释放时返回 False，调用方应重新获取知识库快照"""
+    if _chroma_system(vectorstore) is None:
+        return True
+    with _client_users_lock:
+        system = _vectorstore_systems.get(vectorstore)
+        if system is None:
+            return True
+        entry = _client_users.get(id(system))
+        if entry is None:
+            return False
+        entry[1] += 1
+        return True
+
+
+def _release_vectorstore(vectorstore):
+    """注销一个使用者，最后一个使用者注销时停止 Chroma 客户端"""
+    found = _chroma_system(vectorstore)
+    if found is None:
+        return
+    with _client_users_lock:
+        system = _vectorstore_systems.get(vectorstore)
+        entry = _client_users.get(id(system)) if system is not None else None
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        del _client_users[id(system)]
+    _stop_client(found[0], found[1], system)
+
+
+def _close_vectorstore(vectorstore):
+    """不等使用者注销，立即停止 Chroma 客户端；之后的注销不再生效"""
+    found = _chroma_system(vectorstore)
+    if found is None:
+        return
+    with _client_users_lock:
+        system = _vectorstore_systems.get(vectorstore)
+        if system is not None:
+            _client_users.pop(id(system), None)
+    systems, identifier, current = found
+    if system is None:
+        system = current
+    if system is not None:
+        _stop_client(systems, identifier, system)
+
+
+# 已加载的知识库快照（LRU）；检索时取一次引用并一直使用，刷新不影响正在进行的检索。
+# 淘汰时只注销缓存这个使用者，仍在使用该快照的检索结束后才真正释放客户端
+_collections = CollectionCache(on_evict=lambda name, index: _release_vectorstore(index.vectorstore))
+# 同一时间只允许一个线程写向量库（首次构建或刷新），各知识库共用嵌入接口的限流额度
+_write_lock = threading.Lock()
+# 全局嵌入缓存，所有知识库共用（同一模型的缓存文件只能有一个写入者）
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+
+
+def _get_embedding_cache() -> EmbeddingCache:
+    global _embedding_cache
+
+    if _embedding_cache is not None:
+        return _embedding_cache
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache(_project_path(settings.kb_embedding_cache_dir),
+                                              settings.kb_embedding_model)
+    return _embedding_cache
+
+
+def _create_embeddings(paths: _KBPaths):
+    # 批量、并发、限流地调用 DashScope，失败的批次自动重试；检查点按知识库分开
+    embeddings = EmbeddingPipeline(
+        DashScopeEmbeddings(
+            model=settings.kb_embedding_model,
+            dashscope_api_key=os.getenv("DASHSCOPE_API_KEY")
+        ),
+        checkpoint_dir=paths.checkpoint,
+    )
+    # 外层的持久化缓存让重建和重复的查询不再调用接口，只有未命中的文本进入流水线
+    if settings.kb_embedding_cache_enabled:
+        embeddings = CachedEmbeddings(embeddings, _get_embedding_cache())
+    return embeddings
+
+
+def _pipeline(embeddings) -> EmbeddingPipeline:
+    return embeddings.embeddings if isinstance(embeddings, CachedEmbeddings) else embeddings
+
+
+def _text_splitter():
+    return RecursiveCharacterTextSplitter(
+        chunk_size=settings.kb_chunk_size,
+        chunk_overlap=settings.kb_chunk_overlap,
+        separators=["\n\n", "\n", "。", "!", "?", ".", "!", "?", " "]
+    )
+
+
+def _vectorstore_exists(paths: _KBPaths) -> bool:
+    if os.path.exists(paths.manifest):
+        return bool(KBManifest(paths.manifest).entries)
+    # 没有索引清单的旧版向量库；目录中只有嵌入检查点说明上次构建被中断，需要继续构建
+    return os.path.exists(os.path.join(paths.vectorstore, "chroma.sqlite3")) and not os.path.exists(paths.checkpoint)
+
+
+def _open_vectorstore(paths: _KBPaths):
     # 确保向量库目录存在
-    os.makedirs(vectorstore_path, exist_ok=True)
-    
-    # 初始化 embeddings
-    from config import settings
-    embeddings = DashScopeEmbeddings(
-        model="text-embedding-v1",
-        dashscope_api_key=os.getenv("DASHSCOPE_API_KEY")
+    os.makedirs(paths.vectorstore, exist_ok=True)
+    if settings.kb_vector_backend == "numpy":
+        return NumpyVectorStore(paths.vectorstore, _create_embeddings(paths))
+    vectorstore = Chroma(
+        persist_directory=paths.vectorstore,
+        embedding_function=_create_embeddings(paths)
     )
-    
+    # 调用方用完后需调用 _release_vectorstore（放入缓存的快照在淘汰时注销）
+    _track_vectorstore(vectorstore)
+    return vectorstore
+
+
+def _load_bm25(paths: _KBPaths, vectorstore) -> BM25Index:
+    """加载 BM25 索引；与清单中的分片不一致（例如上次刷新中断）时从向量库中的文本重建"""
+    bm25 = BM25Index.load(paths.bm25)
+    expected = None
+    if os.path.exists(paths.manifest):
+        expected = {cid for entry in KBManifest(paths.manifest).entries.values() for cid in entry.chunk_ids}
+    if (expected is None and len(bm25)) or set(bm25.doc_terms) == expected:
+        return bm25
+    print("重建 BM25 索引...")
+    stored = vectorstore.get(include=["documents"])
+    bm25 = BM25Index()
+    bm25.add(stored["ids"], stored["documents"])
+    bm25.save(paths.bm25)
+    return bm25
+
+
+def _write_files(vectorstore, bm25: BM25Index, manifest: KBManifest, diff: ManifestDiff, pending):
+    """计算一组文件的分片向量并写入向量库，每写完一个文件更新一次清单"""
+    # 这一组分片的向量一次性并发计算；之后按文件写入向量库时直接复用
+    embeddings = vectorstore.embeddings
+    embeddings.embed_documents([doc.page_content for _, doc_splits in pending for doc in doc_splits])
+    for rel, doc_splits in pending:
+        entry = diff.files[rel]
+        ids = [chunk_id(rel, entry.sha256, i) for i in range(len(doc_splits))]
+        # 分片 ID 同时写入元数据，检索结果据此与 BM25 结果对应；序号用于合并相邻分片
+        for i, (doc, cid) in enumerate(zip(doc_splits, ids)):
+            doc.metadata["chunk_id"] = cid
+            doc.metadata["chunk_index"] = i
+        # 先写入新分片再删除旧分片，中途失败时知识库中仍有该文件的内容
+        if doc_splits:
+            # 向量已在上面预取，这里复用，不重复计入缓存命中率
+            with (embeddings.uncounted() if isinstance(embeddings, CachedEmbeddings) else nullcontext()):
+                vectorstore.add_documents(doc_splits, ids=ids)
+            bm25.add(ids, [doc.page_content for doc in doc_splits])
+        previous = manifest.entries.get(rel)
+        if previous is not None and previous.chunk_ids:
+            vectorstore.delete(ids=previous.chunk_ids)
+            bm25.remove(previous.chunk_ids)
+        entry.chunk_ids = ids
+        manifest.entries[rel] = entry
+        # 每处理完一个文件就保存清单，中断后重新刷新不会重复嵌入
+        manifest.save()
+
+
+def _sync_vectorstore(paths: _KBPaths, vectorstore, bm25: BM25Index,
+                      manifest: KBManifest) -> Tuple[ManifestDiff, List[str]]:
+    """
+    按索引清单增量同步向量库和 BM25 索引：只切分和嵌入新增 / 修改的文件，删除修改 / 删除文件的旧分片。
+
+    新增 / 修改的文件在进程池中并行解析，按完成顺序切分；攒够一批分片就开始嵌入和写入，
+    不必等全部文件解析完。
+
+    Returns:
+        (文件变化, 处理失败的文件及原因)；失败的文件保留旧分片，下次刷新时重试
+    """
+    diff = manifest.diff(paths.documents)
+    errors = []
+    text_splitter = _text_splitter()
+    # 每批分片的数量让所有嵌入工作线程都有几个批次可做
+    flush_chunks = settings.kb_embed_batch_size * settings.kb_embed_workers * 2
+    pending, buffered, failure = [], 0, None
+    for rel, loaded in iter_loaded(paths.documents, diff.added + diff.modified):
+        if isinstance(loaded, Exception):
+            errors.append(f"{rel}: {loaded}")
+            continue
+        doc_splits = text_splitter.split_documents(loaded)
+        pending.append((rel, doc_splits))
+        buffered += len(doc_splits)
+        if buffered < flush_chunks:
+            continue
+        try:
+            _write_files(vectorstore, bm25, manifest, diff, pending)
+        except Exception as e:
+            failure = e
+            break
+        pending, buffered = [], 0
+    if failure is None and pending:
+        try:
+            _write_files(vectorstore, bm25, manifest, diff, pending)
+        except Exception as e:
+            failure = e
+    if failure is not None:
+        # 剩下的文件仍是新增 / 修改状态，下次刷新时处理
+        errors.append(f"嵌入失败（已完成的批次已保存，重新刷新会从断点继续）: {failure}")
+
+    for rel in diff.deleted:
+        chunk_ids = manifest.entries.pop(rel).chunk_ids
+        if chunk_ids:
+            vectorstore.delete(ids=chunk_ids)
+            bm25.remove(chunk_ids)
+    manifest.save()
+    bm25.save(paths.bm25)
+    if isinstance(vectorstore, NumpyVectorStore):
+        # 删除较多时压缩墓碑，分片较多时重建 IVF 分区
+        for message in vectorstore.optimize():
+            print(message)
+    if failure is None:
+        # 向量已全部写入向量库，检查点不再需要
+        _pipeline(vectorstore.embeddings).clear_checkpoint()
+    return diff, errors
+
+
+def _load_index(paths: _KBPaths) -> Optional[_KBIndex]:
+    """加载已存在的向量库，不存在时从文档目录构建"""
     # 检查向量库是否已存在
-    if os.path.exists(vectorstore_path) and os.listdir(vectorstore_path):
-        print("加载已存在的向量库...")
-        _vectorstore = Chroma(
-            persist_directory=vectorstore_path,
-            embedding_function=embeddings
-        )
+    if _vectorstore_exists(paths):
+        print(f"加载知识库 '{paths.name}' 的向量库...")
+        vectorstore = _open_vectorstore(paths)
+        try:
+            index = _KBIndex(paths, vectorstore, _load_bm25(paths, vectorstore), KBManifest(paths.manifest).version)
+        except Exception:
+            _release_vectorstore(vectorstore)
+            raise
         print(f"向量库加载完成")
-        return _vectorstore
-    
+        return index
+
     # 向量库不存在，需要创建
-    print("创建新的向量库...")
-    
-    # 加载文档
-    documents = []
-    
-    # 定义支持UTF-8编码的TextLoader
-    class UTF8TextLoader(TextLoader):
-        def __init__(self, file_path: str):
-            super().__init__(file_path, encoding='utf-8')
-    
-    # 支持多种文档格式
-    loaders = [
-        DirectoryLoader(kb_path, glob="**/*.pdf", loader_cls=PyPDFLoader),
-        DirectoryLoader(kb_path, glob="**/*.txt", loader_cls=UTF8TextLoader),
-        DirectoryLoader(kb_path, glob="**/*.md", loader_cls=UTF8TextLoader),
-        DirectoryLoader(kb_path, glob="**/*.docx", loader_cls=Docx2txtLoader)
-    ]
-    
-    for loader in loaders:
+    print(f"创建知识库 '{paths.name}' 的向量库...")
+    with _write_lock:
+        vectorstore = _open_vectorstore(paths)
         try:
-            documents.extend(loader.load())
-        except Exception as e:
-            print(f"加载文档时出错: {e}")
-    
-    if not documents:
+            bm25 = _load_bm25(paths, vectorstore)
+            manifest = KBManifest(paths.manifest)
+            _, errors = _sync_vectorstore(paths, vectorstore, bm25, manifest)
+        except Exception:
+            _release_vectorstore(vectorstore)
+            raise
+    for error in errors:
+        print(f"加载文档时出错: {error}")
+
+    if not manifest.entries:
         print("警告: 未找到任何文档")
+        _release_vectorstore(vectorstore)
         return None
-    
-    # 文档切分
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=500,
-        chunk_overlap=50,
-        separators=["\n\n", "\n", "。", "!", "?", ".", "!", "?", " "]
-    )
-    doc_splits = text_splitter.split_documents(documents)
-    
-    # 创建并持久化向量存储
-    _vectorstore = Chroma.from_documents(
-        documents=doc_splits,
-        embedding=embeddings,
-        persist_directory=vectorstore_path
-    )
-    
-    print(f"向量库创建完成，共 {len(doc_splits)} 个文档片段，已保存到 {vectorstore_path}")
-    return _vectorstore
+
+    chunks = sum(len(entry.chunk_ids) for entry in manifest.entries.values())
+    print(f"向量库创建完成，共 {chunks} 个文档片段，已保存到 {paths.vectorstore}")
+    return _KBIndex(paths, vectorstore, bm25, manifest.version)
+
+
+def _load_collection(name: str) -> Optional[Tuple[_KBIndex, int]]:
+    _migrate_root_store(name)
+    index = _load_index(_collection_paths(name))
+    # 内存占用按向量库目录的大小估算
+    return None if index is None else (index, directory_size(index.paths.vectorstore))
+
+
+def _get_index(name: str) -> Optional[_KBIndex]:
+    """返回知识库的当前快照，首次使用时加载（并发的首次请求只加载一次）"""
+    return _collections.get_or_load(name, lambda: _load_collection(name))
+
+
+def _check_collection(name: str) -> Optional[str]:
+    """知识库不存在时返回提示信息"""
+    available = list_collections(KB_ROOT)
+    if name in available:
+        return None
+    return f"知识库 '{name}' 不存在，可用的知识库: {', '.join(available) or '无'}。"
+
+
+def warmup_knowledge_base(name: str = settings.kb_default_collection, background: bool = True):
+    """
+    预先加载知识库，避免第一个用户承担加载时间。
+
+    Args:
+        name: 知识库名称，默认预热默认知识库
+        background: 为 True 时在后台线程中加载，不阻塞服务启动；加载期间到达的请求等待同一次加载完成
+    """
+    def _warmup():
+        try:
+            if _check_collection(name) is None:
+                _get_index(name)
+        except Exception as e:
+            print(f"知识库预热失败: {e}")
+
+    if not background:
+        _warmup()
+        return
+    threading.Thread(target=_warmup, name="kb-warmup", daemon=True).start()
+
+def _hybrid_search(vectorstore, bm25: BM25Index, query: str, top_k: int):
+    """向量检索与 BM25 检索各取候选，按倒数排名融合后取前 top_k 个分片"""
+    if bm25 is None or not len(bm25):
+        return vectorstore.similarity_search(query, k=top_k)
+    fetch_k = max(top_k, settings.kb_hybrid_fetch_k)
+    vector_docs = vectorstore.similarity_search(query, k=fetch_k)
+    if any("chunk_id" not in doc.metadata for doc in vector_docs):
+        # 旧版向量库的分片没有记录 ID，无法与 BM25 结果对应
+        return vector_docs[:top_k]
+    # 刷新时原地写入向量库：只保留本快照 BM25 索引中有的分片，旧快照不会检索到刷新中途写入的分片
+    vector_docs = [doc for doc in vector_docs if doc.metadata["chunk_id"] in bm25]
+    if not settings.kb_hybrid_enabled:
+        return vector_docs[:top_k]
+    lexical = bm25.search(query, fetch_k)
+    docs = {doc.metadata["chunk_id"]: doc for doc in vector_docs}
+    fused = reciprocal_rank_fusion([list(docs), [doc_id for doc_id, _ in lexical]])
+    top_ids = [doc_id for doc_id, _ in fused[:top_k]]
+    # 只被 BM25 召回的分片从向量库中按 ID 取出正文
+    missing = [doc_id for doc_id in top_ids if doc_id not in docs]
+    if missing:
+        stored = vectorstore.get(ids=missing, include=["documents", "metadatas"])
+        for doc_id, text, metadata in zip(stored["ids"], stored["documents"], stored["metadatas"]):
+            docs[doc_id] = Document(page_content=text, metadata=metadata or {})
+    return [docs[doc_id] for doc_id in top_ids if doc_id in docs]
+
+def _stored_vectors(vectorstore, docs: List[Document]) -> Optional[np.ndarray]:
+    """
+    候选分片已存储的向量：先从向量库按分片 ID 读取，取不到的再只读查询嵌入缓存。
+
+    检索路径上不调用嵌入接口，也不写缓存和检查点；有分片取不到向量时返回 None。
+    """
+    ids = [doc.metadata.get("chunk_id") for doc in docs]
+    found = {}
+    if all(ids):
+        stored = vectorstore.get(ids=ids, include=["embeddings"])
+        if stored.get("embeddings") is not None:
+            found = {doc_id: np.asarray(vector, dtype=np.float32)
+                     for doc_id, vector in zip(stored["ids"], stored["embeddings"])}
+    vectors = [found.get(doc_id) for doc_id in ids]
+    embeddings = vectorstore.embeddings
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing and isinstance(embeddings, CachedEmbeddings):
+        keys = {i: cache_key("document", docs[i].page_content) for i in missing}
+        cached = embeddings.cache.get_many(list(keys.values()))
+        for i, key in keys.items():
+            vectors[i] = cached.get(key)
+    if any(vector is None for vector in vectors):
+        return None
+    return np.stack(vectors)
+
+def _rerank(vectorstore, docs: List[Document], top_k: int) -> List[Document]:
+    """用 MMR 从候选中选出 top_k 个分片；取不到全部候选的向量时按融合排名取前 top_k 个"""
+    if len(docs) <= top_k:
+        return docs
+    vectors = _stored_vectors(vectorstore, docs)
+    if vectors is None:
+        return docs[:top_k]
+    return [docs[i] for i in mmr_select(vectors, top_k)]
 
 @tool(args_schema=RAGQueryInput)
-def retrieve_documents(query: str, top_k: int = 3) -> str:
+def retrieve_documents(query: str, top_k: int = 3, knowledge_base: str = settings.kb_default_collection) -> str:
     """
     【优先使用】从知识库中检索相关文档。对于所有用户问题，都应该先调用此工具。
-    
+
     强制使用场景：
     - 所有用户提出的问题（无论是否看起来是隐私信息）
     - 任何需要事实性回答的问题
     - 即使你认为问题涉及隐私，也应该先检索确认知识库中是否有信息
-    
+
     参数：
     - query: 用户的原始问题
     - top_k: 返回的相关文档数量，默认3
+    - knowledge_base: 知识库名称，不指定时检索默认知识库
     """
-    vectorstore = _init_vectorstore()
-    
-    if vectorstore is None:
-        return "知识库未初始化或为空,请先上传文档。"
-    
-    # 检索相关文档
-    retriever = vectorstore.as_retriever(search_kwargs={"k": top_k})
-    docs = retriever.invoke(query)
-    
+    error = _check_collection(knowledge_base)
+    if error:
+        return error
+    # 检索期间登记为快照的使用者，快照被淘汰时等检索结束才释放客户端；
+    # 取到快照后、登记前刚好被淘汰并释放时重新获取
+    while True:
+        index = _get_index(knowledge_base)
+        if index is None:
+            return "知识库未初始化或为空,请先上传文档。"
+        if _retain_vectorstore(index.vectorstore):
+            break
+    try:
+        return _retrieve(index, query, top_k, knowledge_base)
+    finally:
+        _release_vectorstore(index.vectorstore)
+
+
+def _retrieve(index: _KBIndex, query: str, top_k: int, knowledge_base: str) -> str:
+    vectorstore = index.vectorstore
+
+    # 相同（规范化后）的问题直接返回缓存结果，不再嵌入查询和检索
+    cache_key = retrieval_key(query, top_k, index.version, knowledge_base, settings.kb_hybrid_enabled)
+    if settings.kb_retrieval_cache_enabled:
+        cached = retrieval_cache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    # 检索相关文档；启用 MMR 时多取候选再重排
+    if settings.kb_mmr_enabled:
+        candidates = _hybrid_search(vectorstore, index.bm25, query, max(top_k, settings.kb_mmr_fetch_k))
+        docs = _rerank(vectorstore, candidates, top_k)
+    else:
+        docs = _hybrid_search(vectorstore, index.bm25, query, top_k)
+
     if not docs:
-        return "未找到相关文档。"
-    
-    # 格式化返回结果
-    context = "\n\n---\n\n".join([
-        f"文档 {i+1}:\n{doc.page_content}\n来源: {doc.metadata.get('source', '未知')}"
-        for i, doc in enumerate(docs)
-    ])
-    
+        context = "未找到相关文档。"
+    else:
+        # 合并相邻分片，按 token 预算格式化返回结果
+        context = assemble_context(merge_adjacent(docs))
+
+    if settings.kb_retrieval_cache_enabled:
+        retrieval_cache.put(cache_key, context)
     return context
 
-@tool
-def refresh_knowledge_base() -> str:
+@tool(args_schema=RefreshInput)
+def refresh_knowledge_base(knowledge_base: str = settings.kb_default_collection) -> str:
     """
-    刷新知识库，重新加载所有文档。
-    
+    刷新知识库，增量同步文档目录的变化。
+
     使用场景：
     - 用户上传了新文档
+    - 用户修改或删除了文档
     - 知识库需要更新
+
+    只刷新指定的知识库。只有新增和修改的文档会重新切分和嵌入，删除的文档会从知识库中移除，未变化的文档不做处理。
+    """
+    error = _check_collection(knowledge_base)
+    if error:
+        return error
+    paths = _collection_paths(knowledge_base)
+
+    # 与该知识库的首次加载互斥，避免加载到刷新前的旧快照并覆盖刷新结果
+    with _collections.name_lock(knowledge_base), _write_lock:
+        _migrate_root_store(knowledge_base)
+        current = _collections.peek(knowledge_base)
+        # 上次重建时移走的旧向量库已不再被检索使用
+        for retired in glob.glob(f"{glob.escape(paths.vectorstore)}.retired-*"):
+            shutil.rmtree(retired, ignore_errors=True)
+        # 没有索引清单的旧版向量库无法得知分片来自哪个文件，只能重建一次
+        if not os.path.exists(paths.manifest) and _vectorstore_exists(paths):
+            _collections.discard(knowledge_base)
+            if current is not None:
+                # 否则在同一路径重新打开时 chromadb 会复用旧向量库的客户端；此刻正在进行的检索可能失败一次
+                _close_vectorstore(current.vectorstore)
+            current = None
+            # 正在进行的检索可能还在读旧向量库，先移到一旁（已打开的文件不受影响），下次刷新时再删除
+            os.replace(paths.vectorstore, f"{paths.vectorstore}.retired-{int(time.time())}")
+            print("没有索引清单的旧向量库已移走，将完整重建")
+
+        vectorstore = current.vectorstore if current is not None else _open_vectorstore(paths)
+        try:
+            # 在 BM25 索引的副本上更新，正在检索的请求继续使用旧索引；向量库原地先写新分片再删旧分片，
+            # 旧快照按自己的 BM25 索引过滤向量检索结果，看不到刷新中途写入的分片
+            bm25 = current.bm25.copy() if current is not None else _load_bm25(paths, vectorstore)
+            manifest = KBManifest(paths.manifest)
+            diff, errors = _sync_vectorstore(paths, vectorstore, bm25, manifest)
+            if not manifest.entries:
+                _collections.discard(knowledge_base)
+                if current is not None:
+                    # 缓存不再持有该快照
+                    _release_vectorstore(current.vectorstore)
+            elif current is not None:
+                # 新索引就绪后一次性替换；未加载的知识库刷新后不常驻内存，等到检索时再加载
+                _collections.put(knowledge_base, _KBIndex(paths, vectorstore, bm25, manifest.version),
+                                 directory_size(paths.vectorstore))
+            if diff.changed:
+                # 版本变化后旧结果已不会命中，这里直接释放
+                retrieval_cache.clear()
+        finally:
+            if current is None:
+                # 只为这次刷新打开的客户端，用完即释放
+                _release_vectorstore(vectorstore)
+
+    lines = [f"知识库 '{knowledge_base}' 已刷新：{diff.summary()}。" if diff.changed
+             else f"知识库 '{knowledge_base}' 已是最新，没有文档变化。"]
+    for label, files in (("新增", diff.added), ("修改", diff.modified), ("删除", diff.deleted)):
+        if files:
+            lines.append(f"{label}: {', '.join(files)}")
+    if errors:
+        lines.append("以下文档处理失败，将在下次刷新时重试: " + "；".join(errors))
+    if isinstance(vectorstore.embeddings, CachedEmbeddings):
+        lines.append(vectorstore.embeddings.summary())
+    if settings.kb_retrieval_cache_enabled:
+        lines.append(retrieval_cache.summary())
+    return "\n".join(lines)
+
+@tool
+def list_knowledge_bases() -> str:
+    """
+    列出可检索的知识库及其文档数量。
+
+    用户的问题涉及特定业务领域，或不确定该检索哪个知识库时使用；检索和刷新时通过 knowledge_base 参数指定名称。
     """
-    global _vectorstore
-    _vectorstore = None
-    
-    # 删除旧的向量库
-    vectorstore_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "kb", "vectorstore")
-    if os.path.exists(vectorstore_path):
-        import shutil
-        shutil.rmtree(vectorstore_path)
-        print("已删除旧的向量库")
-    
-    _init_vectorstore()
-    return "知识库已刷新"
\ No newline at end of file
+    names = list_collections(KB_ROOT)
+    if not names:
+        return "没有可用的知识库，请先在文档目录下为每个知识库创建子目录并上传文档。"
+    loaded = set(_collections.loaded())
+    lines = ["可用的知识库："]
+    for name in names:
+        notes = [f"{len(scan_documents(os.path.join(KB_ROOT, name)))} 个文档"]
+        if name == settings.kb_default_collection:
+            notes.insert(0, "默认")
+        if name in loaded:
+            notes.append("已加载")
+        lines.append(f"- {name}（{'，'.join(notes)}）")
+    return "\n".join(lines)
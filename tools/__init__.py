@@ -1,11 +1,18 @@
 from .Tool_Image_Gen import image_gen_tool
-from .Tool_DBM import get_tables_from_db, get_table_schema, run_db_query
-from .Tool_RAG import retrieve_documents, refresh_knowledge_base
+from .Tool_DBM import get_tables_from_db, get_table_schema, get_database_schema, describe_tables, run_db_query, profile_table
+from .Tool_RAG import retrieve_documents, refresh_knowledge_base, list_knowledge_bases
+from .Tool_Load_To_DB import ExcelToDBTool, IngestJobStatusTool
 __all__ = [
     "image_gen_tool",
     "get_tables_from_db",
     "get_table_schema",
+    "get_database_schema",
+    "describe_tables",
     "run_db_query",
+    "profile_table",
     "retrieve_documents",
-    "refresh_knowledge_base"
+    "refresh_knowledge_base",
+    "list_knowledge_bases",
+    "ExcelToDBTool",
+    "IngestJobStatusTool"
 ]
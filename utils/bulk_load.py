@@ -0,0 +1,397 @@
+"""
+批量写入引擎
+
+把 DataFrame 分块高效写入 MySQL，代替 to_sql 默认的逐行 INSERT，可选三种策略：
+
+- executemany：按 ingest_batch_rows 行一批调用 executemany，pymysql 会把它改写成多行
+  INSERT ... VALUES (...), (...)，每批提交一次
+- transaction：同样使用多行 INSERT，但每个分块在一个事务中写入，分块失败时整体回滚
+- load_data：把分块写成临时 CSV，用 LOAD DATA LOCAL INFILE 导入，MySQL 最快的批量路径
+
+auto 优先使用 load_data，服务端或客户端不允许 LOCAL INFILE 时自动回退到 executemany，
+并记住该连接目标，之后不再尝试。LOCAL 导入隐含 IGNORE，类型转换失败只产生警告而不报错，
+因此每个分块导入后都检查警告，有警告时回滚该分块并报错，不静默写入截断或置空的值。
+
+指定主键列时按主键增量写入（upsert）：与上次导入相同的分块直接跳过，其余分块按行哈希
+只写入新增和变化的行，都以 INSERT ... ON DUPLICATE KEY UPDATE 落表：load_data 先把分块导入
+本连接的临时暂存表，再 INSERT ... SELECT 合并。不使用 LOAD DATA REPLACE，它会先删除再插入，
+重置文件中没有的列、重新分配自增 ID、触发级联删除，还可能一次删除多行。
+"""
+import itertools
+import os
+import tempfile
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence
+
+import pandas as pd
+
+from config import settings
+from utils.db_pool import DBTarget
+from utils.ingest_fingerprint import (
+    DeltaCounts, chunk_fingerprint, fetch_row_hashes, normalize_key, row_hashes, split_delta,
+)
+from utils.ingest_schema import ROW_HASH_COLUMN, UPSERT_KEY_NAME, TableSchema
+from utils.schema_catalog import schema_cache
+from utils.table_profile import quote_identifier
+
+LOAD_STRATEGIES = ("auto", "executemany", "transaction", "load_data")
+
+# upsert 时 LOAD DATA 的暂存表；临时表只对当前连接可见，每个 BulkLoader 独占一个连接
+_STAGE_TABLE = "`__bulk_load_stage`"
+
+# 服务端 / 客户端禁用 LOCAL INFILE 时的错误码
+_LOCAL_INFILE_ERRORS = {1148, 2068, 3948}
+
+# 已确认不支持 LOCAL INFILE 的连接目标
+_local_infile_disabled = set()
+_disabled_lock = threading.Lock()
+
+
+@dataclass
+class LoadStats:
+    """写入统计"""
+    strategy: str
+    rows: int = 0
+    chunks: int = 0
+    seconds: float = 0.0
+    source_rows: int = 0                    # 已读取的源数据行数（含跳过的行）
+    notes: List[str] = field(default_factory=list)
+    delta: Optional[DeltaCounts] = None     # 按主键增量写入时的新增 / 更新 / 跳过行数
+    chunk_hashes: List[str] = field(default_factory=list)
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.rows / self.seconds if self.seconds > 0 else 0.0
+
+    def summary(self) -> str:
+        text = f"写入策略 {self.strategy}，{self.chunks} 个分块，写入耗时 {self.seconds:.1f} 秒，约 {self.rows_per_sec:.0f} 行/秒"
+        if self.delta is not None:
+            text = f"{self.delta.summary()}；{text}"
+        return "；".join([text] + self.notes)
+
+
+def chunk_records(chunk: pd.DataFrame) -> List[tuple]:
+    """把分块转换为 DB-API 参数：NaN/NaT 转为 None，numpy 标量转为 Python 原生类型"""
+    values = chunk.astype(object).where(chunk.notna(), None)
+    return [
+        tuple(int(v) if isinstance(v, bool) else v for v in row)
+        for row in values.itertuples(index=False, name=None)
+    ]
+
+
+def _csv_field(value) -> str:
+    # 配合 FIELDS ENCLOSED BY '"' ESCAPED BY ''：未加引号的 NULL 读作 SQL NULL，引号内的双引号成对转义
+    if value is None:
+        return "NULL"
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+def _is_local_infile_error(error: Exception) -> bool:
+    return bool(error.args) and error.args[0] in _LOCAL_INFILE_ERRORS
+
+
+class BulkLoader:
+    """
+    在一个连接上把多个分块写入同一张表，用法：
+
+        with BulkLoader(engine, "orders", columns) as loader:
+            for chunk in chunks:
+                loader.write(chunk)
+        print(loader.stats.summary())
+    """
+
+    def __init__(self, engine, table: str, columns: List[str],
+                 strategy: str = settings.ingest_load_strategy,
+                 batch_rows: int = settings.ingest_batch_rows,
+                 upsert: bool = False):
+        if strategy not in LOAD_STRATEGIES:
+            raise ValueError(f"不支持的写入策略 '{strategy}'，可选: {', '.join(LOAD_STRATEGIES)}")
+        self.engine = engine
+        self.table = table
+        self.columns = list(columns)
+        self.batch_rows = max(1, batch_rows)
+        self.upsert = upsert
+        url = engine.url
+        self.target = DBTarget(url.host or "localhost", int(url.port or 3306), url.username or "", url.database or "")
+        if strategy == "auto":
+            with _disabled_lock:
+                strategy = "executemany" if self.target in _local_infile_disabled else "load_data"
+        self.stats = LoadStats(strategy=strategy)
+        self._connection = None
+        # 语句会经过 pymysql 的 % 参数格式化，标识符中的百分号需要转义
+        column_list = ", ".join(quote_identifier(c) for c in self.columns).replace("%", "%%")
+        quoted_table = quote_identifier(table).replace("%", "%%")
+        placeholders = ", ".join(["%s"] * len(self.columns))
+        self._insert_sql = f"INSERT INTO {quoted_table} ({column_list}) VALUES ({placeholders})"
+        # 与唯一键冲突的行改为更新；VALUES() 写法兼容 MySQL 5.7 和 8.0
+        updates = ", ".join(f"{quote_identifier(c)} = VALUES({quote_identifier(c)})" for c in self.columns)
+        if upsert:
+            self._insert_sql += f" ON DUPLICATE KEY UPDATE {updates}".replace("%", "%%")
+        self._load_sql = (
+            f"LOAD DATA LOCAL INFILE %s INTO TABLE {_STAGE_TABLE if upsert else quoted_table} CHARACTER SET utf8mb4 "
+            f"FIELDS TERMINATED BY ',' ENCLOSED BY '\"' ESCAPED BY '' LINES TERMINATED BY '\\n' ({column_list})"
+        )
+        # 以下语句不带参数，不经过 % 格式化
+        plain_columns = ", ".join(quote_identifier(c) for c in self.columns)
+        plain_table = quote_identifier(table)
+        # 暂存表只复制这几列的类型，不带索引和约束，分块内重复主键由合并时的 ON DUPLICATE KEY 处理（后者生效）；
+        # 导入过程中目标表的列可能被放宽（ALTER），每个分块都按目标表当前的列类型重建暂存表，
+        # 否则暂存表仍是旧类型，后续分块的值会被截断并产生警告
+        self._stage_sqls = [
+            f"DROP TEMPORARY TABLE IF EXISTS {_STAGE_TABLE}",
+            f"CREATE TEMPORARY TABLE {_STAGE_TABLE} SELECT {plain_columns} FROM {plain_table} WHERE FALSE",
+        ]
+        self._merge_sql = (f"INSERT INTO {plain_table} ({plain_columns}) SELECT {plain_columns} FROM {_STAGE_TABLE} "
+                           f"ON DUPLICATE KEY UPDATE {updates}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _connect(self):
+        if self._connection is None:
+            if self.stats.strategy == "load_data":
+                self._connection = self._local_infile_connection()
+            else:
+                # 从共享连接池借出，close() 时归还
+                self._connection = self.engine.raw_connection()
+        return self._connection
+
+    def _local_infile_connection(self):
+        # LOCAL INFILE 允许服务端读取客户端文件，只在批量导入专用的连接上开启，不污染共享连接池
+        import pymysql
+        url = self.engine.url
+        return pymysql.connect(
+            host=url.host or "localhost", port=int(url.port or 3306), user=url.username or "",
+            password=url.password or "", database=url.database, charset="utf8mb4",
+            local_infile=True, connect_timeout=settings.db_connect_timeout,
+        )
+
+    def write(self, chunk: pd.DataFrame) -> int:
+        """写入一个分块，返回写入行数"""
+        if chunk.empty:
+            return 0
+        records = chunk_records(chunk[self.columns])
+        started = time.monotonic()
+        if self.stats.strategy == "load_data":
+            try:
+                self._load_data(records)
+            except Exception as e:
+                if not _is_local_infile_error(e):
+                    raise
+                self._fallback(e)
+                self._insert(records, atomic=False)
+        else:
+            self._insert(records, atomic=self.stats.strategy == "transaction")
+        self.stats.seconds += time.monotonic() - started
+        self.stats.rows += len(records)
+        self.stats.chunks += 1
+        return len(records)
+
+    def _insert(self, records: List[tuple], atomic: bool):
+        connection = self._connect()
+        try:
+            with connection.cursor() as cursor:
+                for start in range(0, len(records), self.batch_rows):
+                    cursor.executemany(self._insert_sql, records[start:start + self.batch_rows])
+                    if not atomic:
+                        connection.commit()
+            if atomic:
+                connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+
+    def _load_data(self, records: List[tuple]):
+        connection = self._connect()
+        fd, path = tempfile.mkstemp(prefix="bulk_load_", suffix=".csv")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8", newline="") as f:
+                for record in records:
+                    f.write(",".join(_csv_field(v) for v in record))
+                    f.write("\n")
+            with connection.cursor() as cursor:
+                if self.upsert:
+                    for sql in self._stage_sqls:
+                        cursor.execute(sql)
+                cursor.execute(self._load_sql, (path,))
+                cursor.execute("SHOW WARNINGS")
+                warnings = cursor.fetchall()
+                if warnings:
+                    samples = "; ".join(str(w[-1]) for w in warnings[:3])
+                    raise ValueError(f"LOAD DATA 产生 {len(warnings)} 条警告（值被截断或置空），已回滚该分块: {samples}")
+                if self.upsert:
+                    cursor.execute(self._merge_sql)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            os.remove(path)
+
+    def _fallback(self, error: Exception):
+        with _disabled_lock:
+            _local_infile_disabled.add(self.target)
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        self.stats.strategy = "executemany"
+        self.stats.notes.append(f"服务端不允许 LOAD DATA LOCAL INFILE（{error.args[-1]}），已回退为 executemany 批量写入")
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def _execute_ddl(engine, statements: List[str]):
+    try:
+        with engine.begin() as conn:
+            for sql in statements:
+                # 列名来自用户文件，可能包含冒号、百分号等字符，不做任何参数解析直接交给驱动执行
+                conn.execution_options(no_parameters=True).exec_driver_sql(sql)
+    finally:
+        # 建表 / 改表后清除该库的表结构目录缓存，查询工具随后能看到新表和新的列类型
+        url = engine.url
+        schema_cache.invalidate(url.host, url.port or 3306, url.database)
+
+
+def create_table(engine, table: str, schema: TableSchema, index_columns: Optional[List[str]] = None,
+                 key_columns: Optional[List[str]] = None) -> bool:
+    """按显式表结构建表（含索引），返回是否为本次新建；表已存在时不做修改"""
+    from sqlalchemy import inspect
+
+    if inspect(engine).has_table(table):
+        return False
+    _execute_ddl(engine, [schema.create_sql(table, index_columns, key_columns)])
+    return True
+
+
+def existing_column_types(engine, table: str) -> Dict[str, str]:
+    """已存在表的列名 -> MySQL 列类型"""
+    from sqlalchemy import inspect
+
+    return {c["name"]: str(c["type"]) for c in inspect(engine).get_columns(table)}
+
+
+def prepare_upsert_table(engine, table: str, key_columns: List[str]) -> List[str]:
+    """
+    让已存在的表支持按主键增量写入：补充行哈希列，主键列上没有唯一键时新建。
+
+    Returns:
+        执行的 DDL 语句
+    """
+    from sqlalchemy import inspect
+
+    inspector = inspect(engine)
+    columns = {c["name"] for c in inspector.get_columns(table)}
+    missing = [name for name in key_columns if name not in columns]
+    if missing:
+        raise ValueError(f"表 '{table}' 中没有主键列: {', '.join(missing)}")
+    quoted_table = quote_identifier(table)
+    statements = []
+    if ROW_HASH_COLUMN not in columns:
+        statements.append(f"ALTER TABLE {quoted_table} ADD COLUMN {quote_identifier(ROW_HASH_COLUMN)} CHAR(16) NULL")
+    unique_sets = [set(index["column_names"]) for index in inspector.get_indexes(table) if index.get("unique")]
+    unique_sets.append(set(inspector.get_pk_constraint(table).get("constrained_columns") or []))
+    if set(key_columns) not in unique_sets:
+        keys = ", ".join(quote_identifier(name) for name in key_columns)
+        statements.append(f"ALTER TABLE {quoted_table} ADD UNIQUE KEY {quote_identifier(UPSERT_KEY_NAME)} ({keys})")
+    if statements:
+        try:
+            _execute_ddl(engine, statements)
+        except Exception as e:
+            raise ValueError(f"无法在表 '{table}' 的 {', '.join(key_columns)} 上建立唯一键"
+                             f"（表中可能已有重复数据，可先去重或导入到新表）: {e}") from e
+    return statements
+
+
+def _upsert_rows(loader: BulkLoader, schema: TableSchema, chunk: pd.DataFrame, key_columns: List[str],
+                 known_hash: Optional[str]) -> Optional[pd.DataFrame]:
+    """计算分块和逐行指纹，返回需要写入的行（附带行哈希列）；分块与上次导入一致时返回 None"""
+    stats = loader.stats
+    hashes = row_hashes(chunk)
+    fingerprint = chunk_fingerprint(list(chunk.columns), hashes)
+    stats.chunk_hashes.append(fingerprint)
+    if fingerprint == known_hash:
+        stats.delta.skipped += len(chunk)
+        return None
+    kinds = [schema.column(name).kind for name in key_columns]
+    keys = [
+        tuple(normalize_key(v, kind) for v, kind in zip(row, kinds))
+        for row in chunk[key_columns].itertuples(index=False, name=None)
+    ]
+    existing = fetch_row_hashes(loader._connect(), loader.table, key_columns, kinds, keys, loader.batch_rows)
+    positions, counts = split_delta(keys, hashes.tolist(), existing)
+    stats.delta.add(counts)
+    return chunk.iloc[positions].assign(**{ROW_HASH_COLUMN: hashes.iloc[positions].values})
+
+
+def load_chunks(engine, table: str, chunks, strategy: str = settings.ingest_load_strategy,
+                batch_rows: int = settings.ingest_batch_rows, on_chunk=None,
+                index_columns: Optional[List[str]] = None,
+                key_columns: Optional[List[str]] = None,
+                known_chunks: Sequence[str] = ()) -> Optional[LoadStats]:
+    """
+    把分块迭代器写入表中；没有任何数据时返回 None。
+
+    第一个分块作为样本推断一次表结构，表不存在时先按该结构建表和索引，
+    之后每个分块都按同一结构转换类型再写入。
+
+    Args:
+        on_chunk: 每处理完一个分块后的回调 fn(stats)，用于汇报进度
+        index_columns: 新建表时要建索引的列，为空时按列名和类型自动选择
+        key_columns: 主键列，非空时按主键增量写入，结果中的 delta 记录新增 / 更新 / 跳过行数
+        known_chunks: 上次导入同一数据源时的分块哈希，同位置哈希一致的分块直接跳过
+    """
+    chunks = iter(chunks)
+    first = next(chunks, None)
+    if first is None:
+        return None
+    schema = TableSchema.infer(first)
+    if key_columns:
+        schema.check_key_columns(key_columns)
+    created = create_table(engine, table, schema, index_columns, key_columns)
+    prepared = prepare_upsert_table(engine, table, key_columns) if key_columns and not created else []
+    # 写入已有的表时按表中实际的列类型转换，而不是按样本推断的类型
+    aligned = [] if created else schema.align(existing_column_types(engine, table))
+    nulled = rounded = missing_keys = 0
+    columns = [c.name for c in schema.columns] + ([ROW_HASH_COLUMN] if key_columns else [])
+    with BulkLoader(engine, table, columns, strategy, batch_rows, upsert=bool(key_columns)) as loader:
+        if created:
+            loader.stats.notes.append(f"已按推断的类型建表: {schema.describe()}")
+        if prepared:
+            loader.stats.notes.append(f"已为增量导入调整表结构: {'; '.join(prepared)}")
+        if aligned:
+            loader.stats.notes.append(f"已按表中的列类型转换: {'; '.join(aligned)}")
+        if key_columns:
+            loader.stats.delta = DeltaCounts()
+        for i, chunk in enumerate(itertools.chain([first], chunks)):
+            loader.stats.source_rows += len(chunk)
+            coerced = schema.coerce(chunk, table, allow_alter=created)
+            if coerced.alter_sqls:
+                _execute_ddl(engine, coerced.alter_sqls)
+                loader.stats.notes.append(f"已放宽列类型: {'; '.join(coerced.alter_sqls)}")
+            nulled += coerced.nulled
+            rounded += coerced.rounded
+            rows = coerced.chunk
+            if key_columns:
+                keyed = rows[key_columns].notna().all(axis=1)
+                missing_keys += int((~keyed).sum())
+                rows = _upsert_rows(loader, schema, rows[keyed], key_columns,
+                                    known_chunks[i] if i < len(known_chunks) else None)
+            if rows is not None:
+                loader.write(rows)
+            if on_chunk is not None:
+                on_chunk(loader.stats)
+        if nulled:
+            loader.stats.notes.append(f"有 {nulled} 个值无法转换为列类型，已写入 NULL")
+        if rounded:
+            loader.stats.notes.append(f"有 {rounded} 个小数写入整数列，已四舍五入")
+        if missing_keys:
+            loader.stats.notes.append(f"有 {missing_keys} 行的主键为空，未导入")
+    return loader.stats
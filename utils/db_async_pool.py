@@ -0,0 +1,170 @@
+"""
+异步数据库连接池注册表
+
+与 utils.db_pool 对应的异步版本，基于 aiomysql。
+aiomysql 的连接池绑定在创建它的事件循环上，因此注册表按 (事件循环, 连接目标) 缓存连接池，
+同样支持空闲淘汰和 LRU 上限。供 Tool_DBM 工具的 coroutine 路径使用，
+让 `langgraph dev` / server 下的并发会话在等待数据库时不阻塞事件循环。
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from config import settings
+from utils.db_pool import DBTarget, password_digest
+
+
+class _PoolEntry:
+    __slots__ = ("task", "password_digest", "last_used")
+
+    def __init__(self, task: "asyncio.Task", password_digest: str):
+        self.task = task
+        self.password_digest = password_digest
+        self.last_used = time.monotonic()
+
+
+class AsyncPoolRegistry:
+    """按事件循环和连接目标缓存 aiomysql 连接池"""
+
+    def __init__(
+        self,
+        max_pools: int = settings.db_pool_max_engines,
+        idle_timeout: float = settings.db_pool_idle_timeout,
+    ):
+        self.max_pools = max_pools
+        self.idle_timeout = idle_timeout
+        self._pools: "OrderedDict[tuple, _PoolEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    async def get_pool(self, host: str, port: int, user: str, password: str, database: str):
+        """获取（或创建）当前事件循环中指定连接目标的连接池"""
+        loop = asyncio.get_running_loop()
+        target = DBTarget(host, int(port), user, database)
+        key = (loop, target)
+        digest = password_digest(password)
+        stale = []
+        with self._lock:
+            stale.extend(self._evict_expired())
+            entry = self._pools.get(key)
+            if entry is not None and (entry.password_digest != digest or self._failed(entry.task)):
+                stale.append(self._pools.pop(key).task)
+                entry = None
+            if entry is None:
+                # 以 Task 形式创建，同一目标的并发请求会等待同一个连接池，而不是各建一个
+                entry = _PoolEntry(loop.create_task(self._create_pool(target, password)), digest)
+                self._pools[key] = entry
+                while len(self._pools) > self.max_pools:
+                    _, oldest = self._pools.popitem(last=False)
+                    stale.append(oldest.task)
+            else:
+                self._pools.move_to_end(key)
+            entry.last_used = time.monotonic()
+            task = entry.task
+        for old_task in stale:
+            await self._close_task(old_task)
+        return await task
+
+    @asynccontextmanager
+    async def acquire(self, host: str, port: int, user: str, password: str, database: str):
+        """从连接池借出一个连接，退出上下文时归还"""
+        pool = await self.get_pool(host, port, user, password, database)
+        async with pool.acquire() as connection:
+            try:
+                yield connection
+            finally:
+                # 与 SQLAlchemy 连接池的 reset-on-return 一致：归还前回滚未提交的事务，
+                # 否则 aiomysql 会直接关闭仍处于事务中的连接
+                if not connection.closed:
+                    await connection.rollback()
+
+    async def close_all(self):
+        """关闭当前事件循环中的所有连接池"""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            keys = [key for key in self._pools if key[0] is loop]
+            tasks = [self._pools.pop(key).task for key in keys]
+        for task in tasks:
+            await self._close_task(task)
+
+    def _evict_expired(self) -> list:
+        # 调用方需持有锁；淘汰空闲超时的连接池，以及事件循环已关闭的连接池
+        now = time.monotonic()
+        expired = [
+            key for key, entry in self._pools.items()
+            if key[0].is_closed() or now - entry.last_used > self.idle_timeout
+        ]
+        return [self._pools.pop(key).task for key in expired]
+
+    @staticmethod
+    def _failed(task: "asyncio.Task") -> bool:
+        return task.done() and (task.cancelled() or task.exception() is not None)
+
+    @staticmethod
+    async def _close_task(task: "asyncio.Task"):
+        if task.get_loop().is_closed() or task.get_loop() is not asyncio.get_running_loop():
+            return
+        try:
+            pool = await task
+        except Exception:
+            return
+        pool.close()
+        await pool.wait_closed()
+
+    @staticmethod
+    async def _create_pool(target: DBTarget, password: str):
+        import aiomysql
+        return await aiomysql.create_pool(
+            host=target.host,
+            port=target.port,
+            user=target.user,
+            password=password,
+            db=target.database,
+            minsize=1,
+            maxsize=settings.db_pool_size + settings.db_pool_max_overflow,
+            pool_recycle=settings.db_pool_recycle,
+            connect_timeout=settings.db_connect_timeout,
+        )
+
+
+# 全局异步连接池注册表
+async_pool_registry = AsyncPoolRegistry()
+
+
+def acquire_async_connection(host: str, port: int, user: str, password: str, database: str):
+    """
+    借出异步连接的快捷方法，用法：
+
+        async with acquire_async_connection(...) as connection:
+            ...
+    """
+    return async_pool_registry.acquire(host, port, user, password, database)
+
+
+async def arun_on_connections(
+    host: str, port: int, user: str, password: str, database: str,
+    jobs: Dict[Hashable, Callable[[Any], Awaitable[Any]]],
+    max_workers: int = settings.db_introspect_workers,
+) -> Tuple[Dict[Hashable, Any], Dict[Hashable, Exception]]:
+    """utils.db_pool.run_on_connections 的异步版本，jobs 为 async fn(cursor)，并发数由信号量限制"""
+    import aiomysql
+
+    semaphore = asyncio.Semaphore(max(1, max_workers))
+
+    async def _run(job):
+        async with semaphore:
+            async with acquire_async_connection(host, port, user, password, database) as connection:
+                async with connection.cursor(aiomysql.DictCursor) as cursor:
+                    return await job(cursor)
+
+    keys = list(jobs)
+    outcomes = await asyncio.gather(*(_run(jobs[key]) for key in keys), return_exceptions=True)
+    results, errors = {}, {}
+    for key, outcome in zip(keys, outcomes):
+        if isinstance(outcome, Exception):
+            errors[key] = outcome
+        else:
+            results[key] = outcome
+    return results, errors
@@ -0,0 +1,197 @@
+"""
+数据库连接池注册表
+
+进程级共享的 SQLAlchemy 引擎缓存，按 (host, port, user, database) 复用引擎及其连接池，
+避免每次工具调用都重新建立 TCP 连接和认证握手。
+
+- 每个引擎的连接池大小有上限，并开启 pre-ping 健康检查
+- 长时间未使用的引擎会被释放（空闲淘汰）
+- 缓存的连接目标数量有上限，超出时按 LRU 淘汰最久未使用的引擎
+"""
+import atexit
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, NamedTuple, Tuple
+
+from sqlalchemy import create_engine
+from sqlalchemy.engine import URL, Engine, make_url
+
+from config import settings
+
+
+class DBTarget(NamedTuple):
+    """连接目标（注册表的键）"""
+    host: str
+    port: int
+    user: str
+    database: str
+
+
+class _EngineEntry:
+    __slots__ = ("engine", "password_digest", "last_used")
+
+    def __init__(self, engine: Engine, password_digest: str):
+        self.engine = engine
+        self.password_digest = password_digest
+        self.last_used = time.monotonic()
+
+
+def password_digest(password: str) -> str:
+    # 只保存密码摘要，用于判断同一目标的凭据是否发生变化
+    return hashlib.sha256(password.encode("utf-8")).hexdigest()
+
+
+class EngineRegistry:
+    """线程安全的引擎注册表"""
+
+    def __init__(
+        self,
+        max_engines: int = settings.db_pool_max_engines,
+        idle_timeout: float = settings.db_pool_idle_timeout,
+    ):
+        self.max_engines = max_engines
+        self.idle_timeout = idle_timeout
+        self._engines: "OrderedDict[DBTarget, _EngineEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_engine(self, host: str, port: int, user: str, password: str, database: str) -> Engine:
+        """获取（或创建）指定连接目标的引擎"""
+        target = DBTarget(host, int(port), user, database)
+        digest = password_digest(password)
+        stale = []
+        with self._lock:
+            stale.extend(self._evict_idle())
+            entry = self._engines.get(target)
+            if entry is not None and entry.password_digest != digest:
+                # 密码变化，旧引擎作废
+                stale.append(self._engines.pop(target).engine)
+                entry = None
+            if entry is None:
+                entry = _EngineEntry(self._create_engine(target, password), digest)
+                self._engines[target] = entry
+                while len(self._engines) > self.max_engines:
+                    _, oldest = self._engines.popitem(last=False)
+                    stale.append(oldest.engine)
+            else:
+                self._engines.move_to_end(target)
+            entry.last_used = time.monotonic()
+            engine = entry.engine
+        # 在锁外释放引擎，避免 dispose 阻塞其他线程
+        for old_engine in stale:
+            old_engine.dispose()
+        return engine
+
+    def get_engine_from_uri(self, db_uri: str) -> Engine:
+        """根据数据库连接字符串获取引擎"""
+        url = make_url(db_uri)
+        return self.get_engine(
+            host=url.host or "localhost",
+            port=url.port or 3306,
+            user=url.username or "",
+            password=url.password or "",
+            database=url.database or "",
+        )
+
+    def dispose_all(self):
+        """释放所有引擎（进程退出时调用）"""
+        with self._lock:
+            entries = list(self._engines.values())
+            self._engines.clear()
+        for entry in entries:
+            entry.engine.dispose()
+
+    def stats(self) -> dict:
+        """返回各连接目标的连接池状态，便于排查"""
+        with self._lock:
+            return {
+                f"{t.user}@{t.host}:{t.port}/{t.database}": entry.engine.pool.status()
+                for t, entry in self._engines.items()
+            }
+
+    def _evict_idle(self) -> list:
+        now = time.monotonic()
+        expired = [
+            target for target, entry in self._engines.items()
+            if now - entry.last_used > self.idle_timeout
+        ]
+        return [self._engines.pop(target).engine for target in expired]
+
+    @staticmethod
+    def _create_engine(target: DBTarget, password: str) -> Engine:
+        db_uri = URL.create(
+            "mysql+pymysql",
+            username=target.user,
+            password=password,
+            host=target.host,
+            port=target.port,
+            database=target.database,
+        )
+        return create_engine(
+            db_uri,
+            echo=False,
+            pool_size=settings.db_pool_size,
+            max_overflow=settings.db_pool_max_overflow,
+            pool_timeout=settings.db_pool_timeout,
+            pool_recycle=settings.db_pool_recycle,
+            pool_pre_ping=True,
+            connect_args={"connect_timeout": settings.db_connect_timeout},
+        )
+
+
+# 全局注册表实例
+engine_registry = EngineRegistry()
+atexit.register(engine_registry.dispose_all)
+
+
+def get_engine(host: str, port: int, user: str, password: str, database: str) -> Engine:
+    """获取共享引擎的快捷方法"""
+    return engine_registry.get_engine(host, port, user, password, database)
+
+
+def get_raw_connection(host: str, port: int, user: str, password: str, database: str):
+    """
+    从连接池借出一个 DBAPI (pymysql) 连接。
+
+    返回的是连接池代理对象，调用 close() 会把连接归还到池中而不是真正断开。
+    """
+    return get_engine(host, port, user, password, database).raw_connection()
+
+
+def run_on_connections(
+    host: str, port: int, user: str, password: str, database: str,
+    jobs: Dict[Hashable, Callable[[Any], Any]],
+    max_workers: int = settings.db_introspect_workers,
+) -> Tuple[Dict[Hashable, Any], Dict[Hashable, Exception]]:
+    """
+    在有界线程池中并发执行一组互相独立的查询，每个任务在自己借出的连接上运行。
+
+    Args:
+        jobs: {任务键: fn(cursor) -> 结果}，cursor 为 DictCursor
+        max_workers: 最大并发数，不应超过连接池容量
+
+    Returns:
+        (成功结果, 失败异常)，单个任务失败不影响其他任务
+    """
+    import pymysql
+
+    def _run(job: Callable[[Any], Any]):
+        connection = get_raw_connection(host, port, user, password, database)
+        try:
+            with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+                return job(cursor)
+        finally:
+            connection.close()
+
+    results, errors = {}, {}
+    workers = max(1, min(max_workers, len(jobs)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="db-introspect") as executor:
+        futures = {key: executor.submit(_run, job) for key, job in jobs.items()}
+        for key, future in futures.items():
+            try:
+                results[key] = future.result()
+            except Exception as e:
+                errors[key] = e
+    return results, errors
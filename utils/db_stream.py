@@ -0,0 +1,233 @@
+"""
+流式查询模块
+
+基于 pymysql 的非缓冲服务端游标 (SSCursor) 逐行读取查询结果：
+- 行按元组读取，再按去重后的列名转换为字典；SSDictCursor 会把重复的列名（如 JOIN 两张表的 id）
+  改成 "表名.列名" 且可能互相覆盖，与 description 中的列名对不上
+- 只在内存中保留不超过行数/字节预算的预览数据
+- 其余行只计数，不驻留内存，避免大表 SELECT * 撑爆 LangGraph worker
+- 可选地把完整结果边读边写入本地 CSV / Parquet 文件，供 Agent 引用
+"""
+import csv
+import os
+import uuid
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence
+
+from config import settings
+from utils.ingest_reader import normalize_headers
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Parquet 按批写入的行数
+_PARQUET_BATCH_ROWS = 10000
+
+
+@dataclass
+class StreamResult:
+    """流式查询结果"""
+    columns: List[str] = field(default_factory=list)
+    rows: List[dict] = field(default_factory=list)   # 预算内的预览行
+    total_rows: int = 0                               # 结果集总行数
+    truncated: bool = False                           # 预览是否被截断
+    spill_path: Optional[str] = None                  # 完整结果文件路径
+    has_result_set: bool = True                       # 语句是否返回结果集（DML 为 False）
+    affected_rows: int = 0
+    notes: List[str] = field(default_factory=list)    # 附加说明（如查询被自动改写）
+
+
+def _row_size(row: dict) -> int:
+    """估算一行在文本输出中占用的字节数"""
+    return sum(len(str(key)) + len(str(value)) + 4 for key, value in row.items())
+
+
+def _spill_dir() -> str:
+    path = settings.db_spill_dir
+    if not os.path.isabs(path):
+        path = os.path.join(PROJECT_ROOT, path)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class _CSVSpill:
+    def __init__(self, path: str, columns: List[str]):
+        self.path = path
+        self._file = open(path, "w", newline="", encoding="utf-8-sig")
+        self._writer = csv.DictWriter(self._file, fieldnames=columns)
+        self._writer.writeheader()
+
+    def write(self, row: dict):
+        self._writer.writerow(row)
+
+    def close(self):
+        self._file.close()
+
+
+class _ParquetSpill:
+    def __init__(self, path: str, columns: List[str]):
+        import pyarrow  # noqa: F401  缺少 pyarrow 时在创建阶段就失败，便于回退到 CSV
+        self.path = path
+        self.columns = columns
+        self._batch = []
+        self._writer = None
+        self._schema = None
+
+    def write(self, row: dict):
+        self._batch.append(row)
+        if len(self._batch) >= _PARQUET_BATCH_ROWS:
+            self._flush()
+
+    def _flush(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if not self._batch:
+            return
+        if self._writer is None:
+            table = pa.Table.from_pylist(self._batch)
+            # 首批中全为 NULL 的列无法推断类型，统一按字符串处理
+            fields = [
+                pa.field(f.name, pa.string()) if pa.types.is_null(f.type) else f
+                for f in table.schema
+            ]
+            self._schema = pa.schema(fields)
+            self._writer = pq.ParquetWriter(self.path, self._schema)
+        table = pa.Table.from_pylist(self._batch, schema=self._schema)
+        self._writer.write_table(table)
+        self._batch = []
+
+    def close(self):
+        self._flush()
+        if self._writer is not None:
+            self._writer.close()
+        else:
+            # 空结果也生成一个只有列名的文件
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            schema = pa.schema([pa.field(c, pa.string()) for c in self.columns])
+            pq.write_table(schema.empty_table(), self.path)
+
+
+def _open_spill(spill_format: str, columns: List[str]):
+    """打开结果文件写入器，缺少 pyarrow 时 Parquet 回退为 CSV"""
+    base = os.path.join(_spill_dir(), f"query_{uuid.uuid4().hex[:12]}")
+    if spill_format == "parquet":
+        try:
+            return _ParquetSpill(base + ".parquet", columns)
+        except ImportError:
+            pass
+    return _CSVSpill(base + ".csv", columns)
+
+
+class StreamCollector:
+    """
+    按预算收集流式结果，同步和异步游标共用同一套截断与落盘逻辑。
+    """
+
+    def __init__(self, max_rows: int, max_bytes: int, spill_format: Optional[str] = None):
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.spill_format = spill_format
+        self.result = StreamResult()
+        self._spill = None
+        self._used_bytes = 0
+
+    def start(self, description, rowcount: int = 0):
+        """根据游标的 description 初始化列信息；无结果集时记录影响行数"""
+        if description is None:
+            self.result.has_result_set = False
+            self.result.affected_rows = max(rowcount, 0)
+            return
+        # 重复的列名依次加后缀（id, id_1），每列都有自己的键
+        self.result.columns = normalize_headers([desc[0] for desc in description])
+        if self.spill_format:
+            self._spill = _open_spill(self.spill_format, self.result.columns)
+
+    def add(self, values: Sequence):
+        """加入游标返回的一行（元组）"""
+        row = dict(zip(self.result.columns, values))
+        result = self.result
+        result.total_rows += 1
+        if self._spill is not None:
+            self._spill.write(row)
+        if result.truncated:
+            return
+        size = _row_size(row)
+        if len(result.rows) >= self.max_rows or self._used_bytes + size > self.max_bytes:
+            result.truncated = True
+            return
+        result.rows.append(row)
+        self._used_bytes += size
+
+    def finish(self) -> StreamResult:
+        if self._spill is not None:
+            self._spill.close()
+            self.result.spill_path = self._spill.path
+            self._spill = None
+        return self.result
+
+    def abort(self):
+        if self._spill is not None:
+            self._spill.close()
+            self._spill = None
+
+
+def stream_query(
+    connection,
+    query: str,
+    max_rows: int = settings.db_query_max_rows,
+    max_bytes: int = settings.db_query_max_bytes,
+    spill_format: Optional[str] = None,
+) -> StreamResult:
+    """
+    使用服务端游标执行查询，按预算截取预览并统计总行数。
+
+    Args:
+        connection: pymysql 连接（或连接池代理）
+        query: SQL 语句
+        max_rows: 预览最多保留的行数
+        max_bytes: 预览最多保留的字节数
+        spill_format: 'csv' / 'parquet'，为空时不落盘
+    """
+    import pymysql
+
+    collector = StreamCollector(max_rows, max_bytes, spill_format)
+    cursor = connection.cursor(pymysql.cursors.SSCursor)
+    try:
+        cursor.execute(query)
+        collector.start(cursor.description, cursor.rowcount)
+        if collector.result.has_result_set:
+            for row in cursor:
+                collector.add(row)
+        return collector.finish()
+    finally:
+        collector.abort()
+        # 关闭非缓冲游标时会读完剩余结果，连接才能安全归还到连接池
+        cursor.close()
+
+
+async def astream_query(
+    connection,
+    query: str,
+    max_rows: int = settings.db_query_max_rows,
+    max_bytes: int = settings.db_query_max_bytes,
+    spill_format: Optional[str] = None,
+) -> StreamResult:
+    """stream_query 的异步版本，connection 为 aiomysql 连接"""
+    import aiomysql
+
+    collector = StreamCollector(max_rows, max_bytes, spill_format)
+    cursor = await connection.cursor(aiomysql.SSCursor)
+    try:
+        await cursor.execute(query)
+        collector.start(cursor.description, cursor.rowcount)
+        if collector.result.has_result_set:
+            while True:
+                rows = await cursor.fetchmany(1000)
+                if not rows:
+                    break
+                for row in rows:
+                    collector.add(row)
+        return collector.finish()
+    finally:
+        collector.abort()
+        await cursor.close()
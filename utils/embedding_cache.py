@@ -0,0 +1,245 @@
+"""
+持久化嵌入缓存
+
+按 (模型, 用途, 规范化文本的哈希) 缓存嵌入向量，重建向量库和重复的检索问题都不再重复调用嵌入接口：
+
+- 每个模型一个目录：vectors.bin 是按行追加的定长向量数组（float16 或 float32），
+  index.txt 每行一个键，行号即向量在数组中的位置，meta.json 记录模型、维度和数据类型
+- 先追加向量再追加索引，写到一半中断时多出的向量没有索引指向，不会读到不完整的数据；
+  索引最后写了一半的行在加载时丢弃，之后从最后一个完整行之后写起，把它覆盖掉
+- 读取通过 np.memmap 按需加载，不把整个缓存读入内存
+- 多个进程可以共享同一缓存目录：写入时持有 .lock 文件的排他锁（fcntl.flock），先读入其他进程
+  追加的索引行再写；读取时未命中的键持有共享锁增量读入新行，其他进程刚写入的向量也能命中
+- 文档和查询分开统计命中率，用于观察重建和重复提问节省的接口调用
+"""
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from config import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """全角 / 半角统一（NFKC），空白字符合并为一个空格"""
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+
+def cache_key(kind: str, text: str) -> str:
+    # 同一文本作为文档和作为查询时的向量不同（DashScope 区分 text_type），键中包含用途
+    return hashlib.sha1(f"{kind}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def summary(self) -> str:
+        return f"命中 {self.hits} / {self.hits + self.misses}（{self.hit_rate:.0%}）"
+
+
+class EmbeddingCache:
+    """一个模型的磁盘向量缓存，线程安全，也可以由多个进程共享"""
+
+    def __init__(self, directory: str, model: str, dtype: str = settings.kb_embedding_cache_dtype):
+        safe_model = re.sub(r"[^\w.-]+", "_", model)
+        self.directory = os.path.join(directory, safe_model)
+        self.model = model
+        self.dtype = np.dtype(dtype)
+        self.dim: Optional[int] = None
+        self._index: Dict[str, int] = {}
+        self._rows = 0                  # 索引中完整的行数，即下一个向量的行号
+        self._index_offset = 0          # 索引文件中最后一个完整行之后的位置
+        self._vectors = None            # 只读 memmap，缓存增长后重新打开
+        self._lock = threading.Lock()
+        self._lock_file = None          # 持有跨进程文件锁时打开的 .lock 文件
+        with self._lock, self._file_lock(shared=True):
+            self._catch_up()
+
+    @property
+    def _meta_path(self) -> str:
+        return os.path.join(self.directory, "meta.json")
+
+    @property
+    def _data_path(self) -> str:
+        return os.path.join(self.directory, "vectors.bin")
+
+    @property
+    def _index_path(self) -> str:
+        return os.path.join(self.directory, "index.txt")
+
+    @contextmanager
+    def _file_lock(self, shared: bool = False):
+        """跨进程的文件锁，同一线程内可嵌套。调用方需持有 self._lock"""
+        if fcntl is None or self._lock_file is not None or (shared and not os.path.isdir(self.directory)):
+            yield
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, ".lock"), "a+b") as f:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            self._lock_file = f
+            try:
+                yield
+            finally:
+                # 关闭文件时释放锁
+                self._lock_file = None
+
+    def _catch_up(self):
+        """读入其他进程（或上次运行）追加的索引行。调用方需持有锁"""
+        if self.dim is None:
+            if not os.path.exists(self._meta_path):
+                return
+            with open(self._meta_path, encoding="utf-8") as f:
+                meta = json.load(f)
+            self.dim, self.dtype = meta["dim"], np.dtype(meta["dtype"])
+        if not os.path.exists(self._index_path) or os.path.getsize(self._index_path) <= self._index_offset:
+            return
+        rows = 0
+        if os.path.exists(self._data_path):
+            rows = os.path.getsize(self._data_path) // (self.dim * self.dtype.itemsize)
+        with open(self._index_path, "rb") as f:
+            f.seek(self._index_offset)
+            for line in f:
+                # 没有换行符的行是上次写到一半中断的，丢弃
+                if self._rows >= rows or not line.endswith(b"\n"):
+                    break
+                self._index[line.decode("ascii").strip()] = self._rows
+                self._rows += 1
+                self._index_offset += len(line)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def _reader(self):
+        # 调用方需持有锁
+        rows = self._rows
+        if self._vectors is None or len(self._vectors) < rows:
+            self._vectors = np.memmap(self._data_path, dtype=self.dtype, mode="r", shape=(rows, self.dim))
+        return self._vectors
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        with self._lock:
+            if any(key not in self._index for key in keys):
+                # 其他进程可能已写入这些键
+                with self._file_lock(shared=True):
+                    self._catch_up()
+            rows = {key: self._index[key] for key in keys if key in self._index}
+            if not rows:
+                return {}
+            vectors = self._reader()
+            # 复制出来，不持有 memmap 的引用，写入时可以关闭映射
+            return {key: np.array(vectors[row], dtype=np.float32) for key, row in rows.items()}
+
+    def put_many(self, keys: List[str], vectors: List[List[float]]):
+        if not keys:
+            return
+        array = np.asarray(vectors, dtype=np.float32)
+        if array.ndim != 2 or len(array) != len(keys):
+            raise ValueError(f"向量形状 {array.shape} 与 {len(keys)} 个键不匹配")
+        with self._lock, self._file_lock():
+            # 持有排他锁后先读入其他进程追加的行，再从文件末尾写起
+            self._catch_up()
+            if self.dim is not None and array.shape[1] != self.dim:
+                raise ValueError(f"向量维度 {array.shape[1]} 与缓存的维度 {self.dim} 不一致，"
+                                 f"模型 '{self.model}' 的输出维度可能已变化")
+            if self.dim is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self.dim = int(array.shape[1])
+                with open(self._meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"model": self.model, "dim": self.dim, "dtype": self.dtype.name}, f)
+            # 同一批中重复的键只写一次
+            new = list({key: vector for key, vector in zip(keys, array) if key not in self._index}.items())
+            if not new:
+                return
+            start = self._rows
+            self._vectors = None
+            # 先写向量再写索引，保证索引指向的向量都已完整写入
+            with open(self._data_path, "r+b" if os.path.exists(self._data_path) else "wb") as f:
+                f.seek(start * self.dim * self.dtype.itemsize)
+                f.write(np.stack([vector for _, vector in new]).astype(self.dtype).tobytes())
+            # 从最后一个完整行之后写起，覆盖上次中断时写了一半的行
+            lines = "".join(f"{key}\n" for key, _ in new).encode("ascii")
+            with open(self._index_path, "r+b" if os.path.exists(self._index_path) else "wb") as f:
+                f.seek(self._index_offset)
+                f.write(lines)
+                f.truncate()
+            self._index_offset += len(lines)
+            for offset, (key, _) in enumerate(new):
+                self._index[key] = start + offset
+            self._rows += len(new)
+
+
+class CachedEmbeddings(Embeddings):
+    """在任意 Embeddings 外面加一层持久化缓存，只把未命中的文本交给内层对象"""
+
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.document_stats = CacheStats()
+        self.query_stats = CacheStats()
+        self._stats_lock = threading.Lock()
+        self._counting = True
+
+    @contextmanager
+    def uncounted(self):
+        """其中的文档嵌入不计入命中率，用于写入向量库时复用刚预取的向量"""
+        self._counting = False
+        try:
+            yield
+        finally:
+            self._counting = True
+
+    def _count(self, stats: CacheStats, hits: int, misses: int):
+        if stats is self.document_stats and not self._counting:
+            return
+        with self._stats_lock:
+            stats.hits += hits
+            stats.misses += misses
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [cache_key("document", text) for text in texts]
+        found = self.cache.get_many(keys)
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        misses = sum(1 for key in keys if key not in found)
+        self._count(self.document_stats, len(keys) - misses, misses)
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            self.cache.put_many(list(missing), vectors)
+            found.update(zip(missing, (np.asarray(v, dtype=np.float32) for v in vectors)))
+        return [found[key].tolist() for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        key = cache_key("query", text)
+        found = self.cache.get_many([key])
+        if key in found:
+            self._count(self.query_stats, 1, 0)
+            return found[key].tolist()
+        self._count(self.query_stats, 0, 1)
+        vector = self.embeddings.embed_query(text)
+        self.cache.put_many([key], [vector])
+        return vector
+
+    def summary(self) -> str:
+        return (f"嵌入缓存（{len(self.cache)} 条）: 文档{self.document_stats.summary()}，"
+                f"查询{self.query_stats.summary()}")
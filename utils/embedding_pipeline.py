@@ -0,0 +1,169 @@
+"""
+批量并发嵌入流水线
+
+把大量文本切成固定大小的批次，在有界线程池中并发调用嵌入接口：
+
+- 令牌桶限流：所有工作线程共享一个令牌桶，每个请求消耗一个令牌，请求速率不超过接口配额
+- 逐批重试：单个批次失败时按指数退避（带随机抖动）重试，不会因为一次偶发错误中止整个构建
+- 断点续传：每完成一个批次就把向量写入检查点目录，构建中断后重新执行只嵌入尚未完成的文本，
+  全部写入向量库后由调用方清除检查点
+
+EmbeddingPipeline 实现 langchain 的 Embeddings 接口，可以直接替换原有的嵌入对象使用。
+"""
+import glob
+import hashlib
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from config import settings
+
+
+class TokenBucket:
+    """线程安全的令牌桶：按 rate 个/秒补充令牌，最多积攒 capacity 个"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0):
+        """取出令牌，令牌不足时阻塞等待；rate 不大于 0 表示不限流"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCheckpoint:
+    """已完成批次的向量，每个批次一个 .npz 文件（文本哈希 + 向量）"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def load(self) -> Dict[str, np.ndarray]:
+        vectors = {}
+        for path in glob.glob(os.path.join(self.directory, "*.npz")):
+            try:
+                with np.load(path) as data:
+                    vectors.update(zip(data["keys"].tolist(), data["vectors"]))
+            except Exception:
+                # 写到一半被中断的文件直接忽略，对应批次会重新嵌入
+                continue
+        return vectors
+
+    def save(self, keys: List[str], vectors: List[List[float]]):
+        os.makedirs(self.directory, exist_ok=True)
+        name = uuid.uuid4().hex
+        tmp = os.path.join(self.directory, f"{name}.tmp.npz")
+        np.savez(tmp, keys=np.array(keys), vectors=np.asarray(vectors, dtype=np.float32))
+        os.replace(tmp, os.path.join(self.directory, f"{name}.npz"))
+
+    def clear(self):
+        for path in glob.glob(os.path.join(self.directory, "*.npz")):
+            os.remove(path)
+
+
+class EmbeddingPipeline(Embeddings):
+    """
+    包装一个 Embeddings 对象，批量、并发、限流地计算文档向量。
+
+    Args:
+        embeddings: 实际调用接口的嵌入对象
+        checkpoint_dir: 检查点目录，为空时不保存进度
+    """
+
+    def __init__(self, embeddings: Embeddings,
+                 batch_size: int = settings.kb_embed_batch_size,
+                 max_workers: int = settings.kb_embed_workers,
+                 requests_per_sec: float = settings.kb_embed_requests_per_sec,
+                 max_retries: int = settings.kb_embed_max_retries,
+                 retry_backoff: float = settings.kb_embed_retry_backoff,
+                 checkpoint_dir: Optional[str] = None):
+        self.embeddings = embeddings
+        self.batch_size = max(1, batch_size)
+        self.max_workers = max(1, max_workers)
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.bucket = TokenBucket(requests_per_sec)
+        self.checkpoint = EmbeddingCheckpoint(checkpoint_dir) if checkpoint_dir else None
+        self.retries = 0
+        self._done: Optional[Dict[str, np.ndarray]] = None   # 本次构建中已完成的向量（含检查点中的）
+        self._lock = threading.Lock()
+
+    def _call(self, fn, *args):
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            try:
+                return fn(*args)
+            except Exception:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                delay = min(self.retry_backoff * 2 ** attempt, 30.0)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def _embed_batch(self, keys: List[str], texts: List[str]) -> List[List[float]]:
+        vectors = self._call(self.embeddings.embed_documents, texts)
+        if self.checkpoint is not None:
+            self.checkpoint.save(keys, vectors)
+        with self._lock:
+            self._done.update(zip(keys, vectors))
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        计算文档向量。可以先对全部文本调用一次做并发预取，
+        之后按文件写入向量库时再次调用会直接命中本次构建中已完成的向量。
+        """
+        keys = [text_key(text) for text in texts]
+        with self._lock:
+            if self._done is None:
+                self._done = self.checkpoint.load() if self.checkpoint is not None else {}
+            done = self._done
+        # 相同文本只嵌入一次，已完成的文本直接复用
+        pending = list(dict.fromkeys(key for key in keys if key not in done))
+        texts_by_key = dict(zip(keys, texts))
+        batches = [pending[i:i + self.batch_size] for i in range(0, len(pending), self.batch_size)]
+        if batches:
+            workers = min(self.max_workers, len(batches))
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embed") as executor:
+                futures = [
+                    executor.submit(self._embed_batch, batch, [texts_by_key[key] for key in batch])
+                    for batch in batches
+                ]
+                # 任一批次重试耗尽时抛出异常；已完成的批次保留在检查点中，下次从断点继续
+                for future in futures:
+                    future.result()
+        return [list(map(float, done[key])) for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._call(self.embeddings.embed_query, text)
+
+    def clear_checkpoint(self):
+        """向量全部写入向量库后调用，清除检查点和本次构建的向量"""
+        with self._lock:
+            self._done = None
+        if self.checkpoint is not None:
+            self.checkpoint.clear()
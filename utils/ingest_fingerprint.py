@@ -0,0 +1,180 @@
+"""
+导入指纹与增量写入模块
+
+同一个文件经常被修改少量内容后重新上传，为了让重复导入的代价只与变化量相关：
+
+- 文件指纹：整个文件内容的 SHA-256，与目标表、数据源一起记录在清单表中，文件未变化时整体跳过
+- 分块指纹：每个分块按表结构转换后计算逐行哈希，再合成分块哈希；与上次导入同位置的分块一致时跳过该分块
+- 行指纹：目标表中保存每行的哈希（_row_hash 列），按主键查出已有行的哈希，
+  只把新增和内容变化的行通过 INSERT ... ON DUPLICATE KEY UPDATE 写入
+
+清单表（默认 __ingest_manifest）建在目标数据库中，与数据放在一起，换一个客户端重新导入也能识别。
+"""
+import datetime
+import hashlib
+import json
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import pandas as pd
+
+from config import settings
+from utils.ingest_schema import ROW_HASH_COLUMN
+from utils.table_profile import quote_identifier
+
+_READ_BLOCK = 1024 * 1024
+
+
+def file_fingerprint(file_path: str) -> str:
+    """文件内容的 SHA-256，按块读取，不把整个文件载入内存"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(_READ_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def row_hashes(chunk: pd.DataFrame) -> pd.Series:
+    """逐行计算 64 位哈希（十六进制），向量化计算，与行索引无关"""
+    values = pd.util.hash_pandas_object(chunk, index=False)
+    return values.map(lambda v: f"{int(v):016x}")
+
+
+def chunk_fingerprint(columns: Sequence[str], hashes: pd.Series) -> str:
+    """由列名和逐行哈希合成分块哈希"""
+    digest = hashlib.sha1("\x1f".join(columns).encode("utf-8"))
+    digest.update("".join(hashes).encode("ascii"))
+    return digest.hexdigest()
+
+
+def normalize_key(value, kind: str):
+    """把主键值转换为可比较的形式，使文件中的值与数据库返回的值一致"""
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return None
+    if kind == "int":
+        return int(value)
+    if kind in ("float", "bool"):
+        return float(value)
+    if kind == "date":
+        return pd.Timestamp(value).date().isoformat()
+    if kind == "datetime":
+        return pd.Timestamp(value).isoformat()
+    return str(value)
+
+
+@dataclass
+class DeltaCounts:
+    """一次导入中按行统计的变化量"""
+    inserted: int = 0
+    updated: int = 0
+    skipped: int = 0
+
+    def add(self, other: "DeltaCounts"):
+        self.inserted += other.inserted
+        self.updated += other.updated
+        self.skipped += other.skipped
+
+    def summary(self) -> str:
+        return f"新增 {self.inserted} 行，更新 {self.updated} 行，未变化跳过 {self.skipped} 行"
+
+
+def split_delta(keys: List[tuple], hashes: List[str],
+                existing: Dict[tuple, str]) -> Tuple[List[int], DeltaCounts]:
+    """
+    按已有行的哈希把分块中的行分为新增 / 更新 / 未变化。
+
+    Returns:
+        (需要写入的行号, 统计)；同一分块中主键重复时只保留最后一行
+    """
+    last = {key: i for i, key in enumerate(keys)}
+    counts = DeltaCounts(skipped=len(keys) - len(last))
+    positions = []
+    for key, i in last.items():
+        previous = existing.get(key)
+        if previous is None:
+            counts.inserted += 1
+        elif previous != hashes[i]:
+            counts.updated += 1
+        else:
+            counts.skipped += 1
+            continue
+        positions.append(i)
+    positions.sort()
+    return positions, counts
+
+
+def fetch_row_hashes(connection, table: str, key_columns: List[str], kinds: List[str],
+                     keys: List[tuple], batch_rows: int = settings.ingest_batch_rows) -> Dict[tuple, str]:
+    """按主键批量查询目标表中已有行的哈希，返回 {规范化后的主键: 行哈希}"""
+    quoted_keys = ", ".join(quote_identifier(c) for c in key_columns).replace("%", "%%")
+    quoted_table = quote_identifier(table).replace("%", "%%")
+    row_marker = "(" + ", ".join(["%s"] * len(key_columns)) + ")"
+    existing = {}
+    with connection.cursor() as cursor:
+        for start in range(0, len(keys), batch_rows):
+            batch = keys[start:start + batch_rows]
+            sql = (f"SELECT {quoted_keys}, {quote_identifier(ROW_HASH_COLUMN)} FROM {quoted_table} "
+                   f"WHERE ({quoted_keys}) IN ({', '.join([row_marker] * len(batch))})")
+            cursor.execute(sql, [value for key in batch for value in key])
+            for row in cursor.fetchall():
+                key = tuple(normalize_key(v, kind) for v, kind in zip(row[:-1], kinds))
+                existing[key] = row[-1]
+    return existing
+
+
+@dataclass
+class SourceManifest:
+    """一个数据源上次成功导入到目标表时的指纹"""
+    file_hash: str
+    chunk_rows: int
+    key_columns: List[str] = field(default_factory=list)
+    chunk_hashes: List[str] = field(default_factory=list)
+    rows: int = 0
+
+    def reusable_chunks(self, chunk_rows: int, key_columns: Optional[List[str]]) -> List[str]:
+        """分块大小和主键都相同时，上次的分块哈希才能逐块比较"""
+        if chunk_rows != self.chunk_rows or list(key_columns or []) != self.key_columns:
+            return []
+        return self.chunk_hashes
+
+
+class IngestManifest:
+    """目标数据库中的导入清单表：(目标表, 数据源) -> 文件指纹和分块指纹"""
+
+    def __init__(self, engine, table: str = settings.ingest_manifest_table):
+        self.engine = engine
+        self.table = table
+
+    def _ensure(self, conn):
+        conn.exec_driver_sql(
+            f"CREATE TABLE IF NOT EXISTS {quote_identifier(self.table)} ("
+            "target_table VARCHAR(64) NOT NULL, source VARCHAR(255) NOT NULL, "
+            "file_hash CHAR(64) NOT NULL, chunk_rows INT NOT NULL, key_columns TEXT, "
+            "chunk_hashes MEDIUMTEXT, row_count BIGINT NOT NULL, imported_at DATETIME NOT NULL, "
+            "PRIMARY KEY (target_table, source)) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4"
+        )
+
+    def load(self, target_table: str, source: str) -> Optional[SourceManifest]:
+        from sqlalchemy import inspect
+
+        if not inspect(self.engine).has_table(self.table):
+            return None
+        with self.engine.connect() as conn:
+            row = conn.exec_driver_sql(
+                f"SELECT file_hash, chunk_rows, key_columns, chunk_hashes, row_count "
+                f"FROM {quote_identifier(self.table)} WHERE target_table = %s AND source = %s",
+                (target_table, source),
+            ).fetchone()
+        if row is None:
+            return None
+        return SourceManifest(row[0], int(row[1]), json.loads(row[2] or "[]"), json.loads(row[3] or "[]"), int(row[4]))
+
+    def save(self, target_table: str, source: str, manifest: SourceManifest):
+        with self.engine.begin() as conn:
+            self._ensure(conn)
+            conn.exec_driver_sql(
+                f"REPLACE INTO {quote_identifier(self.table)} (target_table, source, file_hash, chunk_rows, "
+                f"key_columns, chunk_hashes, row_count, imported_at) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
+                (target_table, source, manifest.file_hash, manifest.chunk_rows, json.dumps(manifest.key_columns),
+                 json.dumps(manifest.chunk_hashes), manifest.rows, datetime.datetime.now().replace(microsecond=0)),
+            )
@@ -0,0 +1,137 @@
+"""
+后台导入任务
+
+大文件导入在进程内的有界线程池中执行，导入工具提交任务后立即返回任务 ID，
+Agent 通过查询工具轮询进度（已处理行数、速率、预计剩余时间、错误），
+不会因为一次导入阻塞整个对话轮次或触发聊天界面的 HTTP 超时。
+"""
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+from config import settings
+
+PENDING, RUNNING, SUCCEEDED, FAILED = "pending", "running", "succeeded", "failed"
+STATUS_LABELS = {PENDING: "排队中", RUNNING: "运行中", SUCCEEDED: "已完成", FAILED: "失败"}
+
+
+@dataclass
+class IngestJob:
+    """一个导入任务的状态，由工作线程更新、查询工具读取"""
+    job_id: str
+    description: str
+    status: str = PENDING
+    total_rows: Optional[int] = None        # 预计总行数，未知时为空
+    rows: int = 0                           # 已处理行数（写入的和增量导入中跳过的）
+    submitted_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    message: str = ""                       # 完成时的结果说明
+    errors: List[str] = field(default_factory=list)
+
+    @property
+    def elapsed(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    @property
+    def rate(self) -> float:
+        return self.rows / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> Optional[float]:
+        """按当前速率估算的剩余秒数"""
+        if self.status != RUNNING or not self.total_rows or self.rate <= 0:
+            return None
+        return max(self.total_rows - self.rows, 0) / self.rate
+
+    def progress(self, rows: int):
+        self.rows = rows
+
+    def to_text(self) -> str:
+        lines = [f"任务 {self.job_id}（{self.description}）: {STATUS_LABELS[self.status]}"]
+        if self.status != PENDING:
+            written = f"已处理 {self.rows} 行"
+            if self.total_rows:
+                written += f" / 预计 {self.total_rows} 行（{min(self.rows / self.total_rows, 1.0):.0%}）"
+            lines.append(f"{written}，耗时 {self.elapsed:.1f} 秒，速率约 {self.rate:.0f} 行/秒")
+        if self.eta is not None:
+            lines.append(f"预计剩余 {self.eta:.0f} 秒")
+        if self.message:
+            lines.append(self.message)
+        if self.errors:
+            lines.append("错误: " + "；".join(self.errors))
+        return "\n".join(lines)
+
+
+class IngestJobManager:
+    """在有界线程池中执行导入任务，并保留最近的任务记录供查询"""
+
+    def __init__(self, max_workers: int = settings.ingest_job_workers,
+                 history: int = settings.ingest_job_history):
+        self.max_workers = max_workers
+        self.history = history
+        self._jobs: "OrderedDict[str, IngestJob]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # 第一次提交任务时才创建线程池，避免仅导入模块就启动线程
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="ingest-job")
+            return self._executor
+
+    def submit(self, description: str, fn: Callable[[IngestJob], str],
+               total_rows: Optional[int] = None) -> IngestJob:
+        """
+        提交任务并立即返回。
+
+        Args:
+            fn: 在工作线程中执行的 fn(job) -> 结果说明，通过 job.progress() 汇报进度
+            total_rows: 预计总行数，用于计算进度和剩余时间
+        """
+        job = IngestJob(job_id=uuid.uuid4().hex[:12], description=description, total_rows=total_rows)
+        with self._lock:
+            self._jobs[job.job_id] = job
+            self._prune()
+        self._get_executor().submit(self._run, job, fn)
+        return job
+
+    def _run(self, job: IngestJob, fn: Callable[[IngestJob], str]):
+        job.status = RUNNING
+        job.started_at = time.time()
+        try:
+            job.message = fn(job) or ""
+            job.status = SUCCEEDED
+        except Exception as e:
+            job.errors.append(f"{type(e).__name__}: {e}")
+            job.status = FAILED
+            if settings.debug:
+                traceback.print_exc()
+        finally:
+            job.finished_at = time.time()
+
+    def _prune(self):
+        # 调用方需持有锁；只淘汰已结束的任务
+        finished = [job_id for job_id, job in self._jobs.items() if job.status in (SUCCEEDED, FAILED)]
+        for job_id in finished[:max(len(self._jobs) - self.history, 0)]:
+            del self._jobs[job_id]
+
+    def get(self, job_id: str) -> Optional[IngestJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def recent(self, limit: int = 10) -> List[IngestJob]:
+        with self._lock:
+            return list(self._jobs.values())[-limit:][::-1]
+
+
+# 全局任务管理器
+ingest_jobs = IngestJobManager()
@@ -0,0 +1,218 @@
+"""
+流式数据文件读取模块
+
+以只读/迭代模式读取 Excel 工作表、CSV 和 Parquet 文件，按固定行数产出 DataFrame 分块：
+- openpyxl 的 read_only 模式边解析 XML 边产出行，不构建整本工作簿的对象树
+- CSV 使用 pandas 的分块读取，Parquet 通过 Arrow 按 RecordBatch 列式读取，不逐行构造对象
+- 调用方每拿到一个分块就写入数据库，峰值内存只与分块大小有关，与文件大小无关
+"""
+import os
+from dataclasses import dataclass
+from typing import Iterator, List, Optional, Sequence
+
+import pandas as pd
+
+from config import settings
+
+
+def normalize_headers(values: Sequence) -> List[str]:
+    """把表头行转换为合法且不重复的列名，空表头命名为 column_<序号>"""
+    headers, used, suffixes = [], set(), {}
+    for i, value in enumerate(values):
+        base = str(value).strip() if value is not None and str(value).strip() else f"column_{i + 1}"
+        name = base
+        # MySQL 列名不区分大小写；生成的名称也可能与后面的原始表头相同，一直递增到未被占用为止
+        while name.lower() in used:
+            suffixes[base] = suffixes.get(base, 0) + 1
+            name = f"{base}_{suffixes[base]}"
+        used.add(name.lower())
+        headers.append(name)
+    return headers
+
+
+def _is_blank(row: Sequence) -> bool:
+    return all(value is None or (isinstance(value, str) and not value.strip()) for value in row)
+
+
+def _trim_header(row: Sequence) -> Sequence:
+    # read_only 模式下工作表的维度信息可能偏大，表头末尾会带出大量空单元格
+    end = len(row)
+    while end and _is_blank(row[end - 1:end]):
+        end -= 1
+    return row[:end]
+
+
+def typed_chunk(rows: List[Sequence], columns: List[str]) -> pd.DataFrame:
+    """把一批原始行转换为 DataFrame，并把 object 列推断为数值 / 日期等具体类型"""
+    width = len(columns)
+    normalized = [tuple(row[:width]) + (None,) * (width - len(row)) for row in rows]
+    return pd.DataFrame.from_records(normalized, columns=columns).infer_objects()
+
+
+EXCEL_EXTENSIONS = (".xlsx", ".xlsm", ".xls")
+CSV_EXTENSIONS = (".csv", ".txt", ".tsv")
+PARQUET_EXTENSIONS = (".parquet", ".pq")
+
+
+def file_kind(file_path: str) -> str:
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext in EXCEL_EXTENSIONS:
+        return "excel"
+    if ext in CSV_EXTENSIONS:
+        return "csv"
+    if ext in PARQUET_EXTENSIONS:
+        return "parquet"
+    raise ValueError(f"不支持的文件类型 '{ext}'，支持 Excel（{', '.join(EXCEL_EXTENSIONS)}）、"
+                     f"CSV（{', '.join(CSV_EXTENSIONS)}）和 Parquet（{', '.join(PARQUET_EXTENSIONS)}）")
+
+
+def excel_sheet_names(file_path: str) -> List[str]:
+    if os.path.splitext(file_path)[1].lower() == ".xls":
+        return list(pd.ExcelFile(file_path).sheet_names)
+    from openpyxl import load_workbook
+    workbook = load_workbook(file_path, read_only=True)
+    try:
+        return list(workbook.sheetnames)
+    finally:
+        workbook.close()
+
+
+def estimate_excel_rows(file_path: str, sheet_name: Optional[str] = None) -> Optional[int]:
+    """根据工作表的维度信息估算数据行数（不含表头），只读取文件头部；无法估算时返回 None"""
+    if os.path.splitext(file_path)[1].lower() == ".xls":
+        return None
+    from openpyxl import load_workbook
+    try:
+        workbook = load_workbook(file_path, read_only=True, data_only=True)
+    except Exception:
+        return None
+    try:
+        sheet = workbook[sheet_name] if sheet_name else workbook.worksheets[0]
+        return max(sheet.max_row - 1, 0) if sheet.max_row else None
+    finally:
+        workbook.close()
+
+
+def iter_excel_chunks(
+    file_path: str,
+    sheet_name: Optional[str] = None,
+    chunk_rows: int = settings.ingest_chunk_rows,
+) -> Iterator[pd.DataFrame]:
+    """
+    逐块读取 Excel 工作表，第一行作为表头。
+
+    Args:
+        file_path: .xlsx / .xlsm 文件路径（.xls 由 pandas 整表读取后再分块）
+        sheet_name: 工作表名，为空时读取第一个工作表
+        chunk_rows: 每个分块的行数
+    """
+    if os.path.splitext(file_path)[1].lower() == ".xls":
+        # openpyxl 不支持旧版 .xls，只能整表读取
+        df = pd.read_excel(file_path, sheet_name=sheet_name or 0, header=0)
+        df.columns = normalize_headers(df.columns)
+        for start in range(0, len(df), chunk_rows):
+            yield df.iloc[start:start + chunk_rows].reset_index(drop=True)
+        return
+
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        sheet = workbook[sheet_name] if sheet_name else workbook.worksheets[0]
+        rows = sheet.iter_rows(values_only=True)
+        columns = None
+        for header in rows:
+            if not _is_blank(header):
+                columns = normalize_headers(_trim_header(header))
+                break
+        if columns is None:
+            return
+        batch = []
+        for row in rows:
+            if _is_blank(row):
+                continue
+            batch.append(row)
+            if len(batch) >= chunk_rows:
+                yield typed_chunk(batch, columns)
+                batch = []
+        if batch:
+            yield typed_chunk(batch, columns)
+    finally:
+        # read_only 模式会保持文件句柄打开，必须显式关闭
+        workbook.close()
+
+
+def _detect_encoding(file_path: str) -> str:
+    # 中文环境下的 CSV 常见 GBK 编码，按文件开头判断
+    with open(file_path, "rb") as f:
+        head = f.read(64 * 1024)
+    try:
+        head.decode("utf-8")
+        return "utf-8-sig"
+    except UnicodeDecodeError as e:
+        # 截断在多字节字符中间的情况仍视为 UTF-8
+        return "utf-8-sig" if e.start >= len(head) - 3 else "gb18030"
+
+
+def iter_csv_chunks(file_path: str, chunk_rows: int = settings.ingest_chunk_rows) -> Iterator[pd.DataFrame]:
+    """分块读取 CSV / TSV 文件，第一行作为表头"""
+    sep = "\t" if os.path.splitext(file_path)[1].lower() == ".tsv" else ","
+    reader = pd.read_csv(file_path, sep=sep, chunksize=chunk_rows, encoding=_detect_encoding(file_path))
+    with reader:
+        for chunk in reader:
+            chunk.columns = normalize_headers(chunk.columns)
+            yield chunk
+
+
+def iter_parquet_chunks(file_path: str, chunk_rows: int = settings.ingest_chunk_rows) -> Iterator[pd.DataFrame]:
+    """按 RecordBatch 读取 Parquet 文件，列式转换为 DataFrame"""
+    import pyarrow.parquet as pq
+
+    parquet = pq.ParquetFile(file_path)
+    try:
+        columns = normalize_headers(parquet.schema_arrow.names)
+        for batch in parquet.iter_batches(batch_size=chunk_rows):
+            chunk = batch.to_pandas()
+            chunk.columns = columns
+            yield chunk
+    finally:
+        parquet.close()
+
+
+@dataclass
+class IngestSource:
+    """一个待导入的数据源：CSV / Parquet 文件，或 Excel 中的一个工作表"""
+    file_path: str
+    kind: str
+    sheet_name: Optional[str] = None
+
+    @property
+    def label(self) -> str:
+        name = os.path.basename(self.file_path)
+        return f"{name}[{self.sheet_name}]" if self.sheet_name else name
+
+    def estimate_rows(self) -> Optional[int]:
+        if self.kind == "excel":
+            return estimate_excel_rows(self.file_path, self.sheet_name)
+        if self.kind == "parquet":
+            import pyarrow.parquet as pq
+            return pq.ParquetFile(self.file_path).metadata.num_rows
+        return None
+
+    def chunks(self, chunk_rows: int = settings.ingest_chunk_rows) -> Iterator[pd.DataFrame]:
+        if self.kind == "excel":
+            return iter_excel_chunks(self.file_path, self.sheet_name, chunk_rows)
+        if self.kind == "parquet":
+            return iter_parquet_chunks(self.file_path, chunk_rows)
+        return iter_csv_chunks(self.file_path, chunk_rows)
+
+
+def list_sources(file_path: str, all_sheets: bool = False) -> List[IngestSource]:
+    """列出文件中的数据源；Excel 默认只取第一个工作表，all_sheets 为真时取全部工作表"""
+    kind = file_kind(file_path)
+    if kind != "excel":
+        return [IngestSource(file_path, kind)]
+    sheets = excel_sheet_names(file_path)
+    if not all_sheets:
+        sheets = sheets[:1]
+    return [IngestSource(file_path, kind, sheet) for sheet in sheets]
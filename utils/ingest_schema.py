@@ -0,0 +1,246 @@
+"""
+导入表结构推断模块
+
+只用第一个分块（样本）推断一次列类型，生成显式的 CREATE TABLE 语句，在写入数据之前建好表和索引；
+之后的每个分块都按这份表结构转换类型，而不是每块各自依赖 pandas 的默认推断：
+
+- 整数 -> BIGINT，小数 -> DOUBLE，布尔 -> TINYINT(1)，日期 -> DATE / DATETIME，
+  文本按样本中的最大长度选择 VARCHAR(255) / TEXT / MEDIUMTEXT
+- 后续分块中出现样本之外的值时自动放宽列类型（整数列出现小数 -> DOUBLE，文本超长 -> TEXT），
+  无法转换的值写入 NULL 并计数
+- 写入已存在的表时按表中实际的列类型转换，不修改表结构；整数列中的小数四舍五入并计数
+"""
+import re
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+from config import settings
+from utils.table_profile import quote_identifier
+
+# VARCHAR(255) 在 utf8mb4 下占用的最大字节数，以及 InnoDB 单行的上限
+_VARCHAR_BYTES = 255 * 4 + 2
+_ROW_BYTES_LIMIT = 60000
+_TEXT_LIMIT = 16383          # TEXT 可容纳的 utf8mb4 字符数
+_LEADING_ZERO = re.compile(r"^[+-]?0\d")
+ROW_HASH_COLUMN = "_row_hash"       # 增量导入时保存每行内容哈希的列
+UPSERT_KEY_NAME = "uk_ingest_key"   # 增量导入时按主键列建的唯一键
+_INDEX_NAME_PATTERN = re.compile(r"(^id$|_id$|^id_|编号$|代码$|编码$)", re.I)
+_SQL_TYPES = {
+    "int": "BIGINT", "float": "DOUBLE", "bool": "TINYINT(1)", "date": "DATE", "datetime": "DATETIME",
+    "varchar": "VARCHAR(255)", "text": "TEXT", "mediumtext": "MEDIUMTEXT",
+}
+# MySQL 列类型（去掉长度等参数）对应的转换类别
+_KIND_BY_SQL_TYPE = {
+    **dict.fromkeys(["tinyint", "smallint", "mediumint", "int", "integer", "bigint", "year"], "int"),
+    **dict.fromkeys(["float", "double", "real", "decimal", "numeric"], "float"),
+    "date": "date", **dict.fromkeys(["datetime", "timestamp"], "datetime"),
+    **dict.fromkeys(["char", "varchar"], "varchar"), **dict.fromkeys(["tinytext", "text"], "text"),
+    **dict.fromkeys(["mediumtext", "longtext"], "mediumtext"),
+}
+
+
+@dataclass
+class ColumnSpec:
+    name: str
+    kind: str                # int / float / bool / date / datetime / varchar / text / mediumtext
+
+    @property
+    def sql_type(self) -> str:
+        return _SQL_TYPES[self.kind]
+
+
+@dataclass
+class CoerceResult:
+    """一个分块按表结构转换后的结果"""
+    chunk: pd.DataFrame
+    alter_sqls: List[str] = field(default_factory=list)   # 需要在写入前执行的放宽列类型语句
+    nulled: int = 0                                        # 无法转换而写入 NULL 的值个数
+    rounded: int = 0                                       # 写入整数列时被四舍五入的小数个数
+
+
+def _to_text(value) -> str:
+    # 被 pandas 读成浮点数的整数（如 5.0）按整数形式保存
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def kind_from_sql_type(sql_type: str) -> Optional[str]:
+    """MySQL 列类型（如 INTEGER(11)、TINYINT(1)、VARCHAR(50)）对应的转换类别，不认识的类型返回 None"""
+    text = sql_type.strip().lower()
+    if text.startswith("tinyint(1)"):
+        return "bool"
+    return _KIND_BY_SQL_TYPE.get(re.split(r"[\s(]", text, maxsplit=1)[0])
+
+
+def _text_kind(max_length: int) -> str:
+    if max_length <= 255:
+        return "varchar"
+    return "text" if max_length <= _TEXT_LIMIT else "mediumtext"
+
+
+def _infer_kind(series: pd.Series) -> str:
+    values = series.dropna()
+    if pd.api.types.is_bool_dtype(series):
+        return "bool"
+    if pd.api.types.is_integer_dtype(series):
+        return "int"
+    if pd.api.types.is_float_dtype(series):
+        # 含缺失值的整数列会被 pandas 读成 float
+        return "int" if len(values) and (values == values.round()).all() else "float"
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return "date" if len(values) and (values == values.dt.normalize()).all() else "datetime"
+    if len(values) == 0:
+        return "varchar"
+    if values.map(lambda v: isinstance(v, bool)).all():
+        return "bool"
+    text = values.astype(str)
+    numeric = pd.to_numeric(values, errors="coerce")
+    # 带前导零的编号（如 "001"）按文本保存，避免丢失前导零
+    if numeric.notna().all() and not text.str.match(_LEADING_ZERO).any():
+        return "int" if (numeric == numeric.round()).all() else "float"
+    # 文本与样本长度相比留出一倍余量，减少后续分块触发放宽
+    return _text_kind(int(text.str.len().max()) * 2)
+
+
+class TableSchema:
+    """由样本推断出的导入表结构"""
+
+    def __init__(self, columns: List[ColumnSpec]):
+        self.columns = columns
+        self._fit_row_size()
+
+    @classmethod
+    def infer(cls, sample: pd.DataFrame) -> "TableSchema":
+        return cls([ColumnSpec(str(name), _infer_kind(sample[name])) for name in sample.columns])
+
+    def _fit_row_size(self):
+        # VARCHAR 计入 InnoDB 行大小上限，列很多时把靠后的文本列改为 TEXT
+        used = 0
+        for col in self.columns:
+            if col.kind == "varchar":
+                used += _VARCHAR_BYTES
+                if used > _ROW_BYTES_LIMIT:
+                    col.kind = "text"
+
+    def column(self, name: str) -> Optional[ColumnSpec]:
+        for col in self.columns:
+            if col.name == name:
+                return col
+        return None
+
+    def default_index_columns(self) -> List[str]:
+        """自动建索引的列：ID / 编号类列优先，其次是日期列"""
+        keys = [c.name for c in self.columns if _INDEX_NAME_PATTERN.search(c.name) and c.kind in ("int", "varchar")]
+        dates = [c.name for c in self.columns if c.kind in ("date", "datetime")]
+        return (keys + dates)[:settings.ingest_auto_index_max]
+
+    def check_key_columns(self, key_columns: List[str]):
+        """校验增量导入的主键列：必须存在，且不能是只能建前缀索引的 TEXT 列"""
+        for name in key_columns:
+            col = self.column(name)
+            if col is None:
+                raise ValueError(f"主键列 '{name}' 不在导入数据的列中")
+            if col.kind in ("text", "mediumtext"):
+                raise ValueError(f"主键列 '{name}' 是长文本列，不能作为唯一键")
+
+    def create_sql(self, table: str, index_columns: Optional[List[str]] = None,
+                   key_columns: Optional[List[str]] = None) -> str:
+        """
+        生成建表语句。
+
+        Args:
+            index_columns: 要建普通索引的列，为空时自动选择
+            key_columns: 增量导入的主键列，非空时额外建唯一键和行哈希列
+        """
+        if index_columns is None:
+            index_columns = self.default_index_columns()
+        lines = [f"  {quote_identifier(c.name)} {c.sql_type} NULL" for c in self.columns]
+        if key_columns:
+            self.check_key_columns(key_columns)
+            lines.append(f"  {quote_identifier(ROW_HASH_COLUMN)} CHAR(16) NULL")
+            # 唯一键的第一列已经可以走索引，不再重复建普通索引
+            index_columns = [name for name in index_columns if name != key_columns[0]]
+        for name in index_columns:
+            col = self.column(name)
+            if col is None:
+                raise ValueError(f"索引列 '{name}' 不在导入数据的列中")
+            # TEXT 列只能建前缀索引
+            prefix = "(191)" if col.kind in ("text", "mediumtext") else ""
+            index_name = quote_identifier(f"idx_{name}"[:64])
+            lines.append(f"  KEY {index_name} ({quote_identifier(name)}{prefix})")
+        if key_columns:
+            keys = ", ".join(quote_identifier(name) for name in key_columns)
+            lines.append(f"  UNIQUE KEY {quote_identifier(UPSERT_KEY_NAME)} ({keys})")
+        body = ",\n".join(lines)
+        return f"CREATE TABLE IF NOT EXISTS {quote_identifier(table)} (\n{body}\n) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4"
+
+    def align(self, sql_types: Dict[str, str]) -> List[str]:
+        """
+        按已存在表中的实际列类型调整各列的转换类别。
+
+        Args:
+            sql_types: 列名 -> MySQL 列类型
+
+        Returns:
+            类别有变化的列，格式为 "列名 推断类型 -> 表中类型"
+        """
+        changed = []
+        for col in self.columns:
+            kind = kind_from_sql_type(sql_types[col.name]) if col.name in sql_types else None
+            if kind is not None and kind != col.kind:
+                changed.append(f"{col.name} {col.sql_type} -> {sql_types[col.name]}")
+                col.kind = kind
+        return changed
+
+    def describe(self) -> str:
+        return ", ".join(f"{c.name} {c.sql_type}" for c in self.columns)
+
+    def _widen(self, table: str, col: ColumnSpec, kind: str, result: CoerceResult):
+        col.kind = kind
+        result.alter_sqls.append(
+            f"ALTER TABLE {quote_identifier(table)} MODIFY {quote_identifier(col.name)} {col.sql_type} NULL"
+        )
+
+    def coerce(self, chunk: pd.DataFrame, table: str, allow_alter: bool = True) -> CoerceResult:
+        """
+        按表结构转换分块的列类型。
+
+        Args:
+            table: 目标表名，用于生成放宽列类型的 ALTER 语句
+            allow_alter: 表不是本次导入创建的时不修改表结构，整数列中的小数四舍五入并计入 rounded，
+                超长文本交给 MySQL 处理
+        """
+        result = CoerceResult(chunk=chunk.copy())
+        data = result.chunk
+        for col in self.columns:
+            if col.name not in data.columns:
+                data[col.name] = None
+                continue
+            series = data[col.name]
+            present = series.notna()
+            if col.kind in ("int", "float", "bool"):
+                converted = pd.to_numeric(series, errors="coerce")
+                if col.kind == "int":
+                    fractional = int((converted.notna() & (converted != converted.round())).sum())
+                    if fractional and allow_alter:
+                        self._widen(table, col, "float", result)
+                    else:
+                        result.rounded += fractional
+                if col.kind == "int":
+                    converted = converted.round().astype("Int64")
+            elif col.kind in ("date", "datetime"):
+                converted = pd.to_datetime(series, errors="coerce", format="mixed")
+            else:
+                converted = series.map(_to_text).where(present, None)
+                longest = int(converted.dropna().str.len().max()) if present.any() else 0
+                needed = _text_kind(longest)
+                order = ["varchar", "text", "mediumtext"]
+                if allow_alter and order.index(needed) > order.index(col.kind):
+                    self._widen(table, col, needed, result)
+            result.nulled += int((present & converted.isna()).sum())
+            data[col.name] = converted
+        result.chunk = data[[c.name for c in self.columns]]
+        return result
@@ -0,0 +1,147 @@
+"""
+知识库 BM25 倒排索引与混合检索
+
+卷烟营销资料中有大量精确的产品编码和名称，稠密向量对这类字面匹配召回较差，
+这里在向量库旁边维护一份本地倒排索引，检索时与向量结果做倒数排名融合（RRF）：
+
+- 中文分词优先使用 jieba 的搜索引擎模式；未安装 jieba 时退化为汉字单字 + 相邻二字组合
+- 字母数字串（产品编码、型号等）整体作为一个词，带连字符的编码同时拆出各段
+- 索引随向量库增量维护：写入 / 删除分片时同步增删，刷新结束后整体保存为 JSON
+- 融合只依赖排名，不需要把 BM25 分数和向量相似度归一化到同一量纲
+"""
+import json
+import math
+import os
+import re
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+from config import settings
+
+try:
+    import jieba
+except ImportError:  # 可选依赖
+    jieba = None
+
+_CODE = re.compile(r"[A-Za-z0-9]+(?:[-_./][A-Za-z0-9]+)*")
+_CJK = re.compile(r"[一-鿿]+")
+_STOPWORDS = frozenset("的 了 和 与 及 或 是 在 对 为 中 等 有 也 就 都 而 被 把 这 那 之 其 吗 呢 吧 啊".split())
+
+
+def _cjk_terms(run: str) -> List[str]:
+    if jieba is not None:
+        return [w for w in jieba.lcut_for_search(run) if w.strip()]
+    # 没有分词器时用单字和二字组合，二字组合保留了大部分词语的区分度
+    return list(run) + [run[i:i + 2] for i in range(len(run) - 1)]
+
+
+def tokenize(text: str) -> List[str]:
+    """把中英文混合文本切分为检索词"""
+    terms = []
+    for match in _CODE.finditer(text):
+        code = match.group().lower()
+        terms.append(code)
+        parts = re.split(r"[-_./]", code)
+        if len(parts) > 1:
+            terms.extend(part for part in parts if part)
+    for run in _CJK.findall(text):
+        terms.extend(term for term in _cjk_terms(run) if term not in _STOPWORDS)
+    return terms
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[str]], k: int = settings.kb_rrf_k) -> List[Tuple[str, float]]:
+    """倒数排名融合：score(d) = Σ 1 / (k + rank)，rank 从 1 开始"""
+    scores: Dict[str, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] += 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class BM25Index:
+    """分片 ID -> 词频的倒排索引，支持增量增删"""
+
+    def __init__(self, k1: float = settings.kb_bm25_k1, b: float = settings.kb_bm25_b):
+        self.k1 = k1
+        self.b = b
+        self.doc_terms: Dict[str, Dict[str, int]] = {}
+        self.doc_lengths: Dict[str, int] = {}
+        self.postings: Dict[str, Dict[str, int]] = defaultdict(dict)
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.doc_terms)
+
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self.doc_terms
+
+    def copy(self) -> "BM25Index":
+        """复制一份可独立修改的索引（各文档的词频不会被原地修改，可以共享）"""
+        clone = BM25Index(self.k1, self.b)
+        clone.doc_terms = dict(self.doc_terms)
+        clone.doc_lengths = dict(self.doc_lengths)
+        clone.postings = defaultdict(dict, {term: dict(posting) for term, posting in self.postings.items()})
+        clone.total_length = self.total_length
+        return clone
+
+    def _add_terms(self, doc_id: str, terms: Dict[str, int]):
+        self.remove([doc_id])
+        self.doc_terms[doc_id] = terms
+        length = sum(terms.values())
+        self.doc_lengths[doc_id] = length
+        self.total_length += length
+        for term, count in terms.items():
+            self.postings[term][doc_id] = count
+
+    def add(self, ids: Sequence[str], texts: Sequence[str]):
+        for doc_id, text in zip(ids, texts):
+            self._add_terms(doc_id, dict(Counter(tokenize(text))))
+
+    def remove(self, ids: Iterable[str]):
+        for doc_id in ids:
+            terms = self.doc_terms.pop(doc_id, None)
+            if terms is None:
+                continue
+            self.total_length -= self.doc_lengths.pop(doc_id)
+            for term in terms:
+                posting = self.postings[term]
+                posting.pop(doc_id, None)
+                if not posting:
+                    del self.postings[term]
+
+    def search(self, query: str, k: int) -> List[Tuple[str, float]]:
+        if not self.doc_terms:
+            return []
+        n = len(self.doc_terms)
+        avg_length = self.total_length / n or 1.0
+        scores: Dict[str, float] = defaultdict(float)
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_id, tf in posting.items():
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_id] / avg_length)
+                scores[doc_id] += idf * tf * (self.k1 + 1) / (tf + norm)
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def save(self, path: str):
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"tokenizer": "jieba" if jieba is not None else "bigram", "docs": self.doc_terms},
+                      f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        """加载索引；文件不存在或分词方式与当前环境不一致时返回空索引，由调用方重建"""
+        index = cls()
+        if not os.path.exists(path):
+            return index
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("tokenizer") != ("jieba" if jieba is not None else "bigram"):
+            return index
+        for doc_id, terms in data["docs"].items():
+            index._add_terms(doc_id, terms)
+        return index
@@ -0,0 +1,157 @@
+"""
+知识库检索结果的重排与上下文组装
+
+直接拼接 top_k 个分片时，相邻分片之间有 chunk_overlap 的重复文本，相似的分片也会挤占名额。
+检索后在本地做三步处理，不额外调用大模型：
+
+- 多取候选（kb_mmr_fetch_k），用 MMR 在相关度和多样性之间取舍选出 top_k 个；
+  相关度取融合排名（保留 BM25 召回的结果），分片间相似度一次算出完整的余弦相似度矩阵
+- 同一来源中相邻（chunk_index 连续）或文本首尾重叠的分片合并为一段，去掉重叠部分
+- 按 token 预算组装上下文，放不下的段落在句子边界处截断
+"""
+import re
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+from langchain_core.documents import Document
+
+from config import settings
+from utils.result_format import estimate_tokens
+
+_SENTENCE_END = re.compile(r"[。！？!?；;\n]|\.\s")
+_MIN_OVERLAP = 10
+_MIN_TRUNCATED_TOKENS = 50
+
+
+def mmr_select(vectors: np.ndarray, k: int, lambda_mult: float = settings.kb_mmr_lambda,
+               relevance: Optional[np.ndarray] = None) -> List[int]:
+    """
+    最大边际相关（MMR）选择。
+
+    Args:
+        vectors: 候选向量，按相关度从高到低排列
+        k: 选出的数量
+        lambda_mult: 相关度权重，1 表示不考虑多样性
+        relevance: 各候选的相关度；默认按排名线性递减
+
+    Returns:
+        选中候选的下标，按选中顺序排列
+    """
+    n = len(vectors)
+    k = min(k, n)
+    if k <= 0:
+        return []
+    if relevance is None:
+        relevance = 1.0 - np.arange(n) / n
+    unit = np.asarray(vectors, dtype=np.float32)
+    unit = unit / np.maximum(np.linalg.norm(unit, axis=1, keepdims=True), 1e-12)
+    similarity = unit @ unit.T
+    max_similarity = np.zeros(n, dtype=np.float32)
+    available = np.ones(n, dtype=bool)
+    selected = []
+    for _ in range(k):
+        scores = np.where(available, lambda_mult * relevance - (1 - lambda_mult) * max_similarity, -np.inf)
+        pick = int(np.argmax(scores))
+        selected.append(pick)
+        available[pick] = False
+        np.maximum(max_similarity, similarity[pick], out=max_similarity)
+    return selected
+
+
+def _overlap(head: str, tail: str, limit: int) -> int:
+    """head 的结尾与 tail 的开头重合的最大长度"""
+    for size in range(min(limit, len(head), len(tail)), _MIN_OVERLAP - 1, -1):
+        if head.endswith(tail[:size]):
+            return size
+    return 0
+
+
+def _join(head: str, tail: str, limit: int) -> str:
+    size = _overlap(head, tail, limit)
+    return head + tail[size:] if size else f"{head}\n{tail}"
+
+
+class _Passage:
+    """合并后的一段文本，rank 为其中最靠前的分片名次"""
+
+    def __init__(self, doc: Document, rank: int):
+        self.source = doc.metadata.get("source", "未知")
+        self.first = self.last = doc.metadata.get("chunk_index")
+        self.text = doc.page_content
+        self.rank = rank
+        self.metadata = {key: value for key, value in doc.metadata.items() if key not in ("chunk_id", "chunk_index")}
+
+    def attach(self, doc: Document, limit: int) -> bool:
+        """doc 与本段相邻或首尾重叠时并入，返回是否并入"""
+        text, index = doc.page_content, doc.metadata.get("chunk_index")
+        if text in self.text:
+            return True
+        if index is not None and self.first is not None:
+            if index == self.last + 1:
+                self.text, self.last = _join(self.text, text, limit), index
+                return True
+            if index == self.first - 1:
+                self.text, self.first = _join(text, self.text, limit), index
+                return True
+            return False
+        # 旧分片没有序号，只能按文本首尾重叠判断是否相邻
+        if _overlap(self.text, text, limit):
+            self.text = _join(self.text, text, limit)
+            return True
+        if _overlap(text, self.text, limit):
+            self.text = _join(text, self.text, limit)
+            return True
+        return False
+
+
+def merge_adjacent(docs: Sequence[Document], overlap_limit: int = settings.kb_chunk_overlap * 2) -> List[Document]:
+    """合并同一来源中相邻或重叠的分片，结果按其中最靠前的分片名次排列"""
+    by_source: Dict[str, List[_Passage]] = {}
+    # 同一来源的分片按文档中的顺序处理，连续的几段才能逐个接上
+    ordered = sorted(enumerate(docs), key=lambda item: (str(item[1].metadata.get("source", "")),
+                                                         item[1].metadata.get("chunk_index", -1), item[0]))
+    for rank, doc in ordered:
+        passages = by_source.setdefault(doc.metadata.get("source", "未知"), [])
+        for passage in passages:
+            if passage.attach(doc, overlap_limit):
+                passage.rank = min(passage.rank, rank)
+                break
+        else:
+            passages.append(_Passage(doc, rank))
+    merged = sorted((p for passages in by_source.values() for p in passages), key=lambda p: p.rank)
+    return [Document(page_content=p.text, metadata=p.metadata) for p in merged]
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    """截断到 max_tokens 以内，尽量停在句子结尾"""
+    low, high = 0, len(text)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    cut = text[:low]
+    ends = [m.end() for m in _SENTENCE_END.finditer(cut)]
+    if ends and ends[-1] > len(cut) // 2:
+        cut = cut[:ends[-1]]
+    return cut.rstrip() + "……"
+
+
+def assemble_context(docs: Sequence[Document], max_tokens: int = settings.kb_context_max_tokens) -> str:
+    """按顺序拼接段落直到用完 token 预算；第一段总会保留（必要时截断）"""
+    separator = "\n\n---\n\n"
+    blocks, used = [], 0
+    for i, doc in enumerate(docs):
+        header = f"文档 {i + 1}:\n"
+        footer = f"\n来源: {doc.metadata.get('source', '未知')}"
+        cost = estimate_tokens(header + doc.page_content + footer) + (estimate_tokens(separator) if blocks else 0)
+        if used + cost <= max_tokens:
+            blocks.append(header + doc.page_content + footer)
+            used += cost
+            continue
+        remaining = max_tokens - used - (cost - estimate_tokens(doc.page_content))
+        if remaining >= _MIN_TRUNCATED_TOKENS or not blocks:
+            blocks.append(header + _truncate(doc.page_content, max(remaining, _MIN_TRUNCATED_TOKENS)) + footer)
+        break
+    return separator.join(blocks)
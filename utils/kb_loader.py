@@ -0,0 +1,80 @@
+"""
+知识库文档并行加载
+
+PDF 等文档的解析是 CPU 密集的单线程任务，逐个加载时大量文档要花几分钟才能开始嵌入：
+
+- 文件只在刷新时扫描一次（见 utils.kb_manifest），这里只负责解析给定的文件列表
+- 解析在进程池中进行，进程数默认等于本进程可用的 CPU 核数（遵守 CPU 亲和性 / 容器限制），绕开 GIL
+- 工作进程用 spawn 方式启动：刷新在带锁的后台线程中进行，fork 会把其他线程持有的锁一并复制，
+  子进程可能因此死锁
+- 按完成顺序逐个产出解析结果，调用方可以边解析边切分、嵌入
+- 单个文件解析失败只影响该文件，异常作为结果产出，由调用方汇报
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterator, List, Sequence, Tuple, Union
+
+from config import settings
+
+
+def _loader_class(path: str):
+    # 在工作进程中才导入 langchain 的加载器
+    from langchain_community.document_loaders import Docx2txtLoader, PyPDFLoader, TextLoader
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".pdf":
+        return PyPDFLoader
+    if ext == ".docx":
+        return Docx2txtLoader
+    if ext in (".txt", ".md"):
+        return lambda file_path: TextLoader(file_path, encoding="utf-8")
+    raise ValueError(f"不支持的文档类型 '{ext}'")
+
+
+def load_file(path: str) -> List:
+    """解析单个文档，返回 langchain Document 列表"""
+    return _loader_class(path)(path).load()
+
+
+def _available_cpus() -> int:
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # macOS / Windows 没有 sched_getaffinity
+        return os.cpu_count() or 1
+
+
+def load_workers(file_count: int) -> int:
+    workers = settings.kb_load_workers or _available_cpus()
+    return max(1, min(workers, file_count))
+
+
+def iter_loaded(root: str, rel_paths: Sequence[str]) -> Iterator[Tuple[str, Union[List, Exception]]]:
+    """
+    并行解析文档，按完成顺序产出 (相对路径, Document 列表或异常)。
+
+    只有一个文件或只允许一个工作进程时在当前进程中解析，省去启动进程池的开销。
+    """
+    if not rel_paths:
+        return
+    workers = load_workers(len(rel_paths))
+    if workers == 1:
+        for rel in rel_paths:
+            try:
+                yield rel, load_file(os.path.join(root, rel))
+            except Exception as e:
+                yield rel, e
+        return
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {executor.submit(load_file, os.path.join(root, rel)): rel for rel in rel_paths}
+        try:
+            for future in as_completed(futures):
+                try:
+                    yield futures[future], future.result()
+                except Exception as e:
+                    yield futures[future], e
+        finally:
+            # 调用方提前停止（例如嵌入接口持续失败）时，不再解析剩下的文件
+            for future in futures:
+                future.cancel()
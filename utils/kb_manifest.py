@@ -0,0 +1,119 @@
+"""
+知识库增量索引清单
+
+记录每个已索引文件的 (相对路径, 大小, 修改时间, 内容哈希) 以及它在向量库中的分片 ID，
+刷新知识库时与文档目录对比，只处理有变化的文件：
+
+- 大小和修改时间都没变的文件直接视为未变化，不读取内容
+- 大小或修改时间变化的文件再计算内容哈希，哈希一致（例如只是被重新保存）时也视为未变化
+- 新增 / 修改的文件重新切分和嵌入，修改 / 删除的文件按清单中的分片 ID 从向量库中删除
+"""
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List
+
+KB_EXTENSIONS = (".pdf", ".txt", ".md", ".docx")
+_READ_BLOCK = 1024 * 1024
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(_READ_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_id(rel_path: str, sha256: str, index: int) -> str:
+    """分片 ID 由路径、内容哈希和序号决定；内容变化后 ID 随之变化，新旧分片不会冲突"""
+    return hashlib.sha1(f"{rel_path}\0{sha256}\0{index}".encode("utf-8")).hexdigest()
+
+
+@dataclass
+class FileEntry:
+    """一个文件的状态；chunk_ids 为空表示尚未写入向量库"""
+    size: int
+    mtime: float
+    sha256: str
+    chunk_ids: List[str] = field(default_factory=list)
+
+
+@dataclass
+class ManifestDiff:
+    """文档目录相对清单的变化，文件均为相对文档目录的路径"""
+    added: List[str] = field(default_factory=list)
+    modified: List[str] = field(default_factory=list)
+    deleted: List[str] = field(default_factory=list)
+    unchanged: List[str] = field(default_factory=list)
+    files: Dict[str, FileEntry] = field(default_factory=dict)   # 新增 / 修改文件的当前状态
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.added or self.modified or self.deleted)
+
+    def summary(self) -> str:
+        return (f"新增 {len(self.added)} 个文件，修改 {len(self.modified)} 个，"
+                f"删除 {len(self.deleted)} 个，未变化 {len(self.unchanged)} 个")
+
+
+def scan_documents(root: str, extensions=KB_EXTENSIONS) -> Dict[str, os.stat_result]:
+    """列出文档目录下支持的文件，返回 {相对路径: stat}，路径统一使用 / 分隔"""
+    found = {}
+    if not os.path.isdir(root):
+        return found
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            if os.path.splitext(name)[1].lower() in extensions:
+                path = os.path.join(dirpath, name)
+                found[os.path.relpath(path, root).replace(os.sep, "/")] = os.stat(path)
+    return found
+
+
+class KBManifest:
+    """保存在向量库目录中的 JSON 清单"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, FileEntry] = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.entries = {rel: FileEntry(**entry) for rel, entry in json.load(f).get("files", {}).items()}
+
+    def save(self):
+        # 先写临时文件再替换，刷新中途失败不会留下损坏的清单
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"files": {rel: asdict(entry) for rel, entry in sorted(self.entries.items())}},
+                      f, ensure_ascii=False, indent=1)
+        os.replace(tmp, self.path)
+
+    @property
+    def version(self) -> str:
+        """已索引内容的版本：由各文件的内容哈希得出，任何文件新增、修改或删除后都会变化"""
+        digest = hashlib.sha1()
+        for rel, entry in sorted(self.entries.items()):
+            if entry.chunk_ids:
+                digest.update(f"{rel}\0{entry.sha256}\n".encode("utf-8"))
+        return digest.hexdigest()
+
+    def diff(self, root: str) -> ManifestDiff:
+        result = ManifestDiff()
+        current = scan_documents(root)
+        for rel, stat in sorted(current.items()):
+            entry = self.entries.get(rel)
+            if entry is not None and entry.size == stat.st_size and entry.mtime == stat.st_mtime:
+                result.unchanged.append(rel)
+                continue
+            sha256 = file_sha256(os.path.join(root, rel))
+            if entry is not None and entry.sha256 == sha256:
+                # 内容未变，只更新修改时间，下次不必再计算哈希
+                entry.size, entry.mtime = stat.st_size, stat.st_mtime
+                result.unchanged.append(rel)
+                continue
+            result.files[rel] = FileEntry(stat.st_size, stat.st_mtime, sha256)
+            (result.added if entry is None else result.modified).append(rel)
+        result.deleted = sorted(set(self.entries) - set(current))
+        return result
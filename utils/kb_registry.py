@@ -0,0 +1,128 @@
+"""
+多知识库（集合）注册与内存管理
+
+文档根目录下的每个子目录是一个独立的知识库，各自有向量库、索引清单和 BM25 索引：
+
+- 知识库在第一次被检索时才加载，同一知识库的并发首次请求只加载一次
+- 已加载的知识库按 LRU 保留，数量超过 kb_max_loaded_collections 或总占用超过
+  kb_max_loaded_mb 时淘汰最久未使用的；占用按向量库目录的大小估算
+- 淘汰时调用 on_evict 释放知识库持有的资源（例如 chromadb 在类级别按路径缓存的客户端，
+  不显式释放时淘汰并不能回收内存）
+"""
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from config import settings
+
+_COLLECTION_NAME = re.compile(r"^[\w-]+$")
+
+
+def list_collections(root: str) -> List[str]:
+    """文档根目录下的知识库名称（子目录名）"""
+    if not os.path.isdir(root):
+        return []
+    return sorted(name for name in os.listdir(root)
+                  if _COLLECTION_NAME.match(name) and os.path.isdir(os.path.join(root, name)))
+
+
+def directory_size(path: str) -> int:
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+
+class CollectionCache:
+    """已加载知识库的 LRU 缓存，线程安全"""
+
+    def __init__(self, max_loaded: int = settings.kb_max_loaded_collections,
+                 max_bytes: int = settings.kb_max_loaded_mb * 1024 * 1024,
+                 on_evict: Optional[Callable[[str, Any], None]] = None):
+        self.max_loaded = max_loaded
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self._entries: "OrderedDict[str, Tuple[Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._name_locks: Dict[str, threading.Lock] = {}
+        self._stats = {"hits": 0, "loads": 0, "evictions": 0}
+
+    def name_lock(self, name: str) -> threading.Lock:
+        """单个知识库的加载 / 刷新锁"""
+        with self._lock:
+            return self._name_locks.setdefault(name, threading.Lock())
+
+    def peek(self, name: str) -> Optional[Any]:
+        """取已加载的知识库，不影响 LRU 顺序和统计"""
+        with self._lock:
+            entry = self._entries.get(name)
+            return entry[0] if entry is not None else None
+
+    def get(self, name: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                return None
+            self._entries.move_to_end(name)
+            self._stats["hits"] += 1
+            return entry[0]
+
+    def get_or_load(self, name: str, loader: Callable[[], Optional[Tuple[Any, int]]]) -> Optional[Any]:
+        """
+        返回已加载的知识库，未加载时调用 loader（双重检查加锁，同一知识库只加载一次）。
+
+        Args:
+            loader: 返回 (知识库, 占用字节数)；返回 None 表示知识库为空，不缓存
+        """
+        value = self.get(name)
+        if value is not None:
+            return value
+        with self.name_lock(name):
+            value = self.peek(name)
+            if value is not None:
+                return value
+            loaded = loader()
+            if loaded is None:
+                return None
+            self.put(name, *loaded)
+            with self._lock:
+                self._stats["loads"] += 1
+            return loaded[0]
+
+    def put(self, name: str, value: Any, size: int):
+        """加入或替换一个知识库，然后按上限淘汰其他最久未使用的知识库"""
+        evicted = []
+        with self._lock:
+            self._entries[name] = (value, size)
+            self._entries.move_to_end(name)
+            while len(self._entries) > 1 and (
+                    len(self._entries) > self.max_loaded
+                    or (self.max_bytes > 0 and sum(s for _, s in self._entries.values()) > self.max_bytes)):
+                evicted.append(self._entries.popitem(last=False))
+                self._stats["evictions"] += 1
+        # 释放资源可能较慢，不在锁内进行
+        for evicted_name, (evicted_value, _) in evicted:
+            print(f"知识库 '{evicted_name}' 已从内存中淘汰")
+            if self.on_evict is not None:
+                self.on_evict(evicted_name, evicted_value)
+
+    def discard(self, name: str):
+        with self._lock:
+            self._entries.pop(name, None)
+
+    def loaded(self) -> List[str]:
+        with self._lock:
+            return list(self._entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["loaded"] = len(self._entries)
+            stats["loaded_bytes"] = sum(size for _, size in self._entries.values())
+        return stats
@@ -0,0 +1,466 @@
+"""
+基于 NumPy 内存映射的知识库向量索引
+
+语料规模不大时，Chroma 的 SQLite + HNSW 带来的启动时间和常驻内存都不划算。
+这里提供一个可替换 Chroma 的向量库实现（settings.kb_vector_backend = "numpy"）：
+
+- 向量按行追加到 vectors.bin，float16 直接存储，int8 按行对称量化并在 scales.bin 中记录缩放系数；
+  写入前归一化，内积即余弦相似度
+- records.jsonl 每行记录一个分片的 ID、正文和元数据，行号即向量在矩阵中的位置；
+  先写向量再写记录，中断时多出的向量没有记录指向，下次写入会覆盖
+- 删除只在 tombstones.txt 中追加行号（墓碑），删除比例过高时由 optimize() 压缩重写
+- 检索时以分块矩阵乘法计算精确 top-k；分片数达到 kb_ivf_min_rows 后由 optimize() 构建
+  IVF 倒排分区（球面 k-means），只扫描与查询最接近的 kb_ivf_nprobe 个分区和之后追加的行
+- 向量矩阵以只读 np.memmap 打开，多个工作进程共享操作系统页缓存中的同一份数据；
+  每次检索前按文件大小增量读取其他进程追加的记录和墓碑
+- 跨进程用 .lock 文件加锁（fcntl.flock）：追加、删除和压缩持有排他锁，读取同步时持有共享锁。
+  压缩替换文件期间存在 .compacting 标记，读取方看到标记或读取过程中文件被替换时重新加载并重试
+  （没有 fcntl 的平台靠这一检查）；压缩中途退出时由下一个取得排他锁的进程完成替换
+"""
+import json
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from config import settings
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+_BLOCK_ROWS = 65536
+_KMEANS_ITERATIONS = 10
+_SYNC_RETRIES = 5
+_SYNC_RETRY_DELAY = 0.05
+_COMPACTING = ".compacting"
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms == 0, 1.0, norms)
+
+
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """按行对称量化，返回 (int8 矩阵, float32 缩放系数)"""
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales = np.where(scales == 0, 1.0, scales).astype(np.float32)
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales
+
+
+def spherical_kmeans(vectors: np.ndarray, clusters: int, iterations: int = _KMEANS_ITERATIONS,
+                     seed: int = 0) -> np.ndarray:
+    """在单位向量上做 k-means（以内积为相似度），返回归一化的聚类中心"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        empty = np.bincount(assign, minlength=clusters) == 0
+        # 空簇重新取一个随机样本作为中心
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()))]
+        centroids = _normalize(sums)
+    return centroids.astype(np.float32)
+
+
+class NumpyVectorStore(VectorStore):
+    """实现 Tool_RAG 用到的 Chroma 接口：add_documents / delete / get / similarity_search"""
+
+    def __init__(self, directory: str, embedding_function: Embeddings,
+                 dtype: str = settings.kb_vector_dtype):
+        if np.dtype(dtype) not in (np.float16, np.int8):
+            raise ValueError(f"不支持的向量存储类型 '{dtype}'，可选 float16 / int8")
+        self.directory = directory
+        self._embedding = embedding_function
+        self.dtype = np.dtype(dtype)
+        self.dim: Optional[int] = None
+        self._lock = threading.RLock()
+        self._lock_file = None          # 当前持有的跨进程锁文件，嵌套加锁时复用
+        self._reset()
+        self._load_meta()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def _reset(self):
+        self._records: List[Tuple[str, str, dict]] = []
+        self._row_of: Dict[str, int] = {}
+        self._alive = np.zeros(0, dtype=bool)
+        self._records_offset = 0
+        self._records_inode = None
+        self._tombstones_offset = 0
+        self._vectors = None
+        self._scales = None
+        self._ivf = None
+        self._ivf_mtime = None
+
+    def _load_meta(self):
+        if os.path.exists(self._path("meta.json")):
+            with open(self._path("meta.json"), encoding="utf-8") as f:
+                meta = json.load(f)
+            self.dim, self.dtype = meta["dim"], np.dtype(meta["dtype"])
+
+    @contextmanager
+    def _file_lock(self, shared: bool = False):
+        """跨进程的文件锁，同一线程内可嵌套。调用方需持有 self._lock"""
+        if fcntl is None or self._lock_file is not None or (shared and not os.path.isdir(self.directory)):
+            yield
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(".lock"), "a+b") as f:
+            fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            self._lock_file = f
+            if not shared and os.path.exists(self._path(_COMPACTING)):
+                self._finish_compaction()
+            try:
+                yield
+            finally:
+                # 关闭文件时释放锁
+                self._lock_file = None
+
+    # ---------- 读取：从文件增量同步内存状态 ----------
+
+    def _sync(self):
+        """
+        读取前同步内存状态并打开向量矩阵。调用方需持有 self._lock。
+
+        其他进程正在压缩时 vectors.bin 与 records.jsonl 可能暂时对不上（内存映射长度超出文件、
+        记录解析失败、读取过程中文件被替换），此时丢弃内存状态重新加载，多次仍失败才抛出异常。
+        """
+        marker = self._path(_COMPACTING)
+        for attempt in range(_SYNC_RETRIES):
+            try:
+                with self._file_lock(shared=True):
+                    if os.path.exists(marker):
+                        raise ValueError("向量索引正在压缩")
+                    self._catch_up()
+                    if self._records:
+                        self._matrix()
+                    records = self._path("records.jsonl")
+                    if os.path.exists(marker) or (self._records and os.stat(records).st_ino != self._records_inode):
+                        raise ValueError("读取过程中向量索引被压缩")
+                return
+            except (ValueError, OSError):
+                if attempt == _SYNC_RETRIES - 1:
+                    raise
+                self._reset()
+                if fcntl is not None and os.path.exists(marker):
+                    # 持有共享锁时仍有标记，说明压缩进程中途退出，取得排他锁时完成替换
+                    with self._file_lock():
+                        pass
+                else:
+                    time.sleep(_SYNC_RETRY_DELAY)
+
+    def _vector_rows(self) -> int:
+        path = self._path("vectors.bin")
+        return os.path.getsize(path) // (self.dim * self.dtype.itemsize) if os.path.exists(path) else 0
+
+    def _catch_up(self):
+        """读取其他进程（或本进程）追加的记录和墓碑；文件被压缩重写时整体重新加载。调用方需持有锁"""
+        path = self._path("records.jsonl")
+        if not os.path.exists(path):
+            if self._records:
+                self._reset()
+            return
+        stat = os.stat(path)
+        if self._records_inode not in (None, stat.st_ino) or stat.st_size < self._records_offset:
+            self._reset()
+        if self.dim is None:
+            self._load_meta()
+        self._records_inode = stat.st_ino
+        if stat.st_size > self._records_offset:
+            vector_rows = self._vector_rows()
+            with open(path, "rb") as f:
+                f.seek(self._records_offset)
+                for line in f:
+                    # 只接受完整且有对应向量的行
+                    if not line.endswith(b"\n") or len(self._records) >= vector_rows:
+                        break
+                    record = json.loads(line)
+                    self._row_of[record["id"]] = len(self._records)
+                    self._records.append((record["id"], record["text"], record["metadata"]))
+                    self._records_offset += len(line)
+            alive = np.ones(len(self._records), dtype=bool)
+            alive[:len(self._alive)] = self._alive
+            self._alive = alive
+        tombstones = self._path("tombstones.txt")
+        if os.path.exists(tombstones) and os.path.getsize(tombstones) > self._tombstones_offset:
+            with open(tombstones, "rb") as f:
+                f.seek(self._tombstones_offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break
+                    row = int(line)
+                    if row < len(self._alive) and self._alive[row]:
+                        self._alive[row] = False
+                        if self._row_of.get(self._records[row][0]) == row:
+                            del self._row_of[self._records[row][0]]
+                    self._tombstones_offset += len(line)
+        self._load_ivf()
+
+    def _matrix(self) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+        """返回只读内存映射的向量矩阵和 int8 缩放系数。调用方需持有锁"""
+        rows = len(self._records)
+        if self._vectors is None or len(self._vectors) != rows:
+            expected = rows * self.dim * self.dtype.itemsize
+            if os.path.getsize(self._path("vectors.bin")) < expected:
+                raise ValueError("vectors.bin 的大小与记录数不一致")
+            self._vectors = np.memmap(self._path("vectors.bin"), dtype=self.dtype, mode="r", shape=(rows, self.dim))
+            if self.dtype == np.int8:
+                self._scales = np.memmap(self._path("scales.bin"), dtype=np.float32, mode="r", shape=(rows,))
+        return self._vectors, self._scales
+
+    def _load_ivf(self):
+        path = self._path("ivf.npz")
+        if not os.path.exists(path):
+            self._ivf, self._ivf_mtime = None, None
+            return
+        mtime = os.path.getmtime(path)
+        if mtime == self._ivf_mtime:
+            return
+        with np.load(path) as data:
+            ivf = {name: data[name] for name in data.files}
+        # 压缩后行号变化，旧的分区不再可用
+        self._ivf = ivf if int(ivf["rows"]) <= len(self._records) else None
+        self._ivf_mtime = mtime
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._sync()
+            return len(self._row_of)
+
+    # ---------- 写入 ----------
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                  ids: Optional[List[str]] = None, **kwargs: Any) -> List[str]:
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = metadatas or [{} for _ in texts]
+        ids = list(ids) if ids else [os.urandom(16).hex() for _ in texts]
+        vectors = _normalize(np.asarray(self._embedding.embed_documents(texts), dtype=np.float32))
+        with self._lock, self._file_lock():
+            self._catch_up()
+            os.makedirs(self.directory, exist_ok=True)
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+                with open(self._path("meta.json"), "w", encoding="utf-8") as f:
+                    json.dump({"dim": self.dim, "dtype": self.dtype.name}, f)
+            # 已存在的 ID 视为更新：旧行记墓碑，新内容追加到末尾
+            self._tombstone([self._row_of[i] for i in ids if i in self._row_of])
+            start = len(self._records)
+            self._vectors = self._scales = None
+            if self.dtype == np.int8:
+                data, scales = quantize_int8(vectors)
+                self._write_at("scales.bin", start * 4, scales.tobytes())
+            else:
+                data = vectors.astype(self.dtype)
+            # 先写向量再写记录，记录指向的向量都已完整写入
+            self._write_at("vectors.bin", start * self.dim * self.dtype.itemsize, data.tobytes())
+            # 从最后一条完整记录之后写起，覆盖上次中断时写了一半的行
+            lines = "".join(json.dumps({"id": i, "text": t, "metadata": m or {}}, ensure_ascii=False) + "\n"
+                            for i, t, m in zip(ids, texts, metadatas))
+            self._write_at("records.jsonl", self._records_offset, lines.encode("utf-8"))
+            self._catch_up()
+        return ids
+
+    def _write_at(self, name: str, offset: int, data: bytes):
+        path = self._path(name)
+        with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+            f.seek(offset)
+            f.write(data)
+            f.truncate()
+
+    def _tombstone(self, rows: Sequence[int]):
+        if rows:
+            self._write_at("tombstones.txt", self._tombstones_offset, "".join(f"{row}\n" for row in rows).encode("ascii"))
+            self._catch_up()
+
+    def delete(self, ids: Optional[List[str]] = None, **kwargs: Any) -> Optional[bool]:
+        with self._lock, self._file_lock():
+            self._catch_up()
+            self._tombstone([self._row_of[i] for i in ids or () if i in self._row_of])
+        return True
+
+    # ---------- 查询 ----------
+
+    def get(self, ids: Optional[Sequence[str]] = None, include: Sequence[str] = ("documents", "metadatas")) -> dict:
+        """与 Chroma.get 相同的返回结构；不指定 ids 时返回全部未删除的分片。embeddings 为归一化后存储的向量"""
+        with self._lock:
+            self._sync()
+            rows = sorted(self._row_of.values()) if ids is None else [self._row_of[i] for i in ids if i in self._row_of]
+            records = [self._records[row] for row in rows]
+            embeddings = None
+            if "embeddings" in include:
+                vectors, scales = self._matrix() if records else (None, None)
+                embeddings = self._dequantize(vectors, scales, rows) if records else np.zeros((0, self.dim or 0), np.float32)
+        return {
+            "ids": [record[0] for record in records],
+            "documents": [record[1] for record in records] if "documents" in include else None,
+            "metadatas": [record[2] for record in records] if "metadatas" in include else None,
+            "embeddings": embeddings,
+        }
+
+    def _scores(self, vectors, scales, rows, query: np.ndarray) -> np.ndarray:
+        block = np.asarray(vectors[rows], dtype=np.float32)
+        scores = block @ query
+        if scales is not None:
+            scores *= scales[rows]
+        return scores
+
+    def _candidate_rows(self, query: np.ndarray) -> Optional[np.ndarray]:
+        """有 IVF 分区时返回需要扫描的行；否则返回 None 表示精确扫描全部行"""
+        ivf = self._ivf
+        if ivf is None:
+            return None
+        centroids = ivf["centroids"]
+        nprobe = min(settings.kb_ivf_nprobe, len(centroids))
+        probes = np.argpartition(-(centroids @ query), nprobe - 1)[:nprobe]
+        offsets, order = ivf["offsets"], ivf["order"]
+        parts = [order[offsets[c]:offsets[c + 1]] for c in probes]
+        # 构建分区之后追加的行不属于任何分区，全部扫描
+        parts.append(np.arange(int(ivf["rows"]), len(self._records)))
+        return np.sort(np.concatenate(parts))
+
+    def similarity_search_with_score(self, query: str, k: int = 4, **kwargs: Any) -> List[Tuple[Document, float]]:
+        vector = np.asarray(self._embedding.embed_query(query), dtype=np.float32)
+        return self.similarity_search_by_vector_with_score(vector, k)
+
+    def similarity_search_by_vector_with_score(self, embedding, k: int = 4) -> List[Tuple[Document, float]]:
+        query = _normalize(np.asarray(embedding, dtype=np.float32)[None, :])[0]
+        with self._lock:
+            self._sync()
+            if not self._row_of or k <= 0:
+                return []
+            vectors, scales = self._matrix()
+            alive = self._alive
+            records = self._records
+            rows = self._candidate_rows(query)
+        if rows is None:
+            scores = np.concatenate([
+                self._scores(vectors, scales, slice(start, start + _BLOCK_ROWS), query)
+                for start in range(0, len(alive), _BLOCK_ROWS)
+            ])
+            rows = np.arange(len(alive))
+        else:
+            scores = self._scores(vectors, scales, rows, query)
+        scores[~alive[rows]] = -np.inf
+        k = min(k, int(np.isfinite(scores).sum()))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        results = []
+        for i in top:
+            doc_id, text, metadata = records[rows[i]]
+            results.append((Document(id=doc_id, page_content=text, metadata=dict(metadata)), float(scores[i])))
+        return results
+
+    def similarity_search(self, query: str, k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k)]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4, **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k)]
+
+    # ---------- 维护 ----------
+
+    def optimize(self, compact_ratio: float = 0.3, min_ivf_rows: int = settings.kb_ivf_min_rows) -> List[str]:
+        """
+        刷新结束后调用：墓碑比例超过 compact_ratio 时压缩重写文件；
+        分片数达到 min_ivf_rows 且未分区的行超过 10% 时重建 IVF 分区。
+
+        Returns:
+            执行了的维护操作说明
+        """
+        done = []
+        with self._lock, self._file_lock():
+            self._catch_up()
+            total = len(self._records)
+            if total and (total - len(self._row_of)) / total > compact_ratio:
+                self._compact()
+                done.append(f"压缩向量索引，移除 {total - len(self._row_of)} 个已删除分片")
+            rows = len(self._records)
+            covered = int(self._ivf["rows"]) if self._ivf is not None else 0
+            if rows >= min_ivf_rows and rows - covered > rows * 0.1:
+                clusters = self._build_ivf()
+                done.append(f"重建 IVF 分区（{clusters} 个）")
+            elif rows < min_ivf_rows and self._ivf is not None:
+                os.remove(self._path("ivf.npz"))
+                self._ivf = self._ivf_mtime = None
+        return done
+
+    def _compact(self):
+        vectors, scales = self._matrix()
+        keep = np.flatnonzero(self._alive)
+        for name, data in (("vectors.bin", vectors), ("scales.bin", scales)):
+            if data is not None:
+                with open(self._path(f"{name}.tmp"), "wb") as f:
+                    for start in range(0, len(keep), _BLOCK_ROWS):
+                        f.write(np.asarray(data[keep[start:start + _BLOCK_ROWS]]).tobytes())
+        with open(self._path("records.jsonl.tmp"), "w", encoding="utf-8") as f:
+            for row in keep:
+                doc_id, text, metadata = self._records[row]
+                f.write(json.dumps({"id": doc_id, "text": text, "metadata": metadata}, ensure_ascii=False) + "\n")
+        self._vectors = self._scales = None
+        # 临时文件全部写完后才放标记，之后的替换可以由任何进程接着完成
+        open(self._path(_COMPACTING), "wb").close()
+        self._finish_compaction()
+        self._reset()
+        self._catch_up()
+
+    def _finish_compaction(self):
+        """把压缩写好的临时文件替换到位并去掉标记。调用方需持有排他锁"""
+        # 墓碑和分区先删除，避免替换过程中被其他进程套用到新的行号上
+        for name in ("tombstones.txt", "ivf.npz"):
+            if os.path.exists(self._path(name)):
+                os.remove(self._path(name))
+        for name in ("vectors.bin", "scales.bin", "records.jsonl"):
+            if os.path.exists(self._path(f"{name}.tmp")):
+                os.replace(self._path(f"{name}.tmp"), self._path(name))
+        os.remove(self._path(_COMPACTING))
+
+    def _build_ivf(self) -> int:
+        vectors, scales = self._matrix()
+        rows = len(self._records)
+        live = np.flatnonzero(self._alive)
+        clusters = int(min(4096, len(live), max(16, math.sqrt(len(live)))))
+        rng = np.random.default_rng(0)
+        sample_rows = np.sort(rng.choice(live, min(len(live), clusters * 64), replace=False))
+        sample = _normalize(self._dequantize(vectors, scales, sample_rows))
+        centroids = spherical_kmeans(sample, clusters)
+        assign = np.concatenate([
+            np.argmax(self._dequantize(vectors, scales, slice(start, min(start + _BLOCK_ROWS, rows))) @ centroids.T, axis=1)
+            for start in range(0, rows, _BLOCK_ROWS)
+        ])
+        order = np.argsort(assign, kind="stable").astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=clusters))]).astype(np.int64)
+        tmp = self._path("ivf.tmp.npz")
+        np.savez(tmp, centroids=centroids, order=order, offsets=offsets, rows=np.int64(rows))
+        os.replace(tmp, self._path("ivf.npz"))
+        self._load_ivf()
+        return clusters
+
+    @staticmethod
+    def _dequantize(vectors, scales, rows) -> np.ndarray:
+        block = np.asarray(vectors[rows], dtype=np.float32)
+        return block * scales[rows][:, None] if scales is not None else block
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   ids: Optional[List[str]] = None, directory: str = "", **kwargs: Any) -> "NumpyVectorStore":
+        store = cls(directory, embedding, **kwargs)
+        store.add_texts(texts, metadatas, ids=ids)
+        return store
@@ -0,0 +1,311 @@
+"""
+查询结果缓存模块
+
+为 run_db_query 缓存只读查询的结果，缓存键由三部分组成：
+- 规范化 SQL 的指纹（去注释、合并空白、关键字统一小写）
+- 连接目标（host/port/user/database 及凭据摘要）
+- 查询涉及的表的数据版本（information_schema.TABLES 中的 CREATE_TIME / UPDATE_TIME）
+
+表数据发生变化时版本随之变化，旧缓存自然失效；UPDATE_TIME 不可用时由 TTL 兜底。
+缓存分两级：进程内 LRU（按条目数和字节数限制）和可选的 SQLite 磁盘缓存（跨进程/重启复用）。
+"""
+import hashlib
+import os
+import pickle
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Iterable, List, Optional, Tuple
+
+from config import settings
+from utils.db_pool import password_digest
+from utils.schema_catalog import DISABLE_STATS_CACHE_SQL
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 只缓存能按引用表的 CREATE_TIME / UPDATE_TIME 判定数据版本的查询；
+# SHOW / DESCRIBE / EXPLAIN 读的是元数据和执行计划，没有可用的数据版本，缓存后会一直过期不了
+_READ_ONLY_PREFIXES = ("select", "with")
+
+# 结果不确定或带副作用的写法，不允许缓存
+_NON_CACHEABLE_PATTERN = re.compile(
+    r"\b(now|sysdate|rand|uuid|uuid_short|curdate|curtime|current_date|current_time|current_timestamp|"
+    r"localtime|localtimestamp|unix_timestamp|utc_date|utc_time|utc_timestamp|last_insert_id|"
+    r"connection_id|found_rows|row_count|user|current_user|session_user|system_user|database|"
+    r"sleep|get_lock|release_lock|benchmark)\s*\("
+    r"|\bfor\s+update\b|\block\s+in\s+share\s+mode\b|\bfor\s+share\b|\binto\s+(outfile|dumpfile|@)"
+    r"|\bcurrent_(date|time|timestamp)\b"
+    # 系统库中的表没有数据版本
+    r"|\b(information_schema|performance_schema)\b"
+)
+
+_TOKEN_PATTERN = re.compile(
+    r"'(?:[^'\\]|\\.|'')*'"       # 单引号字符串
+    r'|"(?:[^"\\]|\\.|"")*"'      # 双引号字符串
+    r"|`[^`]*`"                   # 反引号标识符
+    r"|/\*.*?\*/"                 # 块注释
+    r"|(?:--\s|#)[^\n]*"          # 行注释
+    r"|\s+"                       # 空白
+    r"|[^'\"`/#\s-]+|.",          # 其他
+    re.S,
+)
+
+_TABLE_NAME = r"(?:`[^`]+`|\w+)(?:\s*\.\s*(?:`[^`]+`|\w+))?"
+_TABLE_REF_PATTERN = re.compile(
+    rf"\b(?:from|join)\s+({_TABLE_NAME}(?:\s+(?:as\s+)?\w+)?(?:\s*,\s*{_TABLE_NAME}(?:\s+(?:as\s+)?\w+)?)*)"
+)
+
+
+def normalize_sql(sql: str) -> str:
+    """规范化 SQL：去掉注释、合并空白、字符串以外的内容统一小写、去掉末尾分号"""
+    parts = []
+    for token in _TOKEN_PATTERN.findall(sql):
+        if token.startswith("/*") or token.startswith("#") or token.startswith("--"):
+            parts.append(" ")
+        elif token[0].isspace():
+            parts.append(" ")
+        elif token[0] in "'\"`":
+            parts.append(token)
+        else:
+            parts.append(token.lower())
+    normalized = re.sub(r" +", " ", "".join(parts)).strip()
+    return normalized.rstrip("; ").strip()
+
+
+def mask_sql(sql: str) -> str:
+    """
+    与原语句等长的掩码文本：字符串、反引号标识符和普通注释替换为空格，其余内容统一小写。
+    在掩码上匹配关键字得到的位置可以直接用于改写原语句；优化器提示 /*+ ... */ 保留。
+    """
+    parts = []
+    for token in _TOKEN_PATTERN.findall(sql):
+        if token[0] in "'\"`#" or token.startswith("--") or (token.startswith("/*") and not token.startswith("/*+")):
+            parts.append(" " * len(token))
+        else:
+            parts.append(token.lower())
+    return "".join(parts)
+
+
+def sql_fingerprint(sql: str) -> str:
+    return hashlib.sha256(normalize_sql(sql).encode("utf-8")).hexdigest()
+
+
+def strip_literals(normalized: str) -> str:
+    # 判断语句类型时忽略字符串内容，避免 WHERE name = 'now()' 之类的误判
+    return re.sub(r"'(?:[^'\\]|\\.|'')*'|\"(?:[^\"\\]|\\.|\"\")*\"", "''", normalized)
+
+
+def is_cacheable(sql: str) -> bool:
+    """只有单条、只读、结果确定的语句才允许缓存"""
+    normalized = strip_literals(normalize_sql(sql))
+    if not normalized or ";" in normalized:
+        return False
+    if not normalized.startswith(_READ_ONLY_PREFIXES):
+        return False
+    return _NON_CACHEABLE_PATTERN.search(normalized) is None
+
+
+def referenced_tables(sql: str, default_database: str,
+                      known_tables: Optional[Iterable[str]] = None) -> List[Tuple[str, str]]:
+    """
+    提取查询引用的表，返回 [(库名, 表名)]。
+
+    FROM / JOIN 后的表名通过正则提取；传入 known_tables（当前库的全部表名）时，
+    语句中出现的任何与已知表同名的标识符也会计入，避免复杂写法漏掉依赖表。
+    """
+    normalized = strip_literals(normalize_sql(sql))
+    tables = []
+
+    def _add(database: str, table: str):
+        if (database, table) not in tables:
+            tables.append((database, table))
+
+    for match in _TABLE_REF_PATTERN.finditer(normalized):
+        for ref in match.group(1).split(","):
+            name = re.match(_TABLE_NAME, ref.strip()).group(0)
+            pieces = [p.strip().strip("`") for p in name.split(".")]
+            if len(pieces) == 2:
+                _add(pieces[0], pieces[1])
+            else:
+                _add(default_database, pieces[0])
+    if known_tables:
+        lookup = {name.lower(): name for name in known_tables}
+        for identifier in re.findall(r"`([^`]+)`|\b(\w+)\b", normalized):
+            name = lookup.get((identifier[0] or identifier[1]).lower())
+            if name is not None:
+                _add(default_database, name)
+    return tables
+
+
+def _data_version_sql(tables: List[Tuple[str, str]]) -> Tuple[str, list]:
+    placeholders = ", ".join(["(%s, %s)"] * len(tables))
+    params = [value for pair in tables for value in pair]
+    sql = (
+        "SELECT TABLE_SCHEMA, TABLE_NAME, CREATE_TIME, UPDATE_TIME FROM information_schema.TABLES "
+        f"WHERE (TABLE_SCHEMA, TABLE_NAME) IN ({placeholders}) ORDER BY TABLE_SCHEMA, TABLE_NAME"
+    )
+    return sql, params
+
+
+def _format_data_version(rows) -> str:
+    return "|".join(
+        f"{row['TABLE_SCHEMA']}.{row['TABLE_NAME']}@{row['CREATE_TIME']}/{row['UPDATE_TIME']}"
+        for row in rows
+    )
+
+
+def read_data_version(cursor, tables: Iterable[Tuple[str, str]]) -> str:
+    """读取相关表的数据版本，cursor 需为 DictCursor"""
+    tables = list(tables)
+    if not tables:
+        return ""
+    try:
+        cursor.execute(DISABLE_STATS_CACHE_SQL)
+    except Exception:
+        pass
+    cursor.execute(*_data_version_sql(tables))
+    return _format_data_version(cursor.fetchall())
+
+
+async def aread_data_version(cursor, tables: Iterable[Tuple[str, str]]) -> str:
+    """read_data_version 的异步版本，cursor 为 aiomysql DictCursor"""
+    tables = list(tables)
+    if not tables:
+        return ""
+    try:
+        await cursor.execute(DISABLE_STATS_CACHE_SQL)
+    except Exception:
+        pass
+    await cursor.execute(*_data_version_sql(tables))
+    return _format_data_version(await cursor.fetchall())
+
+
+def make_cache_key(host: str, port: int, user: str, password: str, database: str,
+                   query: str, data_version: str, *variant) -> str:
+    """组合缓存键；variant 用于区分影响结果内容的其他参数（如预览预算）"""
+    raw = "\x1f".join(
+        [host, str(port), user, database, password_digest(password), sql_fingerprint(query), data_version]
+        + [str(v) for v in variant]
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class QueryResultCache:
+    """两级查询结果缓存：内存 LRU + 可选 SQLite"""
+
+    def __init__(
+        self,
+        ttl: float = settings.db_query_cache_ttl,
+        max_entries: int = settings.db_query_cache_max_entries,
+        max_bytes: int = settings.db_query_cache_max_bytes,
+        disk_path: Optional[str] = settings.db_query_cache_disk_path,
+        disk_max_entries: int = settings.db_query_cache_disk_max_entries,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_max_entries = disk_max_entries
+        self.disk_path = None
+        if disk_path:
+            self.disk_path = disk_path if os.path.isabs(disk_path) else os.path.join(PROJECT_ROOT, disk_path)
+            os.makedirs(os.path.dirname(self.disk_path), exist_ok=True)
+            with self._disk() as conn:
+                conn.execute(
+                    "CREATE TABLE IF NOT EXISTS query_cache "
+                    "(key TEXT PRIMARY KEY, created REAL NOT NULL, payload BLOB NOT NULL)"
+                )
+        self._memory: "OrderedDict[str, Tuple[float, bytes]]" = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    @contextmanager
+    def _disk(self):
+        conn = sqlite3.connect(self.disk_path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key: str):
+        now = time.time()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                created, payload = item
+                if now - created <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    return pickle.loads(payload)
+                self._drop(key)
+
+        if self.disk_path:
+            with self._disk() as conn:
+                row = conn.execute("SELECT created, payload FROM query_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and now - row[0] <= self.ttl:
+                with self._lock:
+                    self._stats["disk_hits"] += 1
+                    self._store_memory(key, row[0], row[1])
+                return pickle.loads(row[1])
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def put(self, key: str, value):
+        payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        created = time.time()
+        with self._lock:
+            self._stats["stores"] += 1
+            self._store_memory(key, created, payload)
+        if self.disk_path:
+            with self._disk() as conn:
+                conn.execute("INSERT OR REPLACE INTO query_cache VALUES (?, ?, ?)", (key, created, payload))
+                conn.execute(
+                    "DELETE FROM query_cache WHERE created < ? OR key NOT IN "
+                    "(SELECT key FROM query_cache ORDER BY created DESC LIMIT ?)",
+                    (created - self.ttl, self.disk_max_entries),
+                )
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        if self.disk_path:
+            with self._disk() as conn:
+                conn.execute("DELETE FROM query_cache")
+
+    def stats(self) -> dict:
+        """返回命中率等统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._memory)
+            stats["bytes"] = self._memory_bytes
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 4) if lookups else 0.0
+        return stats
+
+    def _store_memory(self, key: str, created: float, payload: bytes):
+        # 调用方需持有锁；单条结果超过总字节上限时不进入内存缓存
+        if len(payload) > self.max_bytes:
+            return
+        if key in self._memory:
+            self._drop(key)
+        self._memory[key] = (created, payload)
+        self._memory_bytes += len(payload)
+        while len(self._memory) > self.max_entries or self._memory_bytes > self.max_bytes:
+            oldest = next(iter(self._memory))
+            self._drop(oldest)
+            self._stats["evictions"] += 1
+
+    def _drop(self, key: str):
+        _, payload = self._memory.pop(key)
+        self._memory_bytes -= len(payload)
+
+
+# 全局查询缓存实例
+query_cache = QueryResultCache()
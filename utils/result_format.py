@@ -0,0 +1,121 @@
+"""
+查询结果编码模块
+
+把查询结果编码为适合交给 LLM 的紧凑文本，列名只出现一次：
+- csv / tsv: 表头一次，逐行输出
+- markdown: Markdown 表格
+- json: 按列组织的 JSON，{"columns": [...], "data": {"列名": [值, ...]}}
+
+所有格式都会统一处理数值精度、单元格宽度，并给出 token 数估算。
+"""
+import csv
+import datetime
+import decimal
+import io
+import json
+import re
+from typing import Any, List, Sequence, Union
+
+from config import settings
+
+OUTPUT_FORMATS = ("csv", "tsv", "markdown", "json")
+
+# 中日韩字符大致每个字占 1 个 token，其余字符大致每 4 个占 1 个 token
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的 token 数（不依赖分词器，仅用于对比不同编码的体积）"""
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _format_number(value: Any, float_digits: int) -> Any:
+    if isinstance(value, bool) or isinstance(value, int):
+        return value
+    if isinstance(value, decimal.Decimal):
+        if value == value.to_integral_value():
+            return int(value)
+        value = float(value)
+    if isinstance(value, float):
+        if value != value or value in (float("inf"), float("-inf")):
+            return str(value)
+        if value.is_integer() and abs(value) < 1e15:
+            return int(value)
+        return round(value, float_digits)
+    return value
+
+
+def _format_cell(value: Any, float_digits: int, max_width: int) -> Any:
+    """把单元格规范化为 JSON 可序列化的值；字符串超出宽度时截断"""
+    if value is None:
+        return None
+    value = _format_number(value, float_digits)
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        value = value.isoformat(sep=" ") if isinstance(value, datetime.datetime) else value.isoformat()
+    elif isinstance(value, (bytes, bytearray)):
+        try:
+            value = bytes(value).decode("utf-8")
+        except UnicodeDecodeError:
+            value = f"<{len(value)} bytes>"
+    else:
+        value = str(value)
+    if max_width and len(value) > max_width:
+        value = value[:max_width - 1] + "…"
+    return value
+
+
+def _text(value: Any) -> str:
+    return "" if value is None else str(value)
+
+
+def encode_rows(
+    columns: List[str],
+    rows: List[Union[dict, Sequence]],
+    fmt: str = settings.db_query_output_format,
+    float_digits: int = settings.db_query_float_digits,
+    max_cell_width: int = settings.db_query_max_cell_width,
+) -> str:
+    """
+    把查询结果的行编码为紧凑文本。
+
+    Args:
+        columns: 列名（顺序即输出顺序），不能重复
+        rows: 行数据，每行是 {列名: 值}，或与 columns 顺序一致的元组
+        fmt: 输出格式，csv / tsv / markdown / json
+        float_digits: 浮点数保留的小数位数
+        max_cell_width: 单元格最大字符数
+    """
+    if fmt not in OUTPUT_FORMATS:
+        raise ValueError(f"不支持的输出格式: {fmt}，可选: {', '.join(OUTPUT_FORMATS)}")
+    if len(set(columns)) != len(columns):
+        # 按列名取值时重复的列会取到同一个值，json 格式中还会互相覆盖
+        raise ValueError(f"列名重复: {', '.join(sorted({c for c in columns if columns.count(c) > 1}))}")
+
+    matrix = [
+        [_format_cell(value, float_digits, max_cell_width)
+         for value in ([row[col] for col in columns] if isinstance(row, dict) else row)]
+        for row in rows
+    ]
+
+    if fmt == "json":
+        data = {col: [r[i] for r in matrix] for i, col in enumerate(columns)}
+        return json.dumps({"columns": columns, "data": data}, ensure_ascii=False, separators=(",", ":"))
+
+    if fmt == "markdown":
+        def _md(value: Any) -> str:
+            return _text(value).replace("|", "\\|").replace("\n", " ")
+        lines = [
+            "| " + " | ".join(_md(c) for c in columns) + " |",
+            "|" + "|".join("---" for _ in columns) + "|",
+        ]
+        lines.extend("| " + " | ".join(_md(v) for v in r) + " |" for r in matrix)
+        return "\n".join(lines)
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter="\t" if fmt == "tsv" else ",", lineterminator="\n")
+    writer.writerow(columns)
+    writer.writerows([_text(v) for v in r] for r in matrix)
+    return buffer.getvalue().rstrip("\n")
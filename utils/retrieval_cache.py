@@ -0,0 +1,89 @@
+"""
+知识库检索结果缓存
+
+Agent_RAG 节点在编排循环中经常重复提出相同或几乎相同的问题，每次都要重新嵌入查询并检索。
+这里按 (规范化查询, top_k, 知识库版本) 缓存 retrieve_documents 的结果：
+
+- 规范化：全角 / 半角统一、大小写统一、合并空白、去掉句末标点，措辞只差标点的问题共享缓存
+- 知识库版本由索引清单中的文件内容哈希得出，刷新后版本变化，旧结果自然失效；刷新时也会主动清空
+- 进程内 LRU + TTL，命中时不调用嵌入接口，也不访问向量库
+"""
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Optional, Tuple
+
+from config import settings
+from utils.embedding_cache import normalize_text
+
+_TRAILING_PUNCTUATION = re.compile(r"[\s?？。.!！,，;；~～]+$")
+
+
+def normalize_query(query: str) -> str:
+    return _TRAILING_PUNCTUATION.sub("", normalize_text(query).lower())
+
+
+def retrieval_key(query: str, top_k: int, version: str, *variant) -> str:
+    """variant 用于区分影响结果的其他参数（如知识库名称、是否混合检索）"""
+    raw = "\x1f".join([normalize_query(query), str(top_k), version] + [str(v) for v in variant])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class RetrievalCache:
+    """线程安全的 LRU + TTL 缓存，值直接保存对象引用，不做序列化"""
+
+    def __init__(self, ttl: float = settings.kb_retrieval_cache_ttl,
+                 max_entries: int = settings.kb_retrieval_cache_max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.monotonic()
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None:
+                created, value = item
+                if now - created <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return value
+                del self._entries[key]
+                self._stats["expired"] += 1
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, key: str, value: Any):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._stats["invalidations"] += 1
+
+    def stats(self) -> dict:
+        """返回命中率等统计信息"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+    def summary(self) -> str:
+        stats = self.stats()
+        return (f"检索缓存: 命中 {stats['hits']} / {stats['hits'] + stats['misses']}（{stats['hit_rate']:.0%}），"
+                f"当前 {stats['entries']} 条")
+
+
+# 全局检索缓存实例
+retrieval_cache = RetrievalCache()
@@ -0,0 +1,312 @@
+"""
+确定性采样模块
+
+在大事实表上先用小比例样本探索、再全量确认。采样按需启用，同一参数下每次得到同一份样本，
+结果可以复现、也可以命中查询结果缓存。支持三种方式：
+
+- modulo：按主键哈希取模（CRC32(pk) % 10000 < 比例），样本均匀，适用于任意主键类型；
+  仍需扫描全表，但连接、分组等后续计算只作用于样本
+- range：把整数主键的取值范围切成若干条带，每条取开头的一段，走主键范围扫描，
+  只读取样本行，速度最快；属于分块抽样，主键与业务字段相关时偏差会更大
+- table：把 modulo 样本物化为 `__sample_<表名>_<万分比>` 表，定期刷新，反复探索时最省资源
+
+run_db_query 通过同名 CTE 把查询中对该表的引用替换为样本，profile_table 直接以样本为数据源。
+"""
+import math
+import re
+import uuid
+import zlib
+from dataclasses import dataclass, field
+from decimal import Decimal
+from typing import Any, Dict, List, Optional
+
+from config import settings
+from utils.table_profile import quote_identifier
+
+SAMPLE_METHODS = ("modulo", "range", "table")
+METHOD_LABELS = {"modulo": "主键哈希取模", "range": "主键区间分块", "table": "物化样本表"}
+
+# 哈希取模的分母，采样比例精确到万分之一
+_MODULUS = 10000
+_INTEGER_TYPES = {"tinyint", "smallint", "mediumint", "int", "integer", "bigint"}
+_LEADING_WITH = re.compile(r"^(\s*(?:/\*.*?\*/\s*|--[^\n]*\n\s*|#[^\n]*\n\s*)*)with(\s+recursive)?\b", re.I | re.S)
+_LEADING_SELECT = re.compile(r"^(\s*(?:/\*.*?\*/\s*|--[^\n]*\n\s*|#[^\n]*\n\s*)*)(select|\()", re.I | re.S)
+_COUNT_LIKE = re.compile(r"count|cnt|(^|_)num($|_)|数量|次数|个数|总数", re.I)
+# 错误估计最多列出的计数结果个数
+_MAX_ESTIMATES = 10
+
+SAMPLE_AGE_SQL = """
+SELECT TIMESTAMPDIFF(SECOND, CREATE_TIME, NOW()) AS age
+FROM information_schema.TABLES
+WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s
+"""
+
+
+@dataclass
+class SamplePlan:
+    """一次采样的数据源和说明"""
+    table: str                      # 被采样的表
+    method: str
+    fraction: float                 # 样本占全表的比例
+    relation: str                   # 样本所在的表（带库名）
+    condition: Optional[str] = None  # 取样条件，物化样本表为空
+    notes: List[str] = field(default_factory=list)
+
+    def select_sql(self) -> str:
+        sql = f"SELECT * FROM {self.relation}"
+        return f"{sql} WHERE {self.condition}" if self.condition else sql
+
+    def derived_table(self) -> str:
+        """作为 FROM 子句中的派生表使用，别名为原表名"""
+        return f"({self.select_sql()}) AS {quote_identifier(self.table)}"
+
+
+def quantize_fraction(fraction: float) -> float:
+    """取模采样的实际比例：精确到万分之一，最小为万分之一"""
+    return max(1, round(fraction * _MODULUS)) / _MODULUS
+
+
+def sample_table_name(table: str, fraction: float) -> str:
+    """物化样本表名，超长的表名截断并附加哈希，保证不超过 MySQL 的 64 字符限制"""
+    basis_points = max(1, round(fraction * _MODULUS))
+    name = f"{settings.db_sample_table_prefix}{table}_{basis_points}"
+    if len(name) > 48:
+        digest = zlib.crc32(table.encode("utf-8")) & 0xFFFFFFFF
+        name = f"{settings.db_sample_table_prefix}{table[:24]}_{digest:08x}_{basis_points}"
+    return name
+
+
+def is_sample_table(name: str) -> bool:
+    return name.startswith(settings.db_sample_table_prefix)
+
+
+class SamplePlanner:
+    """根据表的主键生成采样 SQL，并解析执行结果得到 SamplePlan"""
+
+    def __init__(self, database: str, table, fraction: float, method: str = settings.db_sample_method):
+        """
+        Args:
+            database: 数据库名
+            table: schema_catalog.TableInfo
+            fraction: 采样比例 (0, 1)
+            method: modulo / range / table
+        """
+        if method not in SAMPLE_METHODS:
+            raise ValueError(f"不支持的采样方式 '{method}'，可选: {', '.join(SAMPLE_METHODS)}")
+        if not table.primary_key:
+            raise ValueError(f"表 '{table.name}' 没有主键，无法进行确定性采样")
+        self.database = database
+        self.table = table
+        self.qualified = f"{quote_identifier(database)}.{quote_identifier(table.name)}"
+        self.plan = SamplePlan(table=table.name, method=method, fraction=fraction, relation=self.qualified)
+        if method == "range":
+            pk_types = [table.column(name).data_type.lower() for name in table.primary_key]
+            if len(pk_types) != 1 or pk_types[0] not in _INTEGER_TYPES:
+                self.plan.method = "modulo"
+                self.plan.notes.append("区间采样需要单列整数主键，已改用主键哈希取模采样")
+        if self.plan.method != "range":
+            # 取模条件只能精确到万分之一，按实际生效的比例计算放大倍数和误差
+            actual = quantize_fraction(fraction)
+            if actual != fraction:
+                self.plan.notes.append(f"采样比例精确到万分之一，实际按 {actual:g} 采样")
+                self.plan.fraction = actual
+        if self.plan.method == "table":
+            self.sample_name = sample_table_name(table.name, self.plan.fraction)
+            self.plan.relation = f"{quote_identifier(database)}.{quote_identifier(self.sample_name)}"
+        else:
+            self.plan.condition = self.modulo_condition() if self.plan.method == "modulo" else None
+
+    @property
+    def method(self) -> str:
+        return self.plan.method
+
+    def modulo_condition(self) -> str:
+        keys = [quote_identifier(name) for name in self.table.primary_key]
+        key = keys[0] if len(keys) == 1 else f"CONCAT_WS(0x1f, {', '.join(keys)})"
+        basis_points = max(1, round(self.plan.fraction * _MODULUS))
+        return f"CRC32({key}) % {_MODULUS} < {basis_points}"
+
+    # ---------- range：按主键取值范围分条带 ----------
+
+    def bounds_sql(self) -> str:
+        key = quote_identifier(self.table.primary_key[0])
+        return f"SELECT MIN({key}) AS low, MAX({key}) AS high FROM {self.qualified}"
+
+    def apply_bounds(self, row: Optional[Dict[str, Any]]):
+        key = quote_identifier(self.table.primary_key[0])
+        if not row or row["low"] is None:
+            self.plan.condition = "FALSE"
+            return
+        low, high = int(row["low"]), int(row["high"])
+        span = high - low + 1
+        stripes = max(1, min(settings.db_sample_range_stripes, span))
+        width = span / stripes
+        take = max(1, round(width * self.plan.fraction))
+        ranges = []
+        for i in range(stripes):
+            start = low + int(i * width)
+            end = min(start + take - 1, high)
+            ranges.append(f"{key} BETWEEN {start} AND {end}")
+        self.plan.condition = "(" + " OR ".join(ranges) + ")"
+        # 以实际覆盖的主键范围作为样本比例
+        self.plan.fraction = min(1.0, take * stripes / span)
+
+    # ---------- table：物化样本表 ----------
+
+    def needs_refresh(self, row: Optional[Dict[str, Any]]) -> bool:
+        return row is None or row["age"] is None or int(row["age"]) > settings.db_sample_refresh_interval
+
+    def refresh_sqls(self, exists: bool) -> List[str]:
+        """先建新表再原子重命名替换，刷新期间旧样本始终可用"""
+        db = quote_identifier(self.database)
+        target = quote_identifier(self.sample_name)
+        suffix = uuid.uuid4().hex[:8]
+        self.staging = quote_identifier(f"{self.sample_name}__new_{suffix}")
+        retired = quote_identifier(f"{self.sample_name}__old_{suffix}")
+        sqls = [f"CREATE TABLE {db}.{self.staging} AS SELECT * FROM {self.qualified} WHERE {self.modulo_condition()}"]
+        if exists:
+            sqls.append(f"RENAME TABLE {db}.{target} TO {db}.{retired}, {db}.{self.staging} TO {db}.{target}")
+            sqls.append(f"DROP TABLE {db}.{retired}")
+        else:
+            sqls.append(f"RENAME TABLE {db}.{self.staging} TO {db}.{target}")
+        return sqls
+
+    def cleanup_sql(self) -> str:
+        return f"DROP TABLE IF EXISTS {quote_identifier(self.database)}.{self.staging}"
+
+    def count_sql(self) -> str:
+        return f"SELECT COUNT(*) AS n FROM {self.plan.relation}"
+
+    def apply_count(self, row: Dict[str, Any], refreshed: bool):
+        rows = int(row["n"] or 0)
+        estimate = self.table.rows_estimate or 0
+        action = "已刷新" if refreshed else "复用"
+        note = f"{action}物化样本表 {self.sample_name}（{rows} 行"
+        if estimate:
+            note += f"，约占全表 {min(rows / estimate, 1.0):.2%}"
+        self.plan.notes.append(note + "）")
+
+
+def _table_references(query: str, table: str):
+    """统计查询中对表的引用：(不带库名的次数, 带库名的次数)，忽略注释和字符串"""
+    from utils.query_cache import normalize_sql, strip_literals
+
+    normalized = strip_literals(normalize_sql(query))
+    name = rf"(?:`{re.escape(table.replace('`', '``'))}`|(?<![\w`]){re.escape(table)}(?![\w`]))"
+    unqualified = qualified = 0
+    for match in re.finditer(name, normalized, re.I):
+        if normalized[:match.start()].rstrip().endswith("."):
+            qualified += 1
+        else:
+            unqualified += 1
+    return unqualified, qualified
+
+
+def apply_sample(query: str, plan: SamplePlan) -> str:
+    """
+    用与原表同名的 CTE 包裹查询，查询中不带库名的表引用都会指向样本。
+    CTE 内部使用带库名的原表，不会与 CTE 自身冲突。
+
+    同名 CTE 只能替换不带库名的引用，查询以 库名.表名 引用该表或根本没有引用该表时，
+    结果不会基于样本，直接报错而不是附带错误的采样说明。
+    """
+    unqualified, qualified = _table_references(query, plan.table)
+    if qualified:
+        raise ValueError(f"采样查询中请直接使用表名 {plan.table} 引用该表，带库名的引用不会被替换为样本")
+    if not unqualified:
+        raise ValueError(f"查询中没有引用采样表 {plan.table}，请检查 sample_table 参数")
+    cte = f"{quote_identifier(plan.table)} AS ({plan.select_sql()})"
+    match = _LEADING_WITH.match(query)
+    if match:
+        return f"{match.group(1)}WITH{match.group(2) or ''} {cte},{query[match.end():]}"
+    if not _LEADING_SELECT.match(query):
+        raise ValueError("采样只支持 SELECT / WITH 查询")
+    return f"WITH {cte}\n{query.strip()}"
+
+
+def _count_estimate(value: int, fraction: float) -> str:
+    if value == 0:
+        return f"0（95% 上限约 {3 / fraction:.0f}）"
+    margin = 1.96 * math.sqrt(value * (1 - fraction)) / fraction
+    return f"{value / fraction:.0f} ± {margin:.0f}"
+
+
+def sample_notes(plan: SamplePlan, columns: List[str], rows: List[dict]) -> List[str]:
+    """生成附加在结果中的采样说明和误差估计"""
+    fraction = plan.fraction
+    notes = [
+        f"结果基于表 {plan.table} 约 {fraction:.2%} 的确定性采样（{METHOD_LABELS[plan.method]}），"
+        f"COUNT/SUM 类结果乘以 {1 / fraction:.4g} 可还原为全表估计，AVG/比例类结果可直接作为全表估计"
+    ]
+    notes.extend(plan.notes)
+    estimates = []
+    for col in columns:
+        if not _COUNT_LIKE.search(str(col)):
+            continue
+        for row in rows:
+            value = row.get(col)
+            if isinstance(value, bool) or not isinstance(value, (int, Decimal)) or value != int(value):
+                continue
+            estimates.append(f"{col}={int(value)} → {_count_estimate(int(value), fraction)}")
+    if estimates:
+        shown = "; ".join(estimates[:_MAX_ESTIMATES])
+        more = f" 等 {len(estimates)} 项" if len(estimates) > _MAX_ESTIMATES else ""
+        notes.append(f"计数的全表估计（95% 置信区间）: {shown}{more}")
+    error_note = "样本中比例 p 的标准误约为 √(p(1-p)/n)，均值的标准误约为 标准差/√n，n 为参与计算的样本行数"
+    if plan.method == "range":
+        error_note += "；区间采样为分块抽样，若数据沿主键有聚集性，实际误差会更大"
+    notes.append(error_note + "。确认结论时请去掉采样参数在全表上重新查询")
+    return notes
+
+
+def _planner(catalog, database: str, table_name: str, fraction: float, method: str) -> SamplePlanner:
+    table = catalog.get_table(table_name)
+    if table is None or not table.columns:
+        raise ValueError(f"采样表 '{table_name}' 不存在")
+    return SamplePlanner(database, table, fraction, method)
+
+
+def plan_sample(cursor, catalog, database: str, table_name: str, fraction: float,
+                method: str = settings.db_sample_method) -> SamplePlan:
+    """同步生成采样方案（必要时刷新物化样本表），cursor 需为 DictCursor"""
+    planner = _planner(catalog, database, table_name, fraction, method)
+    if planner.method == "range":
+        cursor.execute(planner.bounds_sql())
+        planner.apply_bounds(cursor.fetchone())
+    elif planner.method == "table":
+        cursor.execute(SAMPLE_AGE_SQL, (database, planner.sample_name))
+        row = cursor.fetchone()
+        refreshed = planner.needs_refresh(row)
+        if refreshed:
+            try:
+                for sql in planner.refresh_sqls(exists=row is not None):
+                    cursor.execute(sql)
+            except Exception:
+                cursor.execute(planner.cleanup_sql())
+                raise
+        cursor.execute(planner.count_sql())
+        planner.apply_count(cursor.fetchone(), refreshed)
+    return planner.plan
+
+
+async def aplan_sample(cursor, catalog, database: str, table_name: str, fraction: float,
+                       method: str = settings.db_sample_method) -> SamplePlan:
+    """plan_sample 的异步版本，cursor 为 aiomysql DictCursor"""
+    planner = _planner(catalog, database, table_name, fraction, method)
+    if planner.method == "range":
+        await cursor.execute(planner.bounds_sql())
+        planner.apply_bounds(await cursor.fetchone())
+    elif planner.method == "table":
+        await cursor.execute(SAMPLE_AGE_SQL, (database, planner.sample_name))
+        row = await cursor.fetchone()
+        refreshed = planner.needs_refresh(row)
+        if refreshed:
+            try:
+                for sql in planner.refresh_sqls(exists=row is not None):
+                    await cursor.execute(sql)
+            except Exception:
+                await cursor.execute(planner.cleanup_sql())
+                raise
+        await cursor.execute(planner.count_sql())
+        planner.apply_count(await cursor.fetchone(), refreshed)
+    return planner.plan
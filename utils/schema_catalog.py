@@ -0,0 +1,405 @@
+"""
+数据库表结构目录（Schema Catalog）
+
+一次性从 information_schema 批量读取整个库的表、列、类型、主键、索引和外键信息，
+按数据库缓存。缓存只在以下情况失效：
+- 表的 CREATE_TIME / UPDATE_TIME 发生变化（表增删、重建或数据更新）
+- 列定义的 DDL 校验和发生变化（新增/修改/删除列）
+
+版本检查本身也是一条很轻的聚合查询，并且在 db_schema_check_interval 秒内不会重复执行。
+"""
+import fnmatch
+import threading
+import time
+from functools import partial
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from config import settings
+from utils.db_pool import get_raw_connection, password_digest, run_on_connections
+from utils.table_profile import quote_identifier
+
+# MySQL 8 默认缓存 information_schema 统计信息 24 小时，检查版本前先关闭缓存
+DISABLE_STATS_CACHE_SQL = "SET SESSION information_schema_stats_expiry = 0"
+
+VERSION_SQL = """
+SELECT
+    (SELECT CONCAT(COUNT(*), ':', COALESCE(SUM(CRC32(CONCAT_WS('|', TABLE_NAME, CREATE_TIME, UPDATE_TIME))), 0))
+       FROM information_schema.TABLES WHERE TABLE_SCHEMA = %(db)s) AS table_version,
+    (SELECT CONCAT(COUNT(*), ':', COALESCE(SUM(CRC32(CONCAT_WS('|', TABLE_NAME, COLUMN_NAME, COLUMN_TYPE,
+                   IS_NULLABLE, COLUMN_DEFAULT, COLUMN_KEY, EXTRA))), 0))
+       FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = %(db)s) AS ddl_checksum
+"""
+
+# 批量加载整个库结构的查询，键为结果名称
+LOAD_SQLS = {
+    "tables": """
+        SELECT TABLE_NAME, TABLE_TYPE, TABLE_ROWS, TABLE_COMMENT
+        FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = %(db)s
+        ORDER BY TABLE_NAME
+    """,
+    "columns": """
+        SELECT TABLE_NAME, COLUMN_NAME, COLUMN_TYPE, DATA_TYPE, IS_NULLABLE, COLUMN_DEFAULT,
+               COLUMN_KEY, EXTRA, COLUMN_COMMENT
+        FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = %(db)s
+        ORDER BY TABLE_NAME, ORDINAL_POSITION
+    """,
+    "indexes": """
+        SELECT TABLE_NAME, INDEX_NAME, NON_UNIQUE, COLUMN_NAME
+        FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = %(db)s
+        ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX
+    """,
+    "foreign_keys": """
+        SELECT TABLE_NAME, COLUMN_NAME, REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME
+        FROM information_schema.KEY_COLUMN_USAGE
+        WHERE TABLE_SCHEMA = %(db)s AND REFERENCED_TABLE_NAME IS NOT NULL
+        ORDER BY TABLE_NAME, ORDINAL_POSITION
+    """,
+}
+
+
+@dataclass
+class ColumnInfo:
+    name: str
+    type: str
+    data_type: str
+    nullable: bool
+    default: Optional[str]
+    key: str = ""
+    extra: str = ""
+    comment: str = ""
+
+
+@dataclass
+class TableInfo:
+    name: str
+    type: str = "BASE TABLE"
+    rows_estimate: Optional[int] = None
+    comment: str = ""
+    columns: List[ColumnInfo] = field(default_factory=list)
+    primary_key: List[str] = field(default_factory=list)
+    indexes: Dict[str, Tuple[bool, List[str]]] = field(default_factory=dict)  # 索引名 -> (是否唯一, 列)
+    foreign_keys: List[Tuple[str, str, str]] = field(default_factory=list)    # (列, 引用表, 引用列)
+
+    def column(self, name: str) -> Optional[ColumnInfo]:
+        for col in self.columns:
+            if col.name == name:
+                return col
+        return None
+
+
+@dataclass
+class SchemaCatalog:
+    database: str
+    version: Tuple[str, str]
+    tables: Dict[str, TableInfo] = field(default_factory=dict)
+
+    def table_names(self, include_views: bool = False) -> List[str]:
+        # 物化样本表（见 utils.sampling）和导入清单表（见 utils.ingest_fingerprint）不对 Agent 展示
+        return [
+            name for name, table in self.tables.items()
+            if (include_views or table.type == "BASE TABLE")
+            and not name.startswith(settings.db_sample_table_prefix)
+            and name != settings.ingest_manifest_table
+        ]
+
+    def get_table(self, table_name: str) -> Optional[TableInfo]:
+        table = self.tables.get(table_name)
+        if table is None:
+            # MySQL 在大多数平台上表名不区分大小写
+            lowered = table_name.lower()
+            for name, candidate in self.tables.items():
+                if name.lower() == lowered:
+                    return candidate
+        return table
+
+    def match_tables(self, patterns: List[str]) -> Tuple[List[TableInfo], List[str]]:
+        """按表名列表或通配符（如 order_*）匹配表，返回 (匹配到的表, 没有匹配到任何表的模式)"""
+        names = self.table_names(include_views=True)
+        matched, unmatched = [], []
+        for pattern in patterns:
+            if any(ch in pattern for ch in "*?["):
+                hits = [name for name in names if fnmatch.fnmatchcase(name.lower(), pattern.lower())]
+            else:
+                table = self.get_table(pattern)
+                hits = [table.name] if table is not None else []
+            if not hits:
+                unmatched.append(pattern)
+            matched.extend(name for name in hits if name not in matched)
+        return [self.tables[name] for name in matched], unmatched
+
+
+def build_catalog(database: str, version: Tuple[str, str], rows: Dict[str, List[dict]]) -> SchemaCatalog:
+    """根据 LOAD_SQLS 的查询结果构建目录"""
+    catalog = SchemaCatalog(database=database, version=version)
+    for row in rows["tables"]:
+        catalog.tables[row["TABLE_NAME"]] = TableInfo(
+            name=row["TABLE_NAME"],
+            type=row["TABLE_TYPE"],
+            rows_estimate=row["TABLE_ROWS"],
+            comment=row["TABLE_COMMENT"] or "",
+        )
+
+    def _table(name: str) -> TableInfo:
+        return catalog.tables.setdefault(name, TableInfo(name=name))
+
+    for row in rows["columns"]:
+        table = _table(row["TABLE_NAME"])
+        table.columns.append(ColumnInfo(
+            name=row["COLUMN_NAME"],
+            type=row["COLUMN_TYPE"],
+            data_type=row["DATA_TYPE"],
+            nullable=row["IS_NULLABLE"] == "YES",
+            default=row["COLUMN_DEFAULT"],
+            key=row["COLUMN_KEY"] or "",
+            extra=row["EXTRA"] or "",
+            comment=row["COLUMN_COMMENT"] or "",
+        ))
+    for row in rows["indexes"]:
+        table = _table(row["TABLE_NAME"])
+        unique, columns = table.indexes.setdefault(row["INDEX_NAME"], (not row["NON_UNIQUE"], []))
+        columns.append(row["COLUMN_NAME"])
+        if row["INDEX_NAME"] == "PRIMARY":
+            table.primary_key.append(row["COLUMN_NAME"])
+    for row in rows["foreign_keys"]:
+        _table(row["TABLE_NAME"]).foreign_keys.append(
+            (row["COLUMN_NAME"], row["REFERENCED_TABLE_NAME"], row["REFERENCED_COLUMN_NAME"])
+        )
+    return catalog
+
+
+def _to_text(value) -> str:
+    # information_schema 的部分列在某些 MySQL 版本中以 bytes 返回
+    return value.decode("utf-8") if isinstance(value, bytes) else str(value)
+
+
+def read_version(cursor, database: str) -> Tuple[str, str]:
+    """读取当前库的结构版本 (table_version, ddl_checksum)"""
+    try:
+        cursor.execute(DISABLE_STATS_CACHE_SQL)
+    except Exception:
+        # MySQL 5.7 没有该变量，统计信息本身就是实时的
+        pass
+    cursor.execute(VERSION_SQL, {"db": database})
+    row = cursor.fetchone()
+    return _to_text(row["table_version"]), _to_text(row["ddl_checksum"])
+
+
+async def aread_version(cursor, database: str) -> Tuple[str, str]:
+    """read_version 的异步版本，cursor 为 aiomysql DictCursor"""
+    try:
+        await cursor.execute(DISABLE_STATS_CACHE_SQL)
+    except Exception:
+        pass
+    await cursor.execute(VERSION_SQL, {"db": database})
+    row = await cursor.fetchone()
+    return _to_text(row["table_version"]), _to_text(row["ddl_checksum"])
+
+
+def _fetch_all(sql: str, database: str, cursor) -> List[dict]:
+    cursor.execute(sql, {"db": database})
+    return list(cursor.fetchall())
+
+
+async def _afetch_all(sql: str, database: str, cursor) -> List[dict]:
+    await cursor.execute(sql, {"db": database})
+    return list(await cursor.fetchall())
+
+
+def _raise_first(errors: dict):
+    if errors:
+        raise next(iter(errors.values()))
+
+
+class _CacheEntry:
+    __slots__ = ("catalog", "checked_at")
+
+    def __init__(self, catalog: SchemaCatalog):
+        self.catalog = catalog
+        self.checked_at = time.monotonic()
+
+
+class SchemaCatalogCache:
+    """按连接目标（含凭据摘要）缓存表结构目录，凭据不同的调用不会共享缓存"""
+
+    def __init__(self, check_interval: float = settings.db_schema_check_interval):
+        self.check_interval = check_interval
+        self._entries: Dict[tuple, _CacheEntry] = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, host: str, port: int, user: str, password: str, database: str):
+        key = (host, int(port), user, database, password_digest(password))
+        with self._lock:
+            return key, self._entries.get(key)
+
+    def _is_fresh(self, entry: Optional[_CacheEntry]) -> bool:
+        return entry is not None and time.monotonic() - entry.checked_at < self.check_interval
+
+    def _store(self, key: tuple, database: str, version: Tuple[str, str], rows: Dict[str, List[dict]]) -> SchemaCatalog:
+        catalog = build_catalog(database, version, rows)
+        with self._lock:
+            self._entries[key] = _CacheEntry(catalog)
+        return catalog
+
+    def get(self, host: str, port: int, user: str, password: str, database: str,
+            force_check: bool = False) -> SchemaCatalog:
+        import pymysql
+
+        key, entry = self._lookup(host, port, user, password, database)
+        if not force_check and self._is_fresh(entry):
+            return entry.catalog
+
+        connection = get_raw_connection(host, port, user, password, database)
+        try:
+            with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+                version = read_version(cursor, database)
+        finally:
+            connection.close()
+        if entry is not None and entry.catalog.version == version:
+            entry.checked_at = time.monotonic()
+            return entry.catalog
+        # 各类元数据互相独立，在多个池化连接上并发读取，冷启动只需约一次往返的延迟
+        jobs = {name: partial(_fetch_all, sql, database) for name, sql in LOAD_SQLS.items()}
+        rows, errors = run_on_connections(host, port, user, password, database, jobs)
+        _raise_first(errors)
+        return self._store(key, database, version, rows)
+
+    async def aget(self, host: str, port: int, user: str, password: str, database: str,
+                   force_check: bool = False) -> SchemaCatalog:
+        """get 的异步版本，使用 aiomysql 连接池，与同步版本共享缓存"""
+        import aiomysql
+        from utils.db_async_pool import acquire_async_connection, arun_on_connections
+
+        key, entry = self._lookup(host, port, user, password, database)
+        if not force_check and self._is_fresh(entry):
+            return entry.catalog
+
+        async with acquire_async_connection(host, port, user, password, database) as connection:
+            async with connection.cursor(aiomysql.DictCursor) as cursor:
+                version = await aread_version(cursor, database)
+        if entry is not None and entry.catalog.version == version:
+            entry.checked_at = time.monotonic()
+            return entry.catalog
+        jobs = {name: partial(_afetch_all, sql, database) for name, sql in LOAD_SQLS.items()}
+        rows, errors = await arun_on_connections(host, port, user, password, database, jobs)
+        _raise_first(errors)
+        return self._store(key, database, version, rows)
+
+    def invalidate(self, host: Optional[str] = None, port: Optional[int] = None, database: Optional[str] = None):
+        """清除缓存；不传参数时清空全部，不传 database 时清除该服务器上所有库的缓存"""
+        with self._lock:
+            if host is None:
+                self._entries.clear()
+                return
+            for key in list(self._entries):
+                if key[0] == host and key[1] == int(port) and database in (None, key[3]):
+                    del self._entries[key]
+
+
+# 全局目录缓存实例
+schema_cache = SchemaCatalogCache()
+
+
+def get_catalog(host: str, port: int, user: str, password: str, database: str) -> SchemaCatalog:
+    """获取（必要时刷新）指定数据库的表结构目录"""
+    return schema_cache.get(host, port, user, password, database)
+
+
+async def aget_catalog(host: str, port: int, user: str, password: str, database: str) -> SchemaCatalog:
+    """get_catalog 的异步版本"""
+    return await schema_cache.aget(host, port, user, password, database)
+
+
+@dataclass
+class TableDescriptions:
+    """批量描述多张表的结果，部分表失败时其余表照常返回"""
+    tables: List[TableInfo] = field(default_factory=list)
+    unmatched: List[str] = field(default_factory=list)           # 没有匹配到任何表的名称或通配符
+    row_counts: Dict[str, int] = field(default_factory=dict)     # 精确行数
+    errors: Dict[str, str] = field(default_factory=dict)         # 表名 -> 失败原因
+    omitted: int = 0                                             # 超出数量上限未返回的表数
+
+
+def _select_descriptions(catalog: SchemaCatalog, patterns: List[str]) -> TableDescriptions:
+    tables, unmatched = catalog.match_tables(patterns)
+    limit = settings.db_describe_max_tables
+    result = TableDescriptions(tables=tables[:limit], unmatched=unmatched, omitted=max(len(tables) - limit, 0))
+    for table in result.tables:
+        if not table.columns:
+            result.errors[table.name] = "没有读取到任何列（视图定义可能已失效，或没有该表的访问权限）"
+    return result
+
+
+def _count_sql(table: TableInfo) -> str:
+    return (f"SELECT /*+ MAX_EXECUTION_TIME({settings.db_guard_max_execution_ms}) */ COUNT(*) AS n "
+            f"FROM {quote_identifier(table.name)}")
+
+
+def _count_rows(table: TableInfo, cursor) -> int:
+    cursor.execute(_count_sql(table))
+    return int(cursor.fetchone()["n"])
+
+
+async def _acount_rows(table: TableInfo, cursor) -> int:
+    await cursor.execute(_count_sql(table))
+    return int((await cursor.fetchone())["n"])
+
+
+def describe_tables(host: str, port: int, user: str, password: str, database: str,
+                    patterns: List[str], exact_row_count: bool = False) -> TableDescriptions:
+    """
+    批量描述多张表。结构信息来自缓存的目录；需要精确行数时，
+    各表的 COUNT(*) 在有界线程池中并发执行，单表超时或失败只记录在 errors 中。
+    """
+    result = _select_descriptions(get_catalog(host, port, user, password, database), patterns)
+    if exact_row_count:
+        jobs = {t.name: partial(_count_rows, t) for t in result.tables if t.name not in result.errors}
+        counts, errors = run_on_connections(host, port, user, password, database, jobs)
+        result.row_counts.update(counts)
+        result.errors.update({name: str(e) for name, e in errors.items()})
+    return result
+
+
+async def adescribe_tables(host: str, port: int, user: str, password: str, database: str,
+                           patterns: List[str], exact_row_count: bool = False) -> TableDescriptions:
+    """describe_tables 的异步版本"""
+    from utils.db_async_pool import arun_on_connections
+
+    result = _select_descriptions(await aget_catalog(host, port, user, password, database), patterns)
+    if exact_row_count:
+        jobs = {t.name: partial(_acount_rows, t) for t in result.tables if t.name not in result.errors}
+        counts, errors = await arun_on_connections(host, port, user, password, database, jobs)
+        result.row_counts.update(counts)
+        result.errors.update({name: str(e) for name, e in errors.items()})
+    return result
+
+
+def format_table_compact(table: TableInfo) -> str:
+    """把单张表的结构压缩成一行文本，供整库结构概览使用"""
+    parts = []
+    for col in table.columns:
+        flags = ""
+        if col.name in table.primary_key:
+            flags += " PK"
+        if not col.nullable:
+            flags += " NOT NULL"
+        parts.append(f"{col.name} {col.type}{flags}")
+    header = f"{table.name}"
+    if table.type != "BASE TABLE":
+        header += " [视图]"
+    if table.rows_estimate is not None:
+        header += f" (约 {table.rows_estimate} 行)"
+    line = f"{header}: {', '.join(parts)}"
+    indexes = [
+        f"{'UNIQUE ' if unique else ''}{name}({', '.join(cols)})"
+        for name, (unique, cols) in table.indexes.items() if name != "PRIMARY"
+    ]
+    if indexes:
+        line += f" | 索引: {'; '.join(indexes)}"
+    if table.foreign_keys:
+        fks = [f"{col}->{ref_table}.{ref_col}" for col, ref_table, ref_col in table.foreign_keys]
+        line += f" | 外键: {'; '.join(fks)}"
+    return line
@@ -0,0 +1,218 @@
+"""
+SQL 准入检查模块
+
+在执行 Agent 生成的 SQL 之前先运行 EXPLAIN，根据执行计划估算扫描行数、识别全表扫描和
+疑似笛卡尔积的连接，超过阈值的查询会被改写或拒绝：
+
+- 改写：注入 MAX_EXECUTION_TIME 执行超时提示，缺少 LIMIT 时补上 LIMIT
+- 拒绝：返回可操作的提示信息（哪些表全表扫描、可用索引等），让 Agent 调整 SQL 后重试
+
+只检查 SELECT / WITH 查询；EXPLAIN 本身失败（如语法错误）时放行，由实际执行返回错误信息。
+"""
+import re
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+from config import settings
+from utils.query_cache import mask_sql, normalize_sql
+
+_LIMIT_PATTERN = re.compile(r"\blimit\s+\d+(\s*,\s*\d+|\s+offset\s+\d+)?\s*$")
+_HINT_PATTERN = re.compile(r"max_execution_time\s*\(")
+_SELECT_PATTERN = re.compile(r"\bselect\b")
+# 必须出现在 LIMIT 之后的结尾子句：锁定读、导出到文件 / 变量
+_TRAILING_CLAUSE_PATTERN = re.compile(
+    r"\bfor\s+(?:update|share)\b|\block\s+in\s+share\s+mode\b|\binto\s+(?:outfile|dumpfile|@)"
+)
+_FROM_PATTERN = re.compile(r"\bfrom\b")
+
+
+@dataclass
+class PlanTable:
+    """EXPLAIN 结果中的一行"""
+    select_id: int
+    table: str
+    access_type: str
+    key: Optional[str]
+    possible_keys: Optional[str]
+    ref: Optional[str]
+    rows: int
+    filtered: float
+    extra: str
+
+
+@dataclass
+class GuardDecision:
+    """准入检查结论"""
+    allowed: bool = True
+    query: str = ""                                   # 实际执行的 SQL（可能已改写）
+    estimated_rows: int = 0                           # 预计扫描行数
+    estimated_output_rows: int = 0                    # 预计连接输出行数
+    full_scans: List[str] = field(default_factory=list)
+    cartesian_joins: List[str] = field(default_factory=list)
+    notes: List[str] = field(default_factory=list)    # 附加到查询结果中的说明
+    message: str = ""                                 # 拒绝时返回给 Agent 的提示
+
+
+def is_guarded(query: str) -> bool:
+    """只对查询语句做 EXPLAIN 检查"""
+    return normalize_sql(query).startswith(("select", "with", "("))
+
+
+def parse_plan(rows: List[dict]) -> List[PlanTable]:
+    """把 EXPLAIN (传统格式) 的结果行转换为 PlanTable"""
+    plan = []
+    for row in rows:
+        plan.append(PlanTable(
+            select_id=int(row.get("id") or 0),
+            table=str(row.get("table") or ""),
+            access_type=str(row.get("type") or "").upper(),
+            key=row.get("key"),
+            possible_keys=row.get("possible_keys"),
+            ref=row.get("ref"),
+            rows=int(row.get("rows") or 0),
+            filtered=float(row.get("filtered") or 100.0),
+            extra=str(row.get("Extra") or ""),
+        ))
+    return plan
+
+
+def estimate_plan_rows(plan: List[PlanTable]) -> Tuple[int, int]:
+    """
+    估算 (扫描行数, 连接输出行数)。
+
+    同一 SELECT 内按嵌套循环连接累计：前序表输出行数 × 当前表每次扫描行数；
+    hash join 的被连接表只扫描一次，按行数直接累加。不同 SELECT（子查询、UNION）之间相加。
+    """
+    examined = 0
+    fanout_by_select = {}
+    for item in plan:
+        fanout = fanout_by_select.get(item.select_id, 1.0)
+        if "hash join" in item.extra.lower():
+            examined += item.rows
+        else:
+            examined += fanout * item.rows
+        fanout_by_select[item.select_id] = fanout * max(item.rows * item.filtered / 100.0, 1.0)
+    output = max(fanout_by_select.values(), default=0)
+    return int(examined), int(output)
+
+
+def _first_in_select(plan: List[PlanTable], item: PlanTable) -> bool:
+    return next(p for p in plan if p.select_id == item.select_id) is item
+
+
+def evaluate_plan(query: str, plan: List[PlanTable]) -> GuardDecision:
+    """根据执行计划决定放行、改写还是拒绝"""
+    examined, output = estimate_plan_rows(plan)
+    decision = GuardDecision(query=query, estimated_rows=examined, estimated_output_rows=output)
+    for item in plan:
+        if not item.table or item.table.startswith("<"):
+            continue  # 派生表 / UNION 结果等临时表
+        if item.access_type == "ALL":
+            decision.full_scans.append(f"{item.table}(约 {item.rows} 行)")
+            # 走 join buffer、没有 ref 且过滤比例为 100% 说明没有任何连接条件可用
+            if (not _first_in_select(plan, item) and not item.ref and item.filtered >= 100.0
+                    and "join buffer" in item.extra.lower()):
+                decision.cartesian_joins.append(item.table)
+
+    if decision.cartesian_joins and settings.db_guard_reject_cartesian \
+            and decision.estimated_output_rows > settings.db_guard_rewrite_rows:
+        decision.allowed = False
+        decision.message = _reject_message(
+            decision, plan, f"存在没有连接条件的全表连接（疑似笛卡尔积），预计产生约 {output} 行"
+        )
+    elif decision.estimated_rows > settings.db_guard_reject_rows:
+        decision.allowed = False
+        decision.message = _reject_message(
+            decision, plan, f"预计扫描约 {decision.estimated_rows} 行，超过上限 {settings.db_guard_reject_rows} 行"
+        )
+    elif decision.estimated_rows > settings.db_guard_rewrite_rows:
+        decision.query = rewrite_query(query, decision)
+    return decision
+
+
+def _depth(masked: str, position: int) -> int:
+    """掩码文本中某个位置所在的括号层数"""
+    head = masked[:position]
+    return head.count("(") - head.count(")")
+
+
+def _main_select_end(masked: str) -> Optional[int]:
+    """主查询 SELECT 关键字的结束位置：跳过开头 WITH 中括号内的 CTE 定义；整条查询被括号包裹时返回 None"""
+    for match in _SELECT_PATTERN.finditer(masked):
+        if _depth(masked, match.start()) == 0:
+            return match.end()
+    return None
+
+
+def _trailing_clause_start(masked: str) -> int:
+    """主查询结尾的 FOR UPDATE / LOCK IN SHARE MODE / INTO OUTFILE 等子句的起始位置，没有时为语句末尾"""
+    for match in _TRAILING_CLAUSE_PATTERN.finditer(masked):
+        if _depth(masked, match.start()) != 0:
+            continue
+        # SELECT ... INTO @v FROM t 写法中 INTO 位于 FROM 之前，LIMIT 仍放在语句末尾
+        if match.group(0).startswith("into") and any(
+                _depth(masked, m.start()) == 0 for m in _FROM_PATTERN.finditer(masked, match.end())):
+            continue
+        return match.start()
+    return len(masked)
+
+
+def rewrite_query(query: str, decision: GuardDecision) -> str:
+    """注入执行超时提示，并在缺少 LIMIT 时补上 LIMIT（放在锁定读、导出子句之前）"""
+    rewritten = query.strip().rstrip(";").rstrip()
+    masked = mask_sql(rewritten)
+    reason = f"预计扫描约 {decision.estimated_rows} 行，超过 {settings.db_guard_rewrite_rows} 行"
+
+    position = _main_select_end(masked)
+    if not _HINT_PATTERN.search(masked) and position is not None:
+        hint = f"/*+ MAX_EXECUTION_TIME({settings.db_guard_max_execution_ms}) */"
+        rewritten = f"{rewritten[:position]} {hint}{rewritten[position:]}"
+        masked = mask_sql(rewritten)
+        decision.notes.append(f"{reason}，已限制执行时间为 {settings.db_guard_max_execution_ms} 毫秒")
+    tail = _trailing_clause_start(masked)
+    if not _LIMIT_PATTERN.search(masked[:tail].rstrip()):
+        limit = f"{rewritten[:tail].rstrip()}\nLIMIT {settings.db_guard_default_limit}"
+        rewritten = f"{limit}\n{rewritten[tail:]}" if tail < len(rewritten) else limit
+        decision.notes.append(f"{reason}，已自动追加 LIMIT {settings.db_guard_default_limit}")
+    return rewritten
+
+
+def _reject_message(decision: GuardDecision, plan: List[PlanTable], reason: str) -> str:
+    lines = [f"查询被拒绝执行：{reason}。"]
+    if decision.full_scans:
+        lines.append(f"全表扫描的表: {', '.join(decision.full_scans)}")
+    if decision.cartesian_joins:
+        lines.append(f"缺少连接条件的表: {', '.join(decision.cartesian_joins)}，请补充 JOIN ... ON 条件")
+    indexed = [
+        f"{item.table}: {item.possible_keys}" for item in plan
+        if item.access_type == "ALL" and item.possible_keys
+    ]
+    if indexed:
+        lines.append(f"可利用的索引: {'; '.join(indexed)}")
+    lines.append("建议：在 WHERE 中对索引列加过滤条件、缩小时间范围、先聚合再连接，"
+                 "或使用 LIMIT / 采样查询先探索数据。")
+    return "\n".join(lines)
+
+
+def check_query(cursor, query: str) -> GuardDecision:
+    """同步检查，cursor 需为 DictCursor"""
+    if not settings.db_guard_enabled or not is_guarded(query):
+        return GuardDecision(query=query)
+    try:
+        cursor.execute(f"EXPLAIN {query}")
+        plan = parse_plan(list(cursor.fetchall()))
+    except Exception:
+        return GuardDecision(query=query)
+    return evaluate_plan(query, plan)
+
+
+async def acheck_query(cursor, query: str) -> GuardDecision:
+    """check_query 的异步版本，cursor 为 aiomysql DictCursor"""
+    if not settings.db_guard_enabled or not is_guarded(query):
+        return GuardDecision(query=query)
+    try:
+        await cursor.execute(f"EXPLAIN {query}")
+        plan = parse_plan(list(await cursor.fetchall()))
+    except Exception:
+        return GuardDecision(query=query)
+    return evaluate_plan(query, plan)
@@ -0,0 +1,287 @@
+"""
+表概况（Profile）模块
+
+用固定的少量聚合查询在数据库内完成整张表的描述性统计，代替 Agent 逐列、逐指标发起几十次查询：
+
+- 第 1 轮：所有列的非空数、空值数、最小/最大值、均值、标准差（文本列统计长度），
+  以及去重数（小表精确 COUNT(DISTINCT)，大表用 PCSA 概率计数在同一轮中近似）
+- 第 2 轮：数值列的等宽分桶直方图（依赖第 1 轮的最小/最大值）
+- 第 3 轮：低基数文本列的高频值（UNION ALL 合并为一条语句）
+
+SQL 生成和结果解析与执行分离，同步（pymysql）和异步（aiomysql）执行共用同一套逻辑。
+"""
+import math
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from config import settings
+from utils.result_format import encode_rows
+
+NUMERIC_TYPES = {"tinyint", "smallint", "mediumint", "int", "integer", "bigint",
+                 "decimal", "numeric", "float", "double", "real"}
+TEMPORAL_TYPES = {"date", "datetime", "timestamp", "time", "year"}
+TEXT_TYPES = {"char", "varchar", "tinytext", "text", "mediumtext", "longtext", "enum", "set"}
+
+# PCSA 的修正常数
+_PCSA_PHI = 0.77351
+
+
+def quote_identifier(name: str) -> str:
+    return "`" + name.replace("`", "``") + "`"
+
+
+@dataclass
+class ColumnProfile:
+    name: str
+    data_type: str
+    kind: str                                # numeric / temporal / text / other
+    non_null: int = 0
+    nulls: int = 0
+    distinct: Optional[int] = None
+    distinct_exact: bool = True
+    min: Any = None
+    max: Any = None
+    mean: Optional[float] = None
+    std: Optional[float] = None
+    histogram: List[tuple] = field(default_factory=list)     # [(下界, 上界, 行数)]
+    top_values: List[tuple] = field(default_factory=list)    # [(值, 行数)]
+
+
+@dataclass
+class TableProfile:
+    table: str
+    row_count: int = 0
+    columns: List[ColumnProfile] = field(default_factory=list)
+    passes: int = 0
+    notes: List[str] = field(default_factory=list)
+
+
+def column_kind(data_type: str) -> str:
+    data_type = data_type.lower()
+    if data_type in NUMERIC_TYPES:
+        return "numeric"
+    if data_type in TEMPORAL_TYPES:
+        return "temporal"
+    if data_type in TEXT_TYPES:
+        return "text"
+    return "other"
+
+
+def _pcsa_estimate(sketches: List[int], non_null: int) -> int:
+    """根据各分桶的位图估算去重数"""
+    m = len(sketches)
+    if non_null == 0:
+        return 0
+    empty = sum(1 for s in sketches if not s)
+    if empty:
+        # 小基数时 PCSA 偏高，有空桶时改用线性计数
+        estimate = m * math.log(m / empty)
+    else:
+        lowest_zero = []
+        for sketch in sketches:
+            r = 0
+            while sketch & (1 << r):
+                r += 1
+            lowest_zero.append(r)
+        estimate = m / _PCSA_PHI * 2 ** (sum(lowest_zero) / m)
+    return max(1, min(non_null, int(round(estimate))))
+
+
+class TableProfiler:
+    """生成表概况的 SQL 并解析结果"""
+
+    def __init__(self, table, source_sql: str, columns: Optional[List[str]] = None,
+                 buckets: int = settings.db_profile_histogram_buckets):
+        """
+        Args:
+            table: schema_catalog.TableInfo
+            source_sql: FROM 子句中使用的数据源（表名或采样子查询）
+            columns: 只统计指定列，为空时统计全部列
+            buckets: 数值列直方图分桶数
+        """
+        self.table = table
+        self.source_sql = source_sql
+        self.buckets = max(1, buckets)
+        selected = table.columns
+        if columns:
+            wanted = {c.lower() for c in columns}
+            selected = [c for c in table.columns if c.name.lower() in wanted]
+        self.profile = TableProfile(table=table.name)
+        self.profile.columns = [ColumnProfile(c.name, c.data_type, column_kind(c.data_type)) for c in selected]
+        self.exact_distinct = (table.rows_estimate or 0) <= settings.db_profile_exact_distinct_rows
+        self.sketch_buckets = settings.db_profile_sketch_buckets
+
+    def _hint(self) -> str:
+        return f"/*+ MAX_EXECUTION_TIME({settings.db_profile_max_execution_ms}) */"
+
+    # ---------- 第 1 轮：基础统计 ----------
+
+    def stats_sql(self) -> str:
+        exprs = ["COUNT(*) AS `__rows`"]
+        for i, col in enumerate(self.profile.columns):
+            q = quote_identifier(col.name)
+            exprs.append(f"COUNT({q}) AS `c{i}_nn`")
+            if col.kind == "numeric":
+                exprs += [f"MIN({q}) AS `c{i}_min`", f"MAX({q}) AS `c{i}_max`",
+                          f"AVG({q}) AS `c{i}_avg`", f"STDDEV_POP({q}) AS `c{i}_std`"]
+            elif col.kind == "temporal":
+                exprs += [f"MIN({q}) AS `c{i}_min`", f"MAX({q}) AS `c{i}_max`"]
+            elif col.kind == "text":
+                exprs += [f"MIN(CHAR_LENGTH({q})) AS `c{i}_min`", f"MAX(CHAR_LENGTH({q})) AS `c{i}_max`",
+                          f"AVG(CHAR_LENGTH({q})) AS `c{i}_avg`"]
+            if col.kind == "other":
+                continue
+            if self.exact_distinct:
+                exprs.append(f"COUNT(DISTINCT {q}) AS `c{i}_nd`")
+            else:
+                # PCSA：低位选桶，剩余位的末尾零个数写入该桶的位图
+                m = self.sketch_buckets
+                rest = f"((CRC32({q}) DIV {m}) | 0x100000000)"
+                rho = f"(BIT_COUNT({rest} ^ ({rest} - 1)) - 1)"
+                for b in range(m):
+                    exprs.append(f"BIT_OR(IF(CRC32({q}) % {m} = {b}, 1 << {rho}, 0)) AS `c{i}_s{b}`")
+        return f"SELECT {self._hint()} {', '.join(exprs)} FROM {self.source_sql}"
+
+    def apply_stats(self, row: Dict[str, Any]):
+        self.profile.passes += 1
+        self.profile.row_count = int(row["__rows"] or 0)
+        for i, col in enumerate(self.profile.columns):
+            col.non_null = int(row[f"c{i}_nn"] or 0)
+            col.nulls = self.profile.row_count - col.non_null
+            col.min = row.get(f"c{i}_min")
+            col.max = row.get(f"c{i}_max")
+            if row.get(f"c{i}_avg") is not None:
+                col.mean = float(row[f"c{i}_avg"])
+            if row.get(f"c{i}_std") is not None:
+                col.std = float(row[f"c{i}_std"])
+            if f"c{i}_nd" in row:
+                col.distinct = int(row[f"c{i}_nd"] or 0)
+            elif f"c{i}_s0" in row:
+                sketches = [int(row[f"c{i}_s{b}"] or 0) for b in range(self.sketch_buckets)]
+                col.distinct = _pcsa_estimate(sketches, col.non_null)
+                col.distinct_exact = False
+
+    # ---------- 第 2 轮：数值直方图 ----------
+
+    def _histogram_columns(self) -> List[int]:
+        return [
+            i for i, col in enumerate(self.profile.columns)
+            if col.kind == "numeric" and col.min is not None and col.max is not None and col.min != col.max
+        ]
+
+    def _bounds(self, col: ColumnProfile) -> List[float]:
+        low, high = float(col.min), float(col.max)
+        width = (high - low) / self.buckets
+        return [low + width * k for k in range(self.buckets)] + [high]
+
+    def histogram_sql(self) -> Optional[str]:
+        exprs = []
+        for i in self._histogram_columns():
+            col = self.profile.columns[i]
+            q = quote_identifier(col.name)
+            bounds = self._bounds(col)
+            for k in range(self.buckets):
+                upper_op = "<=" if k == self.buckets - 1 else "<"
+                exprs.append(f"SUM({q} >= {bounds[k]!r} AND {q} {upper_op} {bounds[k + 1]!r}) AS `c{i}_h{k}`")
+        if not exprs:
+            return None
+        return f"SELECT {self._hint()} {', '.join(exprs)} FROM {self.source_sql}"
+
+    def apply_histogram(self, row: Dict[str, Any]):
+        self.profile.passes += 1
+        for i in self._histogram_columns():
+            col = self.profile.columns[i]
+            bounds = self._bounds(col)
+            col.histogram = [
+                (bounds[k], bounds[k + 1], int(row[f"c{i}_h{k}"] or 0)) for k in range(self.buckets)
+            ]
+
+    # ---------- 第 3 轮：低基数文本列高频值 ----------
+
+    def _top_columns(self) -> List[int]:
+        return [
+            i for i, col in enumerate(self.profile.columns)
+            if col.kind == "text" and col.distinct is not None and 0 < col.distinct <= settings.db_profile_top_max_distinct
+        ]
+
+    def top_values_sql(self) -> Optional[str]:
+        parts = []
+        for i in self._top_columns():
+            q = quote_identifier(self.profile.columns[i].name)
+            parts.append(
+                f"(SELECT {i} AS col_idx, CAST({q} AS CHAR) AS val, COUNT(*) AS cnt FROM {self.source_sql} "
+                f"WHERE {q} IS NOT NULL GROUP BY {q} ORDER BY cnt DESC LIMIT {settings.db_profile_top_values})"
+            )
+        if not parts:
+            return None
+        return " UNION ALL ".join(parts)
+
+    def apply_top_values(self, rows: List[Dict[str, Any]]):
+        self.profile.passes += 1
+        for row in rows:
+            self.profile.columns[int(row["col_idx"])].top_values.append((row["val"], int(row["cnt"])))
+
+
+def format_profile(profile: TableProfile) -> str:
+    """把表概况格式化为紧凑文本"""
+    header = ["column", "type", "non_null", "null_pct", "distinct", "min", "max", "mean", "std"]
+    rows = []
+    for col in profile.columns:
+        null_pct = round(col.nulls * 100.0 / profile.row_count, 2) if profile.row_count else 0
+        distinct = "" if col.distinct is None else (str(col.distinct) if col.distinct_exact else f"≈{col.distinct}")
+        prefix = "len:" if col.kind == "text" and col.min is not None else ""
+        rows.append({
+            "column": col.name, "type": col.data_type, "non_null": col.non_null, "null_pct": null_pct,
+            "distinct": distinct,
+            "min": f"{prefix}{col.min}" if col.min is not None else None,
+            "max": f"{prefix}{col.max}" if col.max is not None else None,
+            "mean": col.mean, "std": col.std,
+        })
+    lines = [f"表 '{profile.table}' 概况: 共 {profile.row_count} 行，{len(profile.columns)} 列（{profile.passes} 轮聚合查询）"]
+    lines.append(encode_rows(header, rows, "csv"))
+    histograms = [col for col in profile.columns if col.histogram]
+    if histograms:
+        lines.append("数值分布（等宽分桶，[下界, 上界): 行数）:")
+        for col in histograms:
+            buckets = " ".join(f"[{lo:.4g},{hi:.4g}):{count}" for lo, hi, count in col.histogram)
+            lines.append(f"- {col.name}: {buckets}")
+    tops = [col for col in profile.columns if col.top_values]
+    if tops:
+        lines.append("高频取值:")
+        for col in tops:
+            values = ", ".join(f"{value}({count})" for value, count in col.top_values)
+            lines.append(f"- {col.name}: {values}")
+    if any(not col.distinct_exact for col in profile.columns):
+        lines.append("注: ≈ 表示基于 PCSA 概率计数的近似去重数，误差约 ±20%。")
+    lines.extend(f"注: {note}" for note in profile.notes)
+    return "\n".join(lines)
+
+
+def run_profile(cursor, profiler: TableProfiler) -> TableProfile:
+    """同步执行各轮聚合查询，cursor 需为 DictCursor"""
+    cursor.execute(profiler.stats_sql())
+    profiler.apply_stats(cursor.fetchone())
+    sql = profiler.histogram_sql()
+    if sql:
+        cursor.execute(sql)
+        profiler.apply_histogram(cursor.fetchone())
+    sql = profiler.top_values_sql()
+    if sql:
+        cursor.execute(sql)
+        profiler.apply_top_values(list(cursor.fetchall()))
+    return profiler.profile
+
+
+async def arun_profile(cursor, profiler: TableProfiler) -> TableProfile:
+    """run_profile 的异步版本，cursor 为 aiomysql DictCursor"""
+    await cursor.execute(profiler.stats_sql())
+    profiler.apply_stats(await cursor.fetchone())
+    sql = profiler.histogram_sql()
+    if sql:
+        await cursor.execute(sql)
+        profiler.apply_histogram(await cursor.fetchone())
+    sql = profiler.top_values_sql()
+    if sql:
+        await cursor.execute(sql)
+        profiler.apply_top_values(list(await cursor.fetchall()))
+    return profiler.profile